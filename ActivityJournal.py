@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import time
+from typing import Dict, Tuple, List
+
+from DocumentWriteBuffer import DocumentWriteBuffer
+from Helper import iterateDocumentsByIDs
+from models import User
+
+
+""" Journaled lines get fsynced once this many records are unsynced or the oldest unsynced record is older than MAX_SECONDS_UNSYNCED (see syncIfDue). """
+MAX_UNSYNCED_RECORDS = 100
+MAX_SECONDS_UNSYNCED = 5
+
+
+class ActivityType:
+    BOT_USED = 'botUsed'
+    NOTIFICATION_RECEIVED = 'notificationReceived'
+
+
+class ActivityJournal:
+    """ Append-only local journal of user activity timestamps.
+     Recording activity only appends one line to a local file so interactive handlers never have to wait for a DB write just to record activity.
+     'flush' periodically moves the journal aside, compacts it to the latest timestamp per user and activity type and writes the result to DB in bulk.
+     Lines get fsynced in batches so recording never waits for the disk: If the machine crashes, at most the activity of the last <MAX_UNSYNCED_RECORDS> records or
+     <MAX_SECONDS_UNSYNCED> seconds (plus the interval of the routine calling syncIfDue) is lost. Activity only decides when users get auto deleted so that is acceptable.
+     A journal only gets deleted once all of its entries are in the DB. """
+
+    def __init__(self, path: str, writeBuffer: DocumentWriteBuffer):
+        self.path = path
+        self.pathCompacting = path + '.compacting'
+        self.writeBuffer = writeBuffer
+        self.journal = None
+        self.numberofUnsyncedRecords = 0
+        self.timestampOldestUnsyncedRecord = None
+
+    def record(self, userID: str, activityType: str, timestamp: float):
+        self.recordMany({(userID, activityType): timestamp})
+
+    def recordMany(self, entries: Dict[Tuple[str, str], float]):
+        if self.journal is None:
+            self.journal = open(self.path, 'a', encoding='utf-8')
+        for (userID, activityType), timestamp in entries.items():
+            self.journal.write(json.dumps({'u': userID, 't': activityType, 'ts': timestamp}) + '\n')
+        self.numberofUnsyncedRecords += len(entries)
+        if self.timestampOldestUnsyncedRecord is None:
+            self.timestampOldestUnsyncedRecord = time.monotonic()
+        if self.numberofUnsyncedRecords >= MAX_UNSYNCED_RECORDS:
+            self.sync()
+
+    def syncIfDue(self):
+        if self.timestampOldestUnsyncedRecord is not None and time.monotonic() - self.timestampOldestUnsyncedRecord >= MAX_SECONDS_UNSYNCED:
+            self.sync()
+
+    def sync(self):
+        """ Makes sure that all recorded activity is on disk. """
+        if self.journal is None or self.numberofUnsyncedRecords == 0:
+            return
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.numberofUnsyncedRecords = 0
+        self.timestampOldestUnsyncedRecord = None
+
+    def close(self):
+        if self.journal is None:
+            return
+        self.sync()
+        self.journal.close()
+        self.journal = None
+
+    def readCompacted(self, path: str) -> Dict[Tuple[str, str], float]:
+        """ Returns latest timestamp per (userID, activityType) of given journal file. """
+        entries = {}
+        with open(path, encoding='utf-8') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Incomplete last line e.g. due to a crash while writing it
+                    continue
+                key = (entry['u'], entry['t'])
+                entries[key] = max(entries.get(key, 0), entry['ts'])
+        return entries
+
+    def flush(self) -> List[str]:
+        """ Writes all journaled activity to DB. Returns IDs of all updated users. """
+        if not os.path.exists(self.pathCompacting):
+            if not os.path.exists(self.path):
+                return []
+            # Atomic: New activity will go into a new journal file from now on
+            self.close()
+            os.replace(self.path, self.pathCompacting)
+        entries = self.readCompacted(self.pathCompacting)
+        timestampsByUserID = {}
+        for (userID, activityType), timestamp in entries.items():
+            timestampsByUserID.setdefault(userID, {})[activityType] = timestamp
+        usersToUpdate = []
+        for user in iterateDocumentsByIDs(self.writeBuffer.db, User, list(timestampsByUserID.keys())):
+            # Apply activity to the buffered instance of this user if there is one so we don't create conflicts with ourselves
+            user = self.writeBuffer.get(user.id) or user
+            if applyActivity(user, timestampsByUserID[user.id]):
+                usersToUpdate.append(user)
+        failedUserIDs = {user.id for user in self.writeBuffer.writeDocuments(usersToUpdate)}
+        if len(failedUserIDs) > 0:
+            # Keep activity of these users for the next run
+            self.recordMany({key: timestamp for key, timestamp in entries.items() if key[0] in failedUserIDs})
+            self.sync()
+        os.remove(self.pathCompacting)
+        updatedUserIDs = [user.id for user in usersToUpdate if user.id not in failedUserIDs]
+        logging.info(f'Activity journal: Updated {len(updatedUserIDs)}/{len(timestampsByUserID)} users')
+        return updatedUserIDs
+
+
+def applyActivity(user: User, timestamps: Dict[str, float]) -> bool:
+    """ Applies journaled activity timestamps to given user. Same logic as User.updateActivityTimestamp and User.updateNotificationReceivedActivityTimestamp
+     but never overwrites newer information e.g. user has blocked the bot after the recorded activity. Returns True if user has changed. """
+    hasChanged = False
+    for activityType, timestamp in timestamps.items():
+        if activityType == ActivityType.BOT_USED:
+            if timestamp <= user.timestampLastTimeBotUsed:
+                continue
+            user.timestampLastTimeBotUsed = timestamp
+        elif activityType == ActivityType.NOTIFICATION_RECEIVED:
+            if timestamp <= user.timestampLastTimeNotificationSentSuccessfully:
+                continue
+            user.timestampLastTimeNotificationSentSuccessfully = timestamp
+        else:
+            continue
+        hasChanged = True
+        if timestamp > user.timestampLastTimeWarnedAboutUpcomingAutoAccountDeletion:
+            user.timesInformedAboutUpcomingAutoAccountDeletion = 0
+        if timestamp > user.timestampLastTimeBlockedBot:
+            user.botBlockedCounter = 0
+    return hasChanged
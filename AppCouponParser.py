@@ -0,0 +1,159 @@
+import logging
+import re
+from datetime import datetime
+from typing import List
+
+from Helper import CouponType, shortenProductNames
+from UtilsCouponsDB import Coupon
+
+""" Compiled once instead of for every coupon. """
+REGEX_LEGACY_INTERNAL_NAME = re.compile(r'[A-Za-z0-9]+_\d+_(?:UPSELL_|CRM_MYBK_|MYBK_|\d{3,}_)?(.+)')
+REGEX_FOOTNOTE_EXPIRE_DATE = re.compile(r'(?i)Abgabe bis (\d{1,2}\.\d{1,2}\.\d{4})')
+DATEFORMAT_RULE_START = '%Y-%m-%d'
+DATEFORMAT_RULE_END = '%Y-%m-%d %H:%M:%S'
+
+
+def getAppCouponObjects(offer: dict) -> List[dict]:
+    """ Returns coupon objects contained in one offer object of the app API: The offer itself followed by its upsell ("hidden") coupons. """
+    if offer.get('testOnly') is True:
+        # 2025-01-25
+        logging.info("Skipping internal TEST-item")
+        return []
+    bkCoupons = [offer]
+    # Collect hidden coupons
+    upsellOptions = offer.get('upsellOptions')
+    if upsellOptions is not None:
+        for upsellOption in upsellOptions:
+            upsellID = upsellOption.get('_id')
+            upsellType = upsellOption.get('_type')
+            upsellShortCode = upsellOption.get('shortCode')
+            if upsellType != 'offer' or upsellShortCode is None:
+                # Skip invalid items: This should never happen
+                logging.info(f"Found invalid/unsupported upsell object: {upsellID=}")
+                continue
+            bkCoupons.append(upsellOption)
+    return bkCoupons
+
+
+def parseAppCoupon(couponBK: dict, isHidden: bool = False) -> Coupon:
+    """ Creates Coupon from one coupon object of the app API. Does not modify the given object and does not do any I/O so it can be tested and benchmarked offline. """
+    vendorConfigs = couponBK['vendorConfigs']
+    try:
+        uniqueCouponID = vendorConfigs['rpos']['constantPlu']
+    except:
+        uniqueCouponID = None
+    if uniqueCouponID is None:
+        uniqueCouponID = vendorConfigs['partner']['constantPlu']
+    legacyInternalName = couponBK.get('internalName')
+    # Find coupon-title. Prefer to get it from 'internalName' as the other title may contain crap we don't want.
+    # 2022-11-02: Prefer normal titles again because internal ones are sometimes incomplete
+    useInternalNameAsTitle = False
+    legacyInternalNameRegex = None
+    if legacyInternalName is not None:
+        legacyInternalNameRegex = REGEX_LEGACY_INTERNAL_NAME.search(legacyInternalName)
+    subtitle = None
+    try:
+        subtitle = couponBK['description']['localeRaw'][0]['children'][0]['text']
+    except:
+        # Subtitle is not always available
+        pass
+    if legacyInternalNameRegex is not None and useInternalNameAsTitle:
+        titleFull = legacyInternalNameRegex.group(1)
+        titleFull = titleFull.replace('_', ' ')
+    else:
+        """ Decide how to use title and subtitle and if it makes sense to put both into one string. """
+        title = couponBK['name']['localeRaw'][0]['children'][0]['text']
+        title = title.strip()
+        if subtitle is None:
+            titleFull = title
+        else:
+            subtitle = subtitle.strip()
+            titleShortened = shortenProductNames(title)
+            subtitleShortened = shortenProductNames(subtitle)
+            if len(subtitleShortened) == 0 or subtitleShortened.isspace():
+                # Useless subtitle -> Use title only
+                titleFull = title
+            elif len(titleShortened) == 0 or titleShortened.isspace():
+                # Useless title -> Use subtitle only
+                titleFull = subtitle
+            elif titleShortened == subtitleShortened:  # Small hack: Shorten titles before comparing them
+                # Title and subtitle are the same -> Use title only
+                titleFull = title
+            elif not subtitle.startswith('+'):
+                logging.info(
+                    f'Coupon {uniqueCouponID}: Possible subtitle which should not be included in coupon title because it doesnt start with a plus sumbol: {subtitle=}')
+                titleFull = title
+            else:
+                # Assume that subtitle is usable and add it to title
+                titleFull = title + ' ' + subtitle
+
+    price = couponBK['offerPrice']
+    plu = couponBK['shortCode']
+    coupon = Coupon(id=uniqueCouponID, uniqueID=uniqueCouponID, plu=plu, title=titleFull, subtitle=subtitle, type=CouponType.APP)
+    # ID which can be used to view coupon in browser
+    coupon.webviewID = couponBK.get('loyaltyEngineId')
+    if isHidden:
+        # First item = Real coupon, all others = upsell/"hidden" coupon(s)
+        coupon.isHidden = True
+    if price == 0:
+        # Special detection for some 50%/2for1 coupons that are listed with price == 0€
+        if titleFull.startswith('2'):
+            # E.g. 2 Crispy Chicken
+            coupon.staticReducedPercent = 50
+        else:
+            # While it is super unlikely let's allow BK to provide coupons for free products :)
+            coupon.price = 0
+    else:
+        coupon.price = price
+    # Build URL to coupon product image
+    imageurl = couponBK['localizedImage']['locale']['app']['asset']['_id']
+    imageurl = "https://cdn.sanity.io/images/czqk28jt/prod_bk_de/" + imageurl.replace('image-', '')
+    imageurl = imageurl.replace('-png', '.png')
+    coupon.imageURL = imageurl
+    """ Find and set start- and expire-date.
+     """
+    datetimeExpire1 = None
+    datetimeExpire2 = None
+    datetimeStart = None
+    try:
+        footnote = couponBK['moreInfo']['localeRaw'][0]['children'][0]['text']
+        expiredateRegex = REGEX_FOOTNOTE_EXPIRE_DATE.search(footnote)
+        if expiredateRegex is not None:
+            expiredateStr = expiredateRegex.group(1) + ' 23:59:59'
+            datetimeExpire1 = datetime.strptime(expiredateStr, '%d.%m.%Y %H:%M:%S')
+    except:
+        # Dontcare
+        logging.warning('Failed to find BetterExpiredate for coupon: ' + coupon.id)
+    rulesHere = couponBK.get('rules')
+    if rulesHere is not None:
+        rulesAll = []
+        for ruleSet in rulesHere:
+            ruleSetsChilds = ruleSet.get('rules')
+            if ruleSetsChilds is not None:
+                for ruleSetsChild in ruleSetsChilds:
+                    rulesAll.append(ruleSetsChild)
+            else:
+                rulesAll.append(ruleSet)
+        for rule in rulesAll:
+            if rule['__typename'] == 'LoyaltyBetweenDates':
+                datetimeStart = datetime.strptime(rule['startDate'], DATEFORMAT_RULE_START)
+                datetimeExpire2 = datetime.strptime(rule['endDate'] + ' 23:59:59', DATEFORMAT_RULE_END)
+                break
+    else:
+        logging.info(f'Coupon without rules field: {coupon.id}')
+    if datetimeExpire1 is None and datetimeExpire2 is None:
+        # This should never happen
+        raise Exception(f'WTF failed to find any expiredate for coupon: {uniqueCouponID}')
+    if datetimeExpire1 is not None:
+        # Prefer this expiredate
+        coupon.timestampExpire = datetimeExpire1.timestamp()
+    else:
+        coupon.timestampExpire = datetimeExpire2.timestamp()
+    if datetimeStart is not None:
+        coupon.timestampStart = datetimeStart.timestamp()
+    return coupon
+
+
+def parseAppOffer(offer: dict) -> List[Coupon]:
+    """ Returns all coupons contained in one offer object of the app API. """
+    return [parseAppCoupon(couponBK, isHidden=index > 0) for index, couponBK in enumerate(getAppCouponObjects(offer))]
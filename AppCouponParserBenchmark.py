@@ -0,0 +1,61 @@
+import argparse
+import json
+import os
+import time
+
+from AppCouponParser import parseAppOffer
+from Helper import shortenProductNames
+
+""" Measures the speed of the app coupon parser by replaying a saved API response (see BKCrawler.setStoreCouponAPIDataAsJson) at 1x, 10x and 100x its size.
+ Also checks that parsing is deterministic and does not modify the API data.
+ Use '-m' to fail if parsing gets slower than the given number of microseconds per offer e.g. to detect performance regressions. """
+
+PATH_APP_COUPONS_JSON = 'crawler/coupons1.json'
+SIZE_FACTORS = [1, 10, 100]
+
+
+def parseOffers(offers: list) -> list:
+    coupons = []
+    for offer in offers:
+        coupons += parseAppOffer(offer)
+    return coupons
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-m', '--max-microseconds', help='Max. allowed parsing time per offer in microseconds.', type=float)
+    args = parser.parse_args()
+    if not os.path.exists(PATH_APP_COUPONS_JSON):
+        print(f'{PATH_APP_COUPONS_JSON} not found -> Run crawler with setStoreCouponAPIDataAsJson(True) once to create it')
+        raise SystemExit(1)
+    with open(PATH_APP_COUPONS_JSON, encoding='utf-8') as infile:
+        offers = json.load(infile)['data']['LoyaltyOffersUI']['sortedSystemwideOffers']
+    if len(offers) == 0:
+        print(f'{PATH_APP_COUPONS_JSON} does not contain any offers')
+        raise SystemExit(1)
+    offersJsonBefore = json.dumps(offers, sort_keys=True)
+    expectedCoupons = [dict(coupon.items()) for coupon in parseOffers(offers)]
+    if json.dumps(offers, sort_keys=True) != offersJsonBefore:
+        print('Parser has modified the API data')
+        raise SystemExit(1)
+    print(f'{len(offers)} offers -> {len(expectedCoupons)} coupons')
+    microsecondsPerOffer = 0
+    for sizeFactor in SIZE_FACTORS:
+        offersScaled = offers * sizeFactor
+        # Start every run with an empty shortenProductNames cache like a freshly started crawler
+        shortenProductNames.cache_clear()
+        timestampStart = time.perf_counter()
+        coupons = parseOffers(offersScaled)
+        duration = time.perf_counter() - timestampStart
+        if [dict(coupon.items()) for coupon in coupons] != expectedCoupons * sizeFactor:
+            print(f'{sizeFactor}x: Parser results differ between runs')
+            raise SystemExit(1)
+        microsecondsPerOffer = duration * 1000000 / len(offersScaled)
+        print(f'{sizeFactor}x: {len(offersScaled)} offers in {duration * 1000:.1f}ms | {microsecondsPerOffer:.1f}µs per offer | {len(coupons) / duration:.0f} coupons/s')
+    if args.max_microseconds is not None and microsecondsPerOffer > args.max_microseconds:
+        print(f'Too slow: {microsecondsPerOffer:.1f}µs per offer > {args.max_microseconds}µs')
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import argparse
 import asyncio
 import math
+import time
 import traceback
 from copy import deepcopy
 from typing import Tuple
@@ -17,15 +18,21 @@ from BotNotificator import updatePublicChannel, collectNewCouponsNotifications,
     notifyAdminsAboutProblems
 from BotUtils import *
 from BaseUtils import *
-from BotUtils import loadConfig, ImageCache
+from BotUtils import loadConfig, ImageCache, TelegramRateLimiter, NotificationDispatcher
 
 from Helper import *
 from Crawler import BKCrawler, UserStats
 
 from UtilsCouponsDB import Coupon, getCouponsSeparatedByType, UserFavoritesInfo, \
-    USER_SETTINGS_ON_OFF, CouponViews, sortCouponsAsList, MAX_HOURS_ACTIVITY_TRACKING, getCouponViewByIndex, CouponTextRepresentationPLUMode
+    USER_SETTINGS_ON_OFF, CouponViews, MAX_HOURS_ACTIVITY_TRACKING, getCouponViewByIndex, CouponTextRepresentationPLUMode, \
+    MAX_SECONDS_WITHOUT_USAGE_UNTIL_AUTO_ACCOUNT_DELETION
 from filters import CouponFilter
-from models import InfoEntry, ChannelCoupon, User
+from models import InfoEntry, ChannelCoupon, User, USER_VIEW_PENDING_NOTIFICATIONS, USER_VIEW_AUTO_DELETION_CANDIDATES, getViewName
+from NotificationOutbox import NotificationOutbox
+from DocumentWriteBuffer import DocumentWriteBuffer
+from DocumentCache import DocumentCache
+from ActivityJournal import ActivityJournal, ActivityType
+from FavoritesIndex import FavoritesIndex
 from CouponCategory import CouponCategory
 from Helper import BotAllowedCouponTypes, CouponType, TEXT_NOTIFICATION_DISABLE
 from UtilsOffers import offerGetImagePath
@@ -113,12 +120,23 @@ class BKBot:
         self.botName = self.cfg.bot_name
         self.couchdb = self.crawler.couchdb
         self.userdb = self.crawler.getUserDB()
+        # Users by favorite coupons: Gets updated whenever a user has been written to DB
+        self.favoritesIndex = FavoritesIndex()
+        # Recently active users so clicking through the menus doesn't require loading the user from DB every time
+        self.userCache = DocumentCache(self.userdb, User, maxSize=2000, onDocumentStored=self.favoritesIndex.updateUser)
+        # Collects changed user documents e.g. after sending notifications and writes them in bulk. Written users replace outdated instances in the cache.
+        self.userWriteBuffer = DocumentWriteBuffer(self.userdb, onDocumentWritten=self.onUserWritten, onDocumentDropped=self.userCache.invalidate)
+        # Activity timestamps get journaled locally and written to DB in bulk later
+        self.activityJournal = ActivityJournal(Paths.activityJournalPath, self.userWriteBuffer)
+        self.notificationOutbox = NotificationOutbox(outboxDB=self.crawler.getNotificationOutboxDB(), messagesDB=self.crawler.getNotificationMessagesDB())
+        # Build inverted favorites index once, afterwards it gets updated whenever favorites are added/removed
+        self.favoritesIndex.rebuild(iterateDocuments(self.userdb, User))
         self.coupondb = self.crawler.getCouponDB()
         self.application = Application.builder().token(self.cfg.bot_token).read_timeout(30).write_timeout(30).build()
         self.initHandlers()
         self.application.add_error_handler(self.botErrorCallback)
-        self.statsCached: Union[UserStats, None] = None
-        self.statsCachedTimestamp: float = -1
+        # Shared by everything that sends messages so we stay below Telegrams' rate limits
+        self.rateLimiter = TelegramRateLimiter(messagesPerSecond=self.cfg.max_messages_per_second)
         self.debugmode: bool = self.args.debugmode
 
     def initHandlers(self):
@@ -307,8 +325,10 @@ class BKBot:
 
     async def botDisplayMenuMain(self, update: Update, context: CallbackContext):
         userIDStr = str(update.effective_user.id)
-        isNewUser = userIDStr not in self.userdb
+        # Users in cache definitely exist -> Saves us one DB request
+        isNewUser = self.userCache.get(userIDStr) is None and self.userWriteBuffer.get(userIDStr) is None and userIDStr not in self.userdb
         user: User = await self.getUser(userID=userIDStr)
+        self.crawler.updateCachesIfOutdated()
         allButtons = []
         if self.getPublicChannelName() is not None:
             allButtons.append([InlineKeyboardButton('Alle Coupons Liste + Pics + News', url='https://t.me/' + self.getPublicChannelName())])
@@ -447,31 +467,27 @@ class BKBot:
         query = update.callback_query
         if query is not None:
             await query.answer()
-        userDB = self.userdb
-        loadingMessage = None
-        currentDatetime = getCurrentDate()
-        if self.statsCached is None or currentDatetime.timestamp() - self.statsCachedTimestamp > 30 * 60:
-            # Init/Refresh cache
-            loadingMessage = await asyncio.create_task(self.editOrSendMessage(update, text='Statistiken werden geladen...'))
-            self.statsCached = UserStats(userDB)
-            self.statsCachedTimestamp = currentDatetime.timestamp()
+        # Cheap: Only reads precomputed counters from CouchDB views
+        userStats = UserStats(self.userdb)
         couponDB = self.getFilteredCouponsAsList(couponFilter=CouponFilter())
-        userStats = self.statsCached
+        self.crawler.updateCachesIfOutdated()
         user = await self.getUser(userID=update.effective_user.id)
         text = f'<b>Hallo <s>Nerd</s> {update.effective_user.first_name}</b>'
         text += '\n<pre>'
-        text += f'Anzahl User im Bot: {len(userDB)}'
+        text += f'Anzahl User im Bot: {userStats.numberofUsersTotal}'
         text += f'\nAnzahl von Usern gesetzte Favoriten: {userStats.numberofFavorites}'
         text += f'\nAnzahl User, die das Easter-Egg entdeckt haben: {userStats.numberofUsersWhoFoundEasterEgg}'
         text += f'\nAnzahl User, die den Bot wahrscheinlich geblockt haben: {userStats.numberofUsersWhoProbablyBlockedBot}'
+        text += f'\nAnzahl User, deren Account automatisch gelöscht werden kann: {userStats.numberofUsersWhoAreEligableForAutoDeletion}'
         text += f'\nAnzahl User, die den Bot innerhalb der letzten {MAX_HOURS_ACTIVITY_TRACKING}h genutzt haben: ' + str(userStats.numberofUsersWhoRecentlyUsedBot)
         text += f'\nAnzahl User, die eine PB Karte hinzugefügt haben: {userStats.numberofUsersWhoAddedPaybackCard}'
         text += f'\nAnzahl User, die den BetterKing Newsletter aktiviert haben: {userStats.numberofUsersWhoEnabledBotNewsletter}'
         text += f'\nAnzahl User, die den Spenden Button deaktiviert haben haben: {userStats.numberofUsersWhoDisabledDonateButton}'
         text += f'\nAnzahl gültige Coupons: {len(couponDB)}'
         text += f'\nAnzahl bald verfügbarer Coupons: {len(self.crawler.cachedFutureCoupons)}'
+        text += f'\nCoupon-Listen Cache: {self.crawler.getCouponListCacheStatsText()}'
+        text += f'\nUser Cache: {self.userCache.getStatsText()}'
         text += f'\nAnzahl gültige Angebote: {len(self.crawler.getOffersActive())}'
-        text += f'\nStatistiken generiert am: {formatDateGermanHuman(self.statsCachedTimestamp)}'
         text += '\n---'
         text += '\nDein BetterKing Account:'
         text += f'\nAnzahl Aufrufe Easter-Egg: {user.easterEggCounter}'
@@ -481,12 +497,7 @@ class BKBot:
         text += '\n---'
         text += f'\nAlle Datumsangaben zur Bot Verwendung / Benachrichtigungszeitpunkte sind auf {MAX_HOURS_ACTIVITY_TRACKING}h genau.'
         text += '</pre>'
-        if loadingMessage is not None:
-            # Edit existing message
-            await self.editMessage(chat_id=loadingMessage.chat_id, message_id=loadingMessage.message_id, text=text, parse_mode='html', disable_web_page_preview=True)
-        else:
-            # Send new message
-            await self.sendMessage(chat_id=update.effective_chat.id, text=text, parse_mode='html', disable_web_page_preview=True)
+        await self.sendMessage(chat_id=update.effective_chat.id, text=text, parse_mode='html', disable_web_page_preview=True)
         return ConversationHandler.END
 
     async def displayCoupons(self, update: Update, context: CallbackContext, callbackVar: str):
@@ -505,10 +516,9 @@ class BKBot:
         action = urlinfo.get('a')
         try:
             saveUserToDB = False
-            userDB = self.userdb
             user = await self.getUser(userID=update.effective_user.id)
             if user.updateActivityTimestamp():
-                saveUserToDB = True
+                self.activityJournal.record(user.id, ActivityType.BOT_USED, user.timestampLastTimeBotUsed)
             if view.allowModifyFilter:
                 # Inherit some filters from user settings
                 view = deepcopy(view)
@@ -529,28 +539,30 @@ class BKBot:
                 if view.highlightFavorites is None:
                     # User setting overrides unser param in view
                     view.highlightFavorites = user.settings.highlightFavoriteCouponsInButtonTexts
+            if action == 'dcss':
+                # Change sort of coupons
+                sortMode = user.getNextSortModeForCouponView(couponView=view)
+            else:
+                sortMode = user.getSortModeForCouponView(couponView=view)
             if view == CouponViews.FAVORITES:
                 userFavorites, menuText = self.getUserFavoritesAndUserSpecificMenuText(user=user, sortCoupons=False)
-                coupons = userFavorites.couponsAvailable
-                couponCategory = CouponCategory(coupons)
+                couponCategory = CouponCategory(userFavorites.couponsAvailable)
+                coupons = self.crawler.getCouponSnapshot().sortCouponsAsList(userFavorites.couponsAvailable, sortMode)
+                couponIDs = [coupon.id for coupon in coupons]
+                couponsByID = {coupon.id: coupon for coupon in coupons}
             else:
-                coupons = self.getFilteredCouponsAsList(view.getFilter(), sortIfSortCodeIsGivenInCouponFilter=False)
-                couponCategory = CouponCategory(coupons, title=view.title)
+                # Filtered and sorted list is usually already cached -> Only coupons of the current page need to be looked up
+                couponIDs, couponCategory = self.crawler.getCachedCouponList(view.getFilter(), sortMode, title=view.title)
+                self.checkForNoCoupons(couponIDs)
+                couponsByID = self.crawler.getCouponSnapshot().coupons
                 menuText = couponCategory.getCategoryInfoText()
-            if len(coupons) == 0:
+            if len(couponIDs) == 0:
                 # This should never happen
                 raise BetterBotException(f'{SYMBOLS.DENY}<b>Ausnahmefehler: Es gibt derzeit keine Coupons!</b>',
                                          InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=urlquery.url)]]))
             if action == 'dcss':
-                # Change sort of coupons
                 saveUserToDB = True
-                nextSortMode = user.getNextSortModeForCouponView(couponView=view)
-                # Sort coupons
-                coupons = sortCouponsAsList(coupons, nextSortMode)
-                user.setCustomSortModeForCouponView(couponView=view, sortMode=nextSortMode)
-            else:
-                # Sort coupons
-                coupons = sortCouponsAsList(coupons, user.getSortModeForCouponView(couponView=view))
+                user.setCustomSortModeForCouponView(couponView=view, sortMode=sortMode)
             # Answer query
             query = update.callback_query
             if query is not None:
@@ -559,7 +571,7 @@ class BKBot:
             urlquery_callbackBack = furl(urlquery.args["cb"])
             buttons = []
             maxCouponsPerPage = 25
-            paginationMax = math.ceil(len(coupons) / maxCouponsPerPage)
+            paginationMax = math.ceil(len(couponIDs) / maxCouponsPerPage)
             desiredPage = int(urlquery.args.get("p", 1))
             if desiredPage > paginationMax:
                 # Fallback - can happen if user leaves menu open for a long time, DB changes, user presses "next/previous page" button but max page number has changed in the meanwhile.
@@ -568,6 +580,7 @@ class BKBot:
                 currentPage = desiredPage
             # Grab all items in desired range (= on desired page)
             index = (currentPage * maxCouponsPerPage - maxCouponsPerPage)
+            pageCoupons = [couponsByID[couponID] for couponID in couponIDs[index:index + maxCouponsPerPage]]
             # Whenever the user has at least one favorite coupon on page > 1 we'll replace the dummy button in the middle and add Easter Egg functionality :)
             currentPageContainsAtLeastOneFavoriteCoupon = False
             includeVeggieSymbol = user.settings.highlightVeggieCouponsInCouponButtonTexts
@@ -575,12 +588,12 @@ class BKBot:
             if view.includeVeggieSymbol is not None:
                 # Override user setting with value defined in coupon-view
                 includeVeggieSymbol = view.includeVeggieSymbol
-            while len(buttons) < maxCouponsPerPage and index < len(coupons):
-                coupon = coupons[index]
-                if user.settings.enableTerminalMode:
-                    pluRepresentationMode: CouponTextRepresentationPLUMode = CouponTextRepresentationPLUMode.LONG_PLU
-                else:
-                    pluRepresentationMode: CouponTextRepresentationPLUMode = CouponTextRepresentationPLUMode.SHORT_PLU
+            if user.settings.enableTerminalMode:
+                pluRepresentationMode: CouponTextRepresentationPLUMode = CouponTextRepresentationPLUMode.LONG_PLU
+            else:
+                pluRepresentationMode: CouponTextRepresentationPLUMode = CouponTextRepresentationPLUMode.SHORT_PLU
+            for coupon in pageCoupons:
+                # Pre-rendered label of this coupon revision + per-user favorite overlay
                 buttonText = coupon.generateCouponShortText(highlightIfNew=user.settings.highlightNewCouponsInCouponButtonTexts, includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol, plumode=pluRepresentationMode)
                 if user.isFavoriteCoupon(coupon):
                     currentPageContainsAtLeastOneFavoriteCoupon = True
@@ -588,7 +601,6 @@ class BKBot:
                         # Highlight item in list so user can see favourites easier
                         buttonText = SYMBOLS.STAR + buttonText
                 buttons.append([InlineKeyboardButton(buttonText, callback_data="?a=dc&plu=" + coupon.id + "&cb=" + urllib.parse.quote(urlquery_callbackBack.url))])
-                index += 1
             numberofCouponsOnCurrentPage = len(buttons)
             if paginationMax > 1:
                 # Add pagination navigation buttons if needed
@@ -633,7 +645,7 @@ class BKBot:
             finally:
                 if saveUserToDB:
                     # User document has changed -> Update DB
-                    user.store(db=userDB)
+                    await self.storeUserChanges(update, user)
         except BetterBotException as botError:
             await self.handleBotErrorGently(update, context, botError)
 
@@ -675,7 +687,6 @@ class BKBot:
         query = update.callback_query
         if query is not None:
             await query.answer()
-        userDB = self.userdb
         user = await self.getUser(userID=update.effective_user.id)
         logging.info(f"User {user.id} found easter egg times: {user.easterEggCounter}")
         text = "🥚<b>Glückwunsch! Du hast das Easter Egg gefunden!</b>"
@@ -685,7 +696,7 @@ class BKBot:
             await self.sendMessage(chat_id=update.effective_chat.id, text=text, parse_mode="html", disable_web_page_preview=True)
         finally:
             user.easterEggCounter += 1
-            user.store(db=userDB)
+            self.userCache.store(user)
         return CallbackVars.MENU_DISPLAY_COUPON
 
     async def botDisplayCouponsWithImagesFavorites(self, update: Update, context: CallbackContext):
@@ -700,22 +711,24 @@ class BKBot:
             await self.handleBotErrorGently(update, context, botError)
             return CallbackVars.MENU_DISPLAY_COUPON
         await self.displayCouponsWithImagesAndBackButton(update, context, userFavorites.couponsAvailable, topMsgText='<b>Alle Favoriten mit Bildern:</b>',
-                                                         bottomMsgText=favoritesInfoText)
+                                                         bottomMsgText=favoritesInfoText, user=user)
         if query is not None:
             # Delete last message containing bot menu
             await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=query.message.message_id)
         return CallbackVars.MENU_DISPLAY_COUPON
 
-    async def displayCouponsWithImagesAndBackButton(self, update: Update, context: CallbackContext, coupons: list, topMsgText: str, bottomMsgText: str = "Zurück zum Hauptmenü?"):
-        await self.displayCouponsWithImages(update, context, coupons, topMsgText)
+    async def displayCouponsWithImagesAndBackButton(self, update: Update, context: CallbackContext, coupons: list, topMsgText: str, bottomMsgText: str = "Zurück zum Hauptmenü?",
+                                                    user: Union[User, None] = None):
+        await self.displayCouponsWithImages(update, context, coupons, topMsgText, user=user)
         # Post back button
         await update.effective_message.reply_text(text=bottomMsgText, parse_mode="HTML",
                                                   reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.MENU_MAIN)], []]))
 
-    async def displayCouponsWithImages(self, update: Update, context: CallbackContext, coupons: list, msgText: str):
+    async def displayCouponsWithImages(self, update: Update, context: CallbackContext, coupons: list, msgText: str, user: Union[User, None] = None):
         await self.sendMessage(chat_id=update.effective_message.chat_id, text=msgText, parse_mode='HTML')
         index = 0
-        user = await self.getUser(update.effective_user.id)
+        if user is None:
+            user = await self.getUser(update.effective_user.id)
         showCouponIndexText = False
         for coupon in coupons:
             if showCouponIndexText:
@@ -846,15 +859,13 @@ class BKBot:
         msg = f'<b>BetterKing Newsletter</b>'
         msg += '\n\n' + update.message.text_html
         msg += f'\n\n{TEXT_NOTIFICATION_DISABLE}'
-        usersToNotify = []
-        for userID in self.userdb:
-            user = User.load(db=self.userdb, id=userID)
-            if user.settings.notifyOnBotNewsletter and msg not in user.pendingNotifications:
-                joinedlist = user.pendingNotifications + [msg]
-                user.pendingNotifications = joinedlist
-                usersToNotify.append(user)
-        self.userdb.update(usersToNotify)
-        await self.editOrSendMessage(update, text=f"{SYMBOLS.CONFIRM}Alle {len(usersToNotify)} User mit aktivierten Benachrichtigungen werden demnächst benachrichtigt.", parse_mode='HTML')
+        userIDsToNotify = []
+        for user in iterateDocuments(self.userdb, User):
+            if user.settings.notifyOnBotNewsletter:
+                userIDsToNotify.append(user.id)
+        # Text is stored only once, each user only gets a small outbox entry referencing it
+        numberofUsersToNotify = self.notificationOutbox.enqueue(userIDsToNotify, msg)
+        await self.editOrSendMessage(update, text=f"{SYMBOLS.CONFIRM}Alle {numberofUsersToNotify} User mit aktivierten Benachrichtigungen werden demnächst benachrichtigt.", parse_mode='HTML')
         return ConversationHandler.END
 
     async def displaySettings(self, update: Update, context: CallbackContext, user: User):
@@ -928,7 +939,7 @@ class BKBot:
         callbackArgs = furl(query.data).args
         uniqueCouponID = callbackArgs['plu']
         callbackBack = callbackArgs['cb']
-        coupon = Coupon.load(self.coupondb, uniqueCouponID)
+        coupon = self.crawler.getCouponSnapshot().getCoupon(uniqueCouponID)
         user = await self.getUser(update.effective_user.id)
         # Send coupon image in chat
         await self.displayCouponWithImage(update, context, coupon, user)
@@ -968,6 +979,8 @@ class BKBot:
         if userInput is not None and userInput == userIDStr:
             # Delete user from DB
             del self.userdb[userIDStr]
+            self.userCache.invalidate(userIDStr)
+            self.favoritesIndex.removeUser(userIDStr)
             menuText = SYMBOLS.CONFIRM + 'Dein BetterKing Account wurde vernichtet!'
             menuText += '\nDu kannst diesen Chat nun löschen.'
             menuText += '\n<b>Viel Erfolg beim Abnehmen!</b>'
@@ -1027,7 +1040,7 @@ class BKBot:
             isFavorite = False
         else:
             # Add coupon to favorites if it still exists in our DB
-            coupon = Coupon.load(self.coupondb, uniqueCouponID)
+            coupon = self.crawler.getCouponSnapshot().getCoupon(uniqueCouponID)
             if coupon is None:
                 # Edge case: Coupon may have been deleted from DB while user had this keyboard open.
                 await self.editOrSendMessage(update, text=SYMBOLS.WARNING + 'Du kannst diesen Coupon nicht als Favoriten setzen, da er nicht mehr existiert.',
@@ -1042,7 +1055,7 @@ class BKBot:
             await query.edit_message_reply_markup(reply_markup=replyMarkupWithoutBackButton)
         finally:
             # Update DB
-            user.store(self.userdb)
+            await self.storeUserChanges(update, user)
         return CallbackVars.COUPON_LOOSE_WITH_FAVORITE_SETTING
 
     def getCouponFavoriteKeyboard(self, isFavorite: bool, uniqueCouponID: str, callbackBack: str) -> list:
@@ -1148,7 +1161,7 @@ class BKBot:
         try:
             await self.displaySettings(update, context, user)
         finally:
-            user.store(self.userdb)
+            await self.storeUserChanges(update, user)
         return CallbackVars.MENU_SETTINGS
 
     async def botResetSortSettings(self, update: Update, context: CallbackContext):
@@ -1160,7 +1173,7 @@ class BKBot:
             await self.displaySettings(update, context, user)
         finally:
             # Update DB
-            user.store(self.userdb)
+            await self.storeUserChanges(update, user)
         return CallbackVars.MENU_SETTINGS
 
     async def botResetSettings(self, update: Update, context: CallbackContext):
@@ -1172,7 +1185,7 @@ class BKBot:
             await self.displaySettings(update, context, user)
         finally:
             # Update DB
-            user.store(self.userdb)
+            await self.storeUserChanges(update, user)
         return CallbackVars.MENU_SETTINGS
 
     async def botDeleteUnavailableFavoriteCoupons(self, update: Update, context: CallbackContext):
@@ -1199,7 +1212,6 @@ class BKBot:
                 paybackCardNumber = userInput[3:13]
             else:
                 paybackCardNumber = userInput
-            userDB = self.userdb
             user = await self.getUser(userID=update.effective_user.id)
             user.addPaybackCard(paybackCardNumber=paybackCardNumber)
             text = SYMBOLS.CONFIRM + 'Deine Payback Karte wurde eingetragen.'
@@ -1207,7 +1219,7 @@ class BKBot:
                 await self.sendMessage(chat_id=chat_id, text=text)
                 await self.displayPaybackCard(update=update, context=context, user=user)
             finally:
-                user.store(userDB)
+                await self.storeUserChanges(update, user)
             return CallbackVars.MENU_DISPLAY_PAYBACK_CARD
         else:
             # Invalid user input
@@ -1218,7 +1230,6 @@ class BKBot:
     async def botDeletePaybackCard(self, update: Update, context: CallbackContext):
         """ Deletes Payback card from users account if his answer is matching his Payback card number. """
         # Validate input
-        userDB = self.userdb
         user = await self.getUser(userID=update.effective_user.id)
         paybackCardNumber = user.getPaybackCardNumber()
         if paybackCardNumber is None:
@@ -1239,7 +1250,7 @@ class BKBot:
                                              parse_mode='HTML',
                                              reply_markup=InlineKeyboardMarkup([[], [InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.GENERIC_BACK)]]))
             finally:
-                user.store(userDB)
+                await self.storeUserChanges(update, user)
         else:
             await self.editOrSendMessage(update, text=SYMBOLS.DENY + 'Ungültige Eingabe!', parse_mode='HTML',
                                          reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton(SYMBOLS.BACK, callback_data=CallbackVars.GENERIC_BACK)]]))
@@ -1318,10 +1329,13 @@ class BKBot:
         """ Deletes expired favorite coupons of all users who enabled auto deletion of those.
          This function is intended to be used as part of a [daily] batch process.
          """
-        users = []
-        for userIDStr in self.userdb:
-            user = User.load(self.userdb, userIDStr)
-            users.append(user)
+        if self.favoritesIndex.isBuilt:
+            # Only load users who have at least one favorite which is not available anymore
+            availableCouponIDs = set(self.getFilteredCouponsAsDict(couponFilter=CouponFilter(activeOnly=True)).keys())
+            userIDs = self.favoritesIndex.getUserIDsByCouponIDs(self.favoritesIndex.getFavoriteCouponIDs() - availableCouponIDs)
+            users = list(iterateDocumentsByIDs(self.userdb, User, sorted(userIDs)))
+        else:
+            users = list(iterateDocuments(self.userdb, User))
         await self.deleteUsersUnavailableFavorites(users)
 
     async def deleteUsersUnavailableFavorites(self, users: list, force: bool = False):
@@ -1347,13 +1361,31 @@ class BKBot:
         if len(dbUpdates) == 0:
             # Nothing to do
             return
-        self.userdb.update(dbUpdates)
+        # Write via buffer so cached instances of these users get updated
+        self.userWriteBuffer.writeDocuments(dbUpdates)
 
-    def getNewCouponsTextWithChannelHyperlinks(self, couponsDict: dict, maxNewCouponsToLink: int) -> str:
+    def getChannelMessageIDsForHyperlinks(self, couponIDs) -> dict:
+        """ Returns mapping couponID -> messageID of the channel post which can be used to link to the given coupons using one DB request.
+         Coupons which can't be linked are mapped to None. """
+        channelDB = self.crawler.couchdb[DATABASES.TELEGRAM_CHANNEL]
+        messageIDs = {}
+        for couponID in couponIDs:
+            messageIDs[couponID] = None
+        for channelCoupon in iterateDocumentsByIDs(channelDB, ChannelCoupon, list(messageIDs.keys())):
+            messageIDs[channelCoupon.id] = channelCoupon.getMessageIDForChatHyperlink()
+        for couponID, messageID in messageIDs.items():
+            if messageID is None:
+                # This should never happen but we'll allow it to anyways
+                logging.warning("Can't hyperlink coupon because it is not in channelDB or no messageIDs are available: " + couponID)
+        return messageIDs
+
+    def getNewCouponsTextWithChannelHyperlinks(self, couponsDict: dict, maxNewCouponsToLink: int, channelMessageIDs: Union[dict, None] = None) -> str:
+        """ channelMessageIDs: Result of getChannelMessageIDsForHyperlinks which should be passed when calling this multiple times for the same coupons. """
         infoText = ''
         """ Add detailed information about added coupons. Limit the max. number of that so our information message doesn't get too big. """
+        if channelMessageIDs is None:
+            channelMessageIDs = self.getChannelMessageIDsForHyperlinks(list(couponsDict.keys())[:maxNewCouponsToLink])
         index = 0
-        channelDB = self.crawler.couchdb[DATABASES.TELEGRAM_CHANNEL]
         for uniqueCouponID in couponsDict:
             coupon = couponsDict[uniqueCouponID]
 
@@ -1361,20 +1393,12 @@ class BKBot:
             Returns the same with hyperlink if a chat_id is given for this coupon e.g.:
             "Y15 | 2Whopper+M🍟+0,4LCola (https://t.me/betterkingpublic/1054) | 8,99€"
             """
-            if coupon.id in channelDB:
-                channelCoupon = ChannelCoupon.load(channelDB, coupon.id)
-                messageID = channelCoupon.getMessageIDForChatHyperlink()
-                if messageID is not None:
-                    couponText = coupon.generateCouponShortTextFormattedWithHyperlinkToChannelPost(highlightIfNew=False,
-                                                                                                   publicChannelName=self.getPublicChannelName(),
-                                                                                                   messageID=messageID)
-                else:
-                    # This should never happen but we'll allow it to
-                    logging.warning("Can't hyperlink coupon because no messageIDs available: " + coupon.id)
-                    couponText = coupon.generateCouponShortTextFormatted(highlightIfNew=False)
+            messageID = channelMessageIDs.get(coupon.id)
+            if messageID is not None:
+                couponText = coupon.generateCouponShortTextFormattedWithHyperlinkToChannelPost(highlightIfNew=False,
+                                                                                               publicChannelName=self.getPublicChannelName(),
+                                                                                               messageID=messageID)
             else:
-                # This should never happen but we'll allow it to anyways
-                logging.warning("Can't hyperlink coupon because it is not in channelDB: " + coupon.id)
                 couponText = coupon.generateCouponShortTextFormatted(highlightIfNew=False)
             infoText += '\n' + couponText
 
@@ -1396,8 +1420,10 @@ class BKBot:
         """ Deletes all inactive accounts from DB and informs user about that account deletion. """
         logging.info('Collecting users to delete')
         usersToDelete = []
-        for userID in self.userdb:
-            user = User.load(self.userdb, userID)
+        # Only look at users whose last activity is old enough and users who have blocked the bot for a longer time
+        timestampCutoff = getCurrentDate().timestamp() - MAX_SECONDS_WITHOUT_USAGE_UNTIL_AUTO_ACCOUNT_DELETION
+        for user in iterateViewDocuments(self.userdb, User, getViewName(USER_VIEW_AUTO_DELETION_CANDIDATES), reduce=False, endkey=timestampCutoff, inclusive_end=False):
+            userID = user.id
             if user.isEligableForAutoDeletion():
                 usersToDelete.append(user)
                 try:
@@ -1410,6 +1436,9 @@ class BKBot:
         if len(usersToDelete) > 0:
             logging.info(f'Deleting {len(usersToDelete)} inactive users from DB')
             self.userdb.purge(docs=usersToDelete)
+            for user in usersToDelete:
+                self.favoritesIndex.removeUser(user.id)
+                self.userCache.invalidate(user.id)
         # End of function
 
     async def batchProcess(self):
@@ -1436,6 +1465,8 @@ class BKBot:
                     break
                 else:
                     continue
+        # Make sure that all recorded activity is in DB before we decide which accounts are inactive
+        self.flushActivityJournal()
         self.deleteInactiveAccounts()
         await self.batchProcessAutoDeleteUsersUnavailableFavorites()
         await self.collectUserNotificationsAndNotifyAdminsAboutProblems()
@@ -1482,6 +1513,8 @@ class BKBot:
         """ Notify users about expired favorite coupons that are back or new coupons depending on their settings. """
         try:
             await collectNewCouponsNotifications(self)
+            # Account deletion warnings depend on users' activity
+            self.flushActivityJournal()
             await collectUserDeleteNotifications(self)
             await notifyAdminsAboutProblems(self)
             return True
@@ -1504,7 +1537,28 @@ class BKBot:
             return False
 
     def startBot(self):
-        self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
+        try:
+            self.application.run_polling(timeout=300, read_timeout=300, write_timeout=300, connect_timeout=300)
+        finally:
+            # Do not lose buffered user document changes on shutdown
+            failedUsers = self.userWriteBuffer.flush()
+            if len(failedUsers) > 0:
+                logging.warning(f'Failed to write {len(failedUsers)} buffered users on shutdown: {[user.id for user in failedUsers]}')
+            self.activityJournal.close()
+            self.crawler.qrRenderer.shutdown()
+
+    async def storeUserChanges(self, update: Update, user: User):
+        """ Stores changes made by the user e.g. settings or favorites and tells the user if they had to be dropped due to a conflicting change. """
+        if not self.userCache.store(user):
+            await self.sendMessage(chat_id=update.effective_chat.id, text=SYMBOLS.WARNING + 'Deine Änderung konnte nicht gespeichert werden. Bitte versuche es erneut.')
+
+    def onUserWritten(self, user: User):
+        self.userCache.putIfCached(user)
+        self.favoritesIndex.updateUser(user)
+
+    def flushActivityJournal(self):
+        # Cached instances of updated users get replaced by the write buffer
+        self.activityJournal.flush()
 
     def stopBot(self):
         self.application.stop()
@@ -1649,15 +1703,17 @@ class BKBot:
     async def sendMessageWithUserBlockedHandling(self, user: User, userDB: Database, text: Union[str, None] = None, parse_mode: Union[None, str] = None,
                                                  disable_notification: ODVInput[bool] = DEFAULT_NONE, disable_web_page_preview: Union[bool, None] = None,
                                                  reply_markup: ReplyMarkup = None,
-                                                 allowUpdateDB: bool = True) -> Union[Message, None]:
+                                                 allowUpdateDB: bool = True, isBulkMessage: bool = False) -> Union[Message, None]:
         botblockedHandling = False
         try:
             msg = await self.processMessage(chat_id=user.id, text=text, parse_mode=parse_mode, disable_notification=disable_notification,
                                             disable_web_page_preview=disable_web_page_preview,
-                                            reply_markup=reply_markup)
-            if user.updateNotificationReceivedActivityTimestamp() or user.botBlockedCounter > 0:
+                                            reply_markup=reply_markup, isBulkMessage=isBulkMessage)
+            if user.updateNotificationReceivedActivityTimestamp():
+                self.activityJournal.record(user.id, ActivityType.NOTIFICATION_RECEIVED, user.timestampLastTimeNotificationSentSuccessfully)
+            elif user.botBlockedCounter > 0:
                 if allowUpdateDB:
-                    user.store(db=userDB)
+                    self.userWriteBuffer.add(user)
             return msg
         except Forbidden:
             logging.info(f"User blocked bot: {user.id}")
@@ -1665,7 +1721,7 @@ class BKBot:
             user.botBlockedCounter += 1
             user.timestampLastTimeBlockedBot = datetime.now().timestamp()
             if allowUpdateDB:
-                user.store(db=userDB)
+                self.userWriteBuffer.add(user)
         except BadRequest as badrequesterror:
             if badrequesterror.message == 'Chat not found':
                 logging.info(f"User does not exist anymore or user blocked bot: {user.id}")
@@ -1676,7 +1732,7 @@ class BKBot:
             user.botBlockedCounter += 1
             user.timestampLastTimeBlockedBot = datetime.now().timestamp()
             if allowUpdateDB:
-                user.store(db=userDB)
+                self.userWriteBuffer.add(user)
         return None
 
     async def sendPhoto(self, chat_id: Union[int, str], photo, caption: Union[None, str] = None,
@@ -1693,12 +1749,15 @@ class BKBot:
                              disable_notification: ODVInput[bool] = DEFAULT_NONE, disable_web_page_preview: Union[bool, None] = None,
                              reply_markup: 'ReplyMarkup' = None,
                              media: Union[None, List] = None,
-                             photo=None, caption: Union[None, str] = None
+                             photo=None, caption: Union[None, str] = None,
+                             isBulkMessage: bool = False
                              ) -> Union[Message, List[Message]]:
-        """ This will take care of "flood control exceeded" API errors (RetryAfter Errors). """
+        """ This will take care of "flood control exceeded" API errors (RetryAfter Errors).
+         Set <isBulkMessage> for messages nobody is waiting for (e.g. notifications) to also respect the per-chat rate limit. """
         retryNumber = 0
         lastException = None
         while retryNumber <= maxTries:
+            await self.rateLimiter.acquire(chatID=chat_id if isBulkMessage else None, numberofMessages=len(media) if media is not None else 1)
             try:
                 retryNumber += 1
                 if media is not None:
@@ -1718,9 +1777,9 @@ class BKBot:
             except RetryAfter as retryError:
                 # https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this
                 lastException = retryError
-                """ Rate-Limit errorhandling: Wait some time and try again (one retry should do the job) """
+                """ Rate-Limit errorhandling: Pause all senders for some time and try again (one retry should do the job) """
                 logging.info("Rate limit reached, waiting " + str(retryError.retry_after) + " seconds | Try number: " + str(retryNumber))
-                await asyncio.sleep(retryError.retry_after)
+                self.rateLimiter.pause(retryError.retry_after)
                 continue
             except BadRequest as requesterror:
                 if requesterror.message == 'Group send failed':
@@ -1744,63 +1803,109 @@ class BKBot:
             """ Typically this means that this message has already been deleted """
             logging.warning("Failed to delete message with message_id: " + str(messageID))
 
+    def migrateLegacyPendingNotifications(self):
+        """ Moves notifications which are still stored in user documents (before the notification outbox existed) into the outbox. """
+        usersWithPendingNotifications = list(User.view(self.userdb, getViewName(USER_VIEW_PENDING_NOTIFICATIONS), include_docs=True))
+        if len(usersWithPendingNotifications) == 0:
+            return
+        notifications = []
+        for user in usersWithPendingNotifications:
+            for notificationText in user.pendingNotifications:
+                notifications.append((user.id, notificationText))
+            user.pendingNotifications = []
+        self.notificationOutbox.enqueueMany(notifications)
+        self.userWriteBuffer.writeDocuments(usersWithPendingNotifications)
+        logging.info(f'Moved {len(notifications)} pending notifications of {len(usersWithPendingNotifications)} users to notification outbox')
+
     async def sendPendingNotifications(self) -> None:
         userDB = self.userdb
-        usersWithPendingNotifications = []
-        for userIDStr in userDB:
-            user = User.load(userDB, userIDStr)
-            if len(user.pendingNotifications) > 0:
-                usersWithPendingNotifications.append(user)
-        if len(usersWithPendingNotifications) == 0:
+        self.migrateLegacyPendingNotifications()
+        pendingEntriesByUser = self.notificationOutbox.getPendingEntriesByUser()
+        if len(pendingEntriesByUser) == 0:
             logging.debug('User notify: Nothing to do')
             return
         timeStart = datetime.now()
-        index = 0
-        dbDocumentUpdates = []
-        for user in usersWithPendingNotifications:
-            isLastItem = index == len(usersWithPendingNotifications) - 1
-            logging.info(f"Notifying user {index + 1}/{len(usersWithPendingNotifications)} | {user.id} | Pending notifications: {len(user.pendingNotifications)}")
+        messageIDs = set()
+        for entries in pendingEntriesByUser.values():
+            for entry in entries:
+                messageIDs.add(entry.messageID)
+        messageTexts = self.notificationOutbox.getMessageTexts(messageIDs)
+        entriesToAck = []
+        entriesToNack = []
+
+        def flushUpdates():
+            self.userWriteBuffer.flush()
+            self.notificationOutbox.ack(entriesToAck)
+            self.notificationOutbox.nack(entriesToNack)
+            entriesToAck.clear()
+            entriesToNack.clear()
+
+        dispatcher = NotificationDispatcher(numberofWorkers=self.cfg.notification_workers)
+
+        async def notifyUser(userID: str):
+            entries = pendingEntriesByUser[userID]
+            logging.debug(f"Notifying user {userID} | Pending notifications: {len(entries)}")
+            # Prefer instances with the latest changes but don't add users to the cache only because they get notified
+            user = self.userWriteBuffer.get(userID) or self.userCache.get(userID) or User.load(userDB, userID)
+            if user is None:
+                # User has deleted the account in the meantime
+                entriesToAck.extend(entries)
+                return
             # Send all pending notifications to user
-            try:
-                for notificationText in user.pendingNotifications:
+            for entryIndex, entry in enumerate(entries):
+                notificationText = messageTexts.get(entry.messageID)
+                if notificationText is None:
+                    logging.warning(f"Text of notification {entry.id} is missing -> Dropping it")
+                    entriesToAck.append(entry)
+                    continue
+                try:
                     await self.sendMessageWithUserBlockedHandling(user=user, userDB=userDB, text=notificationText, parse_mode='HTML', disable_web_page_preview=True,
-                                                                  allowUpdateDB=False)
-            except Exception as e:
-                logging.exception(e)
-                logging.info(f"Failed to find notification to user {user.id} -> Clearing it anyways")
-                pass
-            # Assume that we've sent all pending messages -> Clear array
-            user.pendingNotifications = []
-            dbDocumentUpdates.append(user)
-            if len(dbDocumentUpdates) == 10 or isLastItem:
+                                                                  isBulkMessage=True)
+                    entriesToAck.append(entry)
+                    dispatcher.addSentMessages()
+                except Exception as e:
+                    logging.exception(e)
+                    logging.info(f"Failed to send notification to user {user.id} -> Will retry later")
+                    # Keep order of notifications: Retry this and all following ones of this user next time
+                    entriesToNack.extend(entries[entryIndex:])
+                    break
+            if len(entriesToAck) + len(entriesToNack) >= DB_BULK_PAGE_SIZE:
                 # Update DB
-                userDB.update(dbDocumentUpdates)
-                dbDocumentUpdates.clear()
-            index += 1
+                flushUpdates()
+
+        try:
+            await dispatcher.run(list(pendingEntriesByUser.keys()), notifyUser)
+        finally:
+            flushUpdates()
+        self.notificationOutbox.cleanup()
         logging.info(f"Notify users done | Duration: {(datetime.now() - timeStart)}")
 
     async def getUser(self, userID: Union[str, int], addIfNew: bool = True, updateUsageTimestamp: bool = True, unblockUser: bool = True) -> Union[User, None]:
         """ Returns user from given DB. Adds it to DB if wished and it doesn't exist. """
         userIDStr = str(userID)
-        user = User.load(self.userdb, userIDStr)
+        # Prefer buffered instance with not yet written changes
+        user = self.userWriteBuffer.get(userIDStr)
+        if user is None:
+            user = self.userCache.load(userIDStr)
         if user is None and addIfNew:
             """ New user --> Add userID to DB if wished. """
             # Add user to DB for the first time
             logging.info(f'Storing new userID: {userIDStr}')
             user = User(id=userIDStr)
-            user.store(self.userdb)
+            self.userCache.store(user)
         elif user is not None:
             """ Store a rough timestamp of when user used bot last time. """
             updatedb = False
             if updateUsageTimestamp and user.updateActivityTimestamp():
-                updatedb = True
+                # Do not block on a DB write only to record activity
+                self.activityJournal.record(user.id, ActivityType.BOT_USED, user.timestampLastTimeBotUsed)
             if unblockUser and user.timestampLastTimeBlockedBot > 0:
                 user.timesInformedAboutUpcomingAutoAccountDeletion = 0
                 user.timestampLastTimeWarnedAboutUpcomingAutoAccountDeletion = 0
                 user.timestampLastTimeBlockedBot = 0
                 updatedb = True
             if updatedb:
-                user.store(self.userdb)
+                self.userCache.store(user)
 
         return user
 
@@ -1831,6 +1936,32 @@ async def dailyRoutine(bkbot):
         await bkbot.batchProcess()
 
 
+async def userWriteBufferRoutine(bkbot):
+    """ Writes buffered user document changes once they're older than the max. buffer time. """
+    while True:
+        await asyncio.sleep(5)
+        try:
+            bkbot.userWriteBuffer.flushIfDue()
+        except Exception as e:
+            logging.info("Exception happened during flushing user write buffer:")
+            logging.info(e)
+
+
+async def activityJournalRoutine(bkbot):
+    """ Fsyncs journaled user activity every few seconds and writes it to DB every X seconds. """
+    timestampLastFlush = time.monotonic()
+    while True:
+        await asyncio.sleep(1)
+        try:
+            bkbot.activityJournal.syncIfDue()
+            if time.monotonic() - timestampLastFlush >= 60:
+                timestampLastFlush = time.monotonic()
+                bkbot.flushActivityJournal()
+        except Exception as e:
+            logging.info("Exception happened during flushing activity journal:")
+            logging.info(e)
+
+
 async def notificationRoutine(bkbot):
     """ Sends pending notifications to user every X seconds. """
     while True:
@@ -1868,6 +1999,8 @@ def main():
         loop.create_task(bkbot.sendPendingNotifications())
     loop.create_task(dailyRoutine(bkbot))
     loop.create_task(notificationRoutine(bkbot))
+    loop.create_task(userWriteBufferRoutine(bkbot))
+    loop.create_task(activityJournalRoutine(bkbot))
     bkbot.startBot()
 
 
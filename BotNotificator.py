@@ -7,18 +7,19 @@ from couchdb import Database
 from telegram import InputMediaPhoto
 
 from BotUtils import getBotImpressum, Commands, ImageCache
-from Helper import DATABASES, getCurrentDate, SYMBOLS, getFormattedPassedTime, URLs, BotAllowedCouponTypes, formatSeconds, formatDateGermanHuman, TEXT_NOTIFICATION_DISABLE
+from Helper import DATABASES, getCurrentDate, SYMBOLS, getFormattedPassedTime, URLs, BotAllowedCouponTypes, formatSeconds, formatDateGermanHuman, TEXT_NOTIFICATION_DISABLE, \
+    iterateDocuments, iterateDocumentsByIDs, iterateViewDocuments
 
 from UtilsCouponsDB import sortCouponsByPrice, getCouponTitleMapping, CouponSortModes, \
     MAX_SECONDS_WITHOUT_USAGE_UNTIL_SEND_WARNING_TO_USER, MIN_SECONDS_BETWEEN_UPCOMING_AUTO_DELETION_WARNING, MAX_TIMES_INFORM_ABOUT_UPCOMING_AUTO_ACCOUNT_DELETION, \
     MAX_SECONDS_WITHOUT_USAGE_UNTIL_AUTO_ACCOUNT_DELETION
 from filters import CouponFilter
-from models import InfoEntry, ChannelCoupon, User
+from models import InfoEntry, ChannelCoupon, User, USER_VIEW_NEW_COUPONS_SUBSCRIBERS, USER_VIEW_LAST_ACCOUNT_ACTIVITY, getViewName
 
 
 async def collectNewCouponsNotifications(bkbot) -> None:
     """
-    Collects user notifications regarding new coupons and adds them to user document so they can be sent out later.
+    Collects user notifications regarding new coupons and adds them to the notification outbox so they can be sent out later.
     """
     logging.info("Checking for pending new coupons notifications")
     timeStart = datetime.now()
@@ -46,14 +47,50 @@ async def collectNewCouponsNotifications(bkbot) -> None:
      """
     # List of user documents that were changed and need to be pushed to DB
     dbUserUpdateList = set()
+    # List of (userID, text) items which will be added to the notification outbox
+    notifications = []
     separator = '---'
+    # Resolve channel post links of all new coupons only once
+    channelMessageIDs = bkbot.getChannelMessageIDsForHyperlinks(list(newCoupons.keys()))
 
+    def renderNotificationText(favoriteCouponsBack: dict, newCouponsForUser: dict) -> str:
+        text = ''
+        if len(favoriteCouponsBack) > 0:
+            text += "<b>" + SYMBOLS.STAR + str(
+                len(favoriteCouponsBack)) + " deiner Favoriten sind wieder verfügbar:</b>" + bkbot.getNewCouponsTextWithChannelHyperlinks(favoriteCouponsBack, 49, channelMessageIDs)
+        if len(newCouponsForUser) > 0:
+            if len(text) > 0:
+                text += f"\n{separator}\n"
+            text += "<b>" + SYMBOLS.NEW + str(
+                len(newCouponsForUser)) + " neue Coupons verfügbar:</b>" + bkbot.getNewCouponsTextWithChannelHyperlinks(newCouponsForUser, 49, channelMessageIDs)
+        if len(text) > 0:
+            text += f"\n{separator}"
+            # Complete user text and save it to send it later
+            if bkbot.getPublicChannelName() is None:
+                # Different text in case someone sets up this bot without a public channel (kinda makes no sense).
+                text += "\nMit /start gelangst du ins Hauptmenü des Bots."
+            else:
+                text += f"\nPer Klick gelangst du zu den jeweiligen Coupons im {bkbot.getPublicChannelHyperlinkWithCustomizedText('Channel')} und mit /start ins Hauptmenü des Bots."
+            text += "\n" + TEXT_NOTIFICATION_DISABLE
+        return text
+
+    """ Most users get exactly the same text e.g. all users without favorites who want to be notified about all new coupons.
+     Text only depends on the favorites that are back and the new coupons a user gets notified about -> Render each distinct text only once. """
+    notificationTexts = {}
     numberofFavoriteNotifications = 0
     logging.info('Computing new coupons\' notification messages...')
-    for userIDStr in userDB:
-        user = User.load(userDB, userIDStr)
-        notificationtext = ""
+    if bkbot.favoritesIndex.isBuilt:
+        # Only look at users who could be affected: Favorites that are back, favorites for which we could find an alternative and subscribers of all new coupons
+        userIDsToCheck = bkbot.favoritesIndex.getUserIDsByCouponIDs(newCoupons.keys())
+        userIDsToCheck.update(bkbot.favoritesIndex.getUserIDsByNormalizedTitles(couponTitleMapping.keys()))
+        userIDsToCheck.update(row.id for row in userDB.view(getViewName(USER_VIEW_NEW_COUPONS_SUBSCRIBERS)))
+        logging.info(f'Number of users who could be affected by new coupons: {len(userIDsToCheck)}')
+        usersToCheck = iterateDocumentsByIDs(userDB, User, sorted(userIDsToCheck))
+    else:
+        usersToCheck = iterateDocuments(userDB, User)
+    for user in usersToCheck:
         userNewFavoriteCoupons = {}
+        newCouponsListForThisUsersNotification = {}
         # Check if user wants to be notified about favorites that are back
         updateUserDoc = False
         if user.isAllowSendFavoritesNotification():
@@ -80,12 +117,9 @@ async def collectNewCouponsNotifications(bkbot) -> None:
                 # DB update required
                 updateUserDoc = True
             if len(userNewFavoriteCoupons) > 0:
-                notificationtext += "<b>" + SYMBOLS.STAR + str(
-                    len(userNewFavoriteCoupons)) + " deiner Favoriten sind wieder verfügbar:</b>" + bkbot.getNewCouponsTextWithChannelHyperlinks(userNewFavoriteCoupons, 49)
                 numberofFavoriteNotifications += 1
         # Check if user has enabled notifications for new coupons
         if user.settings.notifyWhenNewCouponsAreAvailable:
-            newCouponsListForThisUsersNotification = {}
             if user.isAllowSendFavoritesNotification() and len(userNewFavoriteCoupons) > 0:
                 """ Avoid duplicates: If e.g. user has set favorite coupon to 'DoubleChiliCheese' and it's back in this run, we do not need to include it again in the list of new coupons.
                  If this dict is empty after the loop this means that all of this users' favorites would also be in the "new coupons" list thus no need to include them in the post we send to the user (= duplicates).
@@ -95,41 +129,35 @@ async def collectNewCouponsNotifications(bkbot) -> None:
                         newCouponsListForThisUsersNotification[couponID] = newCoupons[couponID]
             else:
                 newCouponsListForThisUsersNotification = newCoupons
-            if len(newCouponsListForThisUsersNotification) > 0:
-                if len(notificationtext) > 0:
-                    notificationtext += f"\n{separator}\n"
-                notificationtext += "<b>" + SYMBOLS.NEW + str(
-                    len(newCouponsListForThisUsersNotification)) + " neue Coupons verfügbar:</b>" + bkbot.getNewCouponsTextWithChannelHyperlinks(
-                    newCouponsListForThisUsersNotification, 49)
+        notificationTextKey = (tuple(userNewFavoriteCoupons.keys()), tuple(newCouponsListForThisUsersNotification.keys()))
+        notificationtext = notificationTexts.get(notificationTextKey)
+        if notificationtext is None:
+            notificationtext = renderNotificationText(userNewFavoriteCoupons, newCouponsListForThisUsersNotification)
+            notificationTexts[notificationTextKey] = notificationtext
         if len(notificationtext) > 0:
-            notificationtext += f"\n{separator}"
-            # Complete user text and save it to send it later
-            if bkbot.getPublicChannelName() is None:
-                # Different text in case someone sets up this bot without a public channel (kinda makes no sense).
-                notificationtext += "\nMit /start gelangst du ins Hauptmenü des Bots."
-            else:
-                notificationtext += f"\nPer Klick gelangst du zu den jeweiligen Coupons im {bkbot.getPublicChannelHyperlinkWithCustomizedText('Channel')} und mit /start ins Hauptmenü des Bots."
-            notificationtext += "\n" + TEXT_NOTIFICATION_DISABLE
-            if notificationtext not in user.pendingNotifications:
-                # Add notification text if it is not already contained in list of pending notifications
-                joinedlist = user.pendingNotifications + [notificationtext]
-                user.pendingNotifications = joinedlist
-                updateUserDoc = True
+            notifications.append((user.id, notificationtext))
         if updateUserDoc:
             dbUserUpdateList.add(user)
-    if len(dbUserUpdateList) == 0:
+    logging.info(f'Rendered {len(notificationTexts)} distinct notification texts for {len(notifications)} users')
+    if len(dbUserUpdateList) == 0 and len(notifications) == 0:
         logging.info("Did not collect any new notifications to send out")
         return
-    logging.info(f"Pushing DB update of {len(dbUserUpdateList)} user documents")
-    userDB.update(list(dbUserUpdateList))
+    if len(dbUserUpdateList) > 0:
+        logging.info(f"Pushing DB update of {len(dbUserUpdateList)} user documents")
+        for user in dbUserUpdateList:
+            bkbot.userWriteBuffer.add(user)
+        bkbot.userWriteBuffer.flush()
+    # Notifications which are already pending for a user will be skipped by the outbox
+    bkbot.notificationOutbox.enqueueMany(notifications)
     logging.info(f"New coupons notifications collector done | Duration: {(datetime.now() - timeStart)}")
 
 
 async def collectUserDeleteNotifications(bkbot) -> None:
     userDB = bkbot.userdb
     numberOfCollectedNotifications = 0
-    for userID in userDB:
-        user = User.load(db=userDB, id=userID)
+    # Only look at users whose last account activity is old enough to send a warning
+    timestampCutoff = getCurrentDate().timestamp() - MAX_SECONDS_WITHOUT_USAGE_UNTIL_SEND_WARNING_TO_USER
+    for user in iterateViewDocuments(userDB, User, getViewName(USER_VIEW_LAST_ACCOUNT_ACTIVITY), endkey=timestampCutoff):
         if not user.hasEverUsedBot():
             """ 
             Avoid sending such notifications to users whose datasets are not up2date.
@@ -156,12 +184,11 @@ async def collectUserDeleteNotifications(bkbot) -> None:
                 text += f'\nDies ist Warnung {user.timesInformedAboutUpcomingAutoAccountDeletion}/{MAX_TIMES_INFORM_ABOUT_UPCOMING_AUTO_ACCOUNT_DELETION}.'
             text += '\nÖffne das Hauptmenü einmalig mit /start, um dem Bot zu zeigen, dass du noch lebst.'
             text += f'\nWahlweise kannst du deinen Account mit /{Commands.DELETE_ACCOUNT} selbst löschen.'
-            await bkbot.sendMessageWithUserBlockedHandling(user=user, userDB=userDB, text=text, parse_mode='HTML', disable_web_page_preview=True)
-            if text not in user.pendingNotifications:
-                notificationlist = user.pendingNotifications + [text]
-                user.pendingNotifications = notificationlist
-            user.store(db=userDB)
+            await bkbot.sendMessageWithUserBlockedHandling(user=user, userDB=userDB, text=text, parse_mode='HTML', disable_web_page_preview=True, isBulkMessage=True)
+            bkbot.notificationOutbox.enqueue([user.id], text)
+            bkbot.userWriteBuffer.add(user)
             numberOfCollectedNotifications += 1
+    bkbot.userWriteBuffer.flush()
     logging.info('Number of users who will soon be informed about account deletion: ' + str(numberOfCollectedNotifications))
 
 
@@ -251,9 +278,8 @@ async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
         logging.warning(f"Found {len(infoDBDoc.messageIDsToDelete)} leftover messageIDs to delete")
     # Collect deleted coupons from channel
     deletedChannelCoupons = []
-    for uniqueCouponID in channelDB:
-        if uniqueCouponID not in activeCoupons:
-            channelCoupon = ChannelCoupon.load(channelDB, uniqueCouponID)
+    for channelCoupon in iterateDocuments(channelDB, ChannelCoupon):
+        if channelCoupon.id not in activeCoupons:
             infoDBDoc.addMessageIDsToDelete(channelCoupon.getMessageIDs())
             # Collect it here so we can delete it with only one DB request later.
             deletedChannelCoupons.append(channelCoupon)
@@ -340,6 +366,7 @@ async def updatePublicChannel(bkbot, updateMode: ChannelUpdateMode):
     await bkbot.sendCouponOverviewWithChannelLinks(chat_id=bkbot.getPublicChannelChatID(), coupons=activeCoupons, useLongCouponTitles=False, channelDB=channelDB, infoDB=infoDB,
                                                    infoDBDoc=infoDBDoc)
 
+    bkbot.crawler.updateCachesIfOutdated()
     notYetAvailableCouponsText = bkbot.crawler.cachedFutureCouponsText
 
     """ Generate new information message text. """
@@ -438,14 +465,13 @@ async def nukeChannel(bkbot):
         logging.info(f"Deleting {len(channelDB)} coupons...")
         index = 0
         initialItemNumber = len(channelDB)
-        for couponID in channelDB:
+        for channelCoupon in iterateDocuments(channelDB, ChannelCoupon):
             index += 1
             logging.info(f"Working on coupon {index}/{initialItemNumber}")
-            channelCoupon = ChannelCoupon.load(channelDB, couponID)
             messageIDs = channelCoupon.getMessageIDs()
             for messageID in messageIDs:
                 await asyncio.create_task(bkbot.deleteMessage(chat_id=bkbot.getPublicChannelChatID(), messageID=messageID))
-            del channelDB[couponID]
+            del channelDB[channelCoupon.id]
     # Delete coupon overview messages
     updateInfoDoc = False
     hasLoggedDeletionOfCouponOverviewMessageIDs = False
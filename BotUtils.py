@@ -1,6 +1,9 @@
+import asyncio
 import json
-from datetime import datetime
-from typing import Optional, List
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Optional, List, Callable, Awaitable, Any, Union
 
 import pydantic
 from pydantic import root_validator
@@ -83,6 +86,12 @@ class Config(pydantic.BaseModel):
     admin_ids: Optional[List]
     public_channel_name: Optional[str]
     public_channel_post_id_faq: Optional[int]
+    # Number of users which get notified in parallel
+    notification_workers: int = 16
+    # Max. number of messages sent per second over all chats. Telegram allows ~30.
+    max_messages_per_second: float = 25
+    # Number of coupon images which get downloaded in parallel
+    image_download_workers: int = 8
 
     @root_validator
     def check_config_values(cls, values):
@@ -110,4 +119,132 @@ class ImageCache:
     def updateLastUsedDate(self):
         """ Updates last used timestamp to current timestamp. """
         self.dateLastUsed = datetime.now()
-        # self.timesUsed += 1
\ No newline at end of file
+        # self.timesUsed += 1
+
+class TelegramRateLimiter:
+    """ Token bucket shared by everything that sends messages via the bot.
+     Respects the global limit (messages per second over all chats) and - for bulk messages like notifications - the per-chat limit.
+     If Telegram replies with RetryAfter anyways, the whole bucket gets paused instead of every sender sleeping on its own.
+     See https://core.telegram.org/bots/faq#my-bot-is-hitting-limits-how-do-i-avoid-this """
+
+    def __init__(self, messagesPerSecond: float = 25, minSecondsBetweenMessagesPerChat: float = 1):
+        self.messagesPerSecond = messagesPerSecond
+        self.minSecondsBetweenMessagesPerChat = minSecondsBetweenMessagesPerChat
+        # Allow small bursts but never more than one second worth of messages
+        self.capacity = max(1.0, messagesPerSecond)
+        self.tokens = self.capacity
+        self.timestampLastRefill = time.monotonic()
+        self.timestampPausedUntil = 0
+        # Tokens interactive replies are currently waiting for -> Bulk messages have to leave them in the bucket
+        self.numberofTokensWaitingInteractive = 0
+        self.chatTimestampsNextMessageAllowed = {}
+
+    def pause(self, seconds: float):
+        """ Stops all senders for the given number of seconds e.g. after a RetryAfter error.
+         The bucket starts refilling when the pause is over so the senders don't all burst at once afterwards. """
+        self.timestampPausedUntil = max(self.timestampPausedUntil, time.monotonic() + seconds)
+        self.tokens = 0
+        self.timestampLastRefill = self.timestampPausedUntil
+
+    def tryAcquireTokens(self, numberofTokensRequired: float, numberofTokensToKeep: float = 0) -> float:
+        """ Takes tokens if at least <numberofTokensToKeep> remain in the bucket afterwards. Returns 0 on success, otherwise the number of seconds to wait before trying again. """
+        now = time.monotonic()
+        if self.timestampPausedUntil > now:
+            return self.timestampPausedUntil - now
+        self.tokens = min(self.capacity, self.tokens + max(0.0, now - self.timestampLastRefill) * self.messagesPerSecond)
+        self.timestampLastRefill = max(now, self.timestampLastRefill)
+        if self.tokens >= numberofTokensRequired + numberofTokensToKeep:
+            self.tokens -= numberofTokensRequired
+            return 0
+        return (numberofTokensRequired + numberofTokensToKeep - self.tokens) / self.messagesPerSecond
+
+    async def acquire(self, chatID: Union[int, str, None] = None, numberofMessages: int = 1):
+        """ Waits until given number of messages may be sent. Only pass <chatID> for bulk messages: Interactive replies shall not be delayed by the per-chat limit.
+         Bulk messages always leave one token plus the tokens interactive replies are waiting for in the bucket so interactive replies never queue up behind them. """
+        # Allow bigger requests (media groups) to go through once the bucket is full
+        numberofTokensRequired = min(numberofMessages, self.capacity)
+        if chatID is not None:
+            await self.acquireChat(chatID, numberofMessages)
+            # Checking and taking tokens happens without any await in between so no lock is needed and nobody sleeps while blocking others
+            while True:
+                numberofTokensToKeep = min(1 + self.numberofTokensWaitingInteractive, self.capacity - numberofTokensRequired)
+                waitSeconds = self.tryAcquireTokens(numberofTokensRequired, numberofTokensToKeep=numberofTokensToKeep)
+                if waitSeconds <= 0:
+                    return
+                await asyncio.sleep(waitSeconds)
+        waitSeconds = self.tryAcquireTokens(numberofTokensRequired)
+        if waitSeconds <= 0:
+            return
+        self.numberofTokensWaitingInteractive += numberofTokensRequired
+        try:
+            while waitSeconds > 0:
+                await asyncio.sleep(waitSeconds)
+                waitSeconds = self.tryAcquireTokens(numberofTokensRequired)
+        finally:
+            self.numberofTokensWaitingInteractive -= numberofTokensRequired
+
+    async def acquireChat(self, chatID: Union[int, str], numberofMessages: int = 1):
+        chatID = str(chatID)
+        now = time.monotonic()
+        if len(self.chatTimestampsNextMessageAllowed) > 10000:
+            # Forget about chats we haven't sent anything to recently
+            self.chatTimestampsNextMessageAllowed = {thisChatID: timestamp for thisChatID, timestamp in self.chatTimestampsNextMessageAllowed.items() if timestamp > now}
+        timestampNextMessageAllowed = max(now, self.chatTimestampsNextMessageAllowed.get(chatID, 0))
+        # Reserve slot before waiting so concurrent senders to the same chat queue up behind each other
+        self.chatTimestampsNextMessageAllowed[chatID] = timestampNextMessageAllowed + numberofMessages * self.minSecondsBetweenMessagesPerChat
+        if timestampNextMessageAllowed > now:
+            await asyncio.sleep(timestampNextMessageAllowed - now)
+
+
+class NotificationDispatcher:
+    """ Processes jobs (e.g. all pending notifications of one user) with a pool of worker coroutines and logs progress.
+     The rate limit is not handled here but by the TelegramRateLimiter used when sending messages. """
+
+    def __init__(self, numberofWorkers: int = 8, logIntervalSeconds: float = 30):
+        self.numberofWorkers = max(1, numberofWorkers)
+        self.logIntervalSeconds = logIntervalSeconds
+        self.numberofJobsTotal = 0
+        self.numberofJobsDone = 0
+        self.numberofJobsFailed = 0
+        self.numberofMessagesSent = 0
+        self.timestampStart = 0
+        self.timestampLastLog = 0
+
+    def addSentMessages(self, numberofMessages: int = 1):
+        self.numberofMessagesSent += numberofMessages
+
+    async def run(self, jobs: List[Any], handler: Callable[[Any], Awaitable[None]]):
+        """ Calls handler for every job using up to <numberofWorkers> jobs in parallel. Returns when all jobs are done. """
+        self.numberofJobsTotal = len(jobs)
+        self.numberofJobsDone = 0
+        self.numberofJobsFailed = 0
+        self.numberofMessagesSent = 0
+        self.timestampStart = time.monotonic()
+        self.timestampLastLog = self.timestampStart
+        queue = asyncio.Queue()
+        for job in jobs:
+            queue.put_nowait(job)
+
+        async def worker():
+            while not queue.empty():
+                job = queue.get_nowait()
+                try:
+                    await handler(job)
+                except Exception as e:
+                    logging.exception(e)
+                    self.numberofJobsFailed += 1
+                self.numberofJobsDone += 1
+                if time.monotonic() - self.timestampLastLog >= self.logIntervalSeconds:
+                    self.timestampLastLog = time.monotonic()
+                    logging.info(self.getProgressText())
+
+        await asyncio.gather(*[worker() for i in range(min(self.numberofWorkers, len(jobs)))])
+        logging.info(self.getProgressText())
+
+    def getProgressText(self) -> str:
+        secondsPassed = max(time.monotonic() - self.timestampStart, 0.001)
+        jobsPerSecond = self.numberofJobsDone / secondsPassed
+        text = f'Dispatcher: {self.numberofJobsDone}/{self.numberofJobsTotal} done | Failed: {self.numberofJobsFailed} | Messages: {self.numberofMessagesSent} ({self.numberofMessagesSent / secondsPassed:.1f}/s)'
+        if 0 < self.numberofJobsDone < self.numberofJobsTotal:
+            text += f' | ETA: {timedelta(seconds=round((self.numberofJobsTotal - self.numberofJobsDone) / jobsPerSecond))}'
+        return text
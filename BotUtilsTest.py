@@ -0,0 +1,50 @@
+import asyncio
+import time
+import unittest
+
+from BotUtils import TelegramRateLimiter
+
+""" Checks the timing of TelegramRateLimiter. Run with 'python -m unittest BotUtilsTest'. """
+
+
+class TelegramRateLimiterTest(unittest.TestCase):
+
+    def test_no_burst_after_pause(self):
+        async def run() -> list:
+            rateLimiter = TelegramRateLimiter(messagesPerSecond=20, minSecondsBetweenMessagesPerChat=0)
+            rateLimiter.pause(0.2)
+            timestampStart = time.monotonic()
+            timestamps = []
+
+            async def send(chatID: int):
+                await rateLimiter.acquire(chatID=chatID)
+                timestamps.append(time.monotonic() - timestampStart)
+
+            await asyncio.gather(*[send(chatID) for chatID in range(6)])
+            return sorted(timestamps)
+
+        timestamps = asyncio.run(run())
+        self.assertGreaterEqual(timestamps[0], 0.2)
+        # Bucket is empty after the pause -> Messages are spread out at the configured rate instead of all being sent at once
+        self.assertGreaterEqual(timestamps[-1] - timestamps[0], 4 / 20)
+
+    def test_interactive_reply_does_not_wait_for_bulk_messages(self):
+        async def run() -> float:
+            rateLimiter = TelegramRateLimiter(messagesPerSecond=10, minSecondsBetweenMessagesPerChat=0)
+            bulkSenders = [asyncio.create_task(rateLimiter.acquire(chatID=chatID)) for chatID in range(30)]
+            # Let bulk senders drain the bucket
+            await asyncio.sleep(0.05)
+            timestampStart = time.monotonic()
+            await rateLimiter.acquire()
+            duration = time.monotonic() - timestampStart
+            for task in bulkSenders:
+                task.cancel()
+            await asyncio.gather(*bulkSenders, return_exceptions=True)
+            return duration
+
+        # 30 queued bulk messages would take about 2s at 10 messages per second
+        self.assertLess(asyncio.run(run()), 0.3)
+
+
+if __name__ == '__main__':
+    unittest.main()
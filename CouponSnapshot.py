@@ -0,0 +1,286 @@
+import math
+from bisect import bisect_right
+from datetime import datetime
+from types import MappingProxyType
+from typing import Union, List
+
+from Helper import getCurrentDate
+from UtilsCouponsDB import Coupon, COUPON_IS_NEW_FOR_SECONDS, CouponSortMode, CouponSortModes, getSortModeBySortCode, sortCouponsAsList, \
+    getDuplicateCouponGroups, getPreferredDuplicateCoupon, removeDuplicatedCoupons
+from filters import CouponFilter
+
+""" Mapping of CouponFilter fields to the Coupon flags they are checked against. """
+STATIC_FILTER_FLAGS = {
+    'containsFriesAndCoke': lambda coupon: coupon.isContainsFriesAndDrink(),
+    'isHidden': lambda coupon: coupon.isHidden,
+    'isVeggie': lambda coupon: coupon.isVeggie(),
+    'isPlantBased': lambda coupon: coupon.isPlantBased(),
+    'isEatable': lambda coupon: coupon.isEatable(),
+}
+
+
+class CouponFilterIndex:
+    """ Bitset index over all coupons of a snapshot: Bit <i> represents the i-th coupon in snapshot order.
+     All flags which do not depend on the current time are evaluated only once when the index is built.
+     Time dependent flags (valid, not yet active, new) are evaluated on plain timestamps which are also precomputed here and only get re-evaluated
+     once the current time passes the next instant at which any of them changes. """
+
+    def __init__(self, coupons: List[Coupon]):
+        self.allBits = (1 << len(coupons)) - 1
+        # Per flag: Bitset of coupons with value True and bitset of coupons with value False. None values are in neither.
+        self.flagBits = {}
+        for filterField, getFlag in STATIC_FILTER_FLAGS.items():
+            trueBits = 0
+            falseBits = 0
+            for index, coupon in enumerate(coupons):
+                value = getFlag(coupon)
+                if value == True:
+                    trueBits |= 1 << index
+                elif value == False:
+                    falseBits |= 1 << index
+            self.flagBits[filterField] = {True: trueBits, False: falseBits}
+        self.typeBits = {}
+        for index, coupon in enumerate(coupons):
+            self.typeBits[coupon.type] = self.typeBits.get(coupon.type, 0) | (1 << index)
+        # Timestamps needed to evaluate the time dependent flags
+        self.timestampsExpire = []
+        self.timestampsStart = []
+        self.timestampsIsNewUntil = []
+        # Instants at which at least one time dependent flag of at least one coupon changes
+        timeBoundaries = set()
+        for coupon in coupons:
+            timestampExpire = coupon.timestampExpire if coupon.timestampExpire is not None else float('-inf')
+            self.timestampsExpire.append(timestampExpire)
+            timestampStart = coupon.timestampStart if coupon.timestampStart is not None else 0
+            self.timestampsStart.append(timestampStart)
+            isNewUntil = max((coupon.timestampAddedToDB or 0) + COUPON_IS_NEW_FOR_SECONDS, (coupon.timestampIsNew or 0) + COUPON_IS_NEW_FOR_SECONDS)
+            isNewUntilDatetime = coupon.getIsNewUntilDatetime()
+            if isNewUntilDatetime is not None:
+                isNewUntil = max(isNewUntil, isNewUntilDatetime.timestamp())
+            self.timestampsIsNewUntil.append(isNewUntil)
+            # Coupons expire and become new via start date strictly after the given timestamp -> Boundary is the next float
+            timeBoundaries.add(math.nextafter(timestampExpire, math.inf))
+            timeBoundaries.add(isNewUntil)
+            if timestampStart > 0:
+                timeBoundaries.add(timestampStart)
+                timeBoundaries.add(math.nextafter(timestampStart, math.inf))
+                timeBoundaries.add(timestampStart + COUPON_IS_NEW_FOR_SECONDS)
+        self.timeBoundaries = sorted(timeBoundary for timeBoundary in timeBoundaries if math.isfinite(timeBoundary))
+        # Time dependent bitsets are valid for all timestamps in [cachedTimeDependentBitsValidFrom, cachedTimeDependentBitsValidUntil)
+        self.cachedTimeDependentBits = None
+        self.cachedTimeDependentBitsValidFrom = 0
+        self.cachedTimeDependentBitsValidUntil = 0
+        # Cached static part of the resulting bitset for each distinct filter
+        self.staticFilterBitsCache = {}
+
+    def getNextTimeBoundary(self, timestamp: float) -> float:
+        """ Returns the next instant after given timestamp at which any time dependent coupon state changes.
+         Returns infinity if no such instant exists. """
+        position = bisect_right(self.timeBoundaries, timestamp)
+        if position < len(self.timeBoundaries):
+            return self.timeBoundaries[position]
+        else:
+            return math.inf
+
+    def getTimeDependentBits(self, timestamp: float) -> tuple:
+        """ Returns bitsets (valid, notYetActive, new) for given timestamp.
+         Results are re-used until the next time boundary is reached. """
+        if self.cachedTimeDependentBits is not None and self.cachedTimeDependentBitsValidFrom <= timestamp < self.cachedTimeDependentBitsValidUntil:
+            return self.cachedTimeDependentBits
+        validBits = 0
+        notYetActiveBits = 0
+        newBits = 0
+        for index, timestampExpire in enumerate(self.timestampsExpire):
+            timestampStart = self.timestampsStart[index]
+            notYetActive = timestampStart > 0 and timestampStart > timestamp
+            if notYetActive:
+                notYetActiveBits |= 1 << index
+            elif timestampExpire >= timestamp:
+                validBits |= 1 << index
+            if timestamp < self.timestampsIsNewUntil[index] or (timestampStart > 0 and timestampStart < timestamp < timestampStart + COUPON_IS_NEW_FOR_SECONDS):
+                newBits |= 1 << index
+        position = bisect_right(self.timeBoundaries, timestamp)
+        self.cachedTimeDependentBitsValidFrom = self.timeBoundaries[position - 1] if position > 0 else -math.inf
+        self.cachedTimeDependentBitsValidUntil = self.timeBoundaries[position] if position < len(self.timeBoundaries) else math.inf
+        self.cachedTimeDependentBits = (validBits, notYetActiveBits, newBits)
+        return self.cachedTimeDependentBits
+
+    def getStaticFilterBits(self, couponfilter: CouponFilter) -> int:
+        """ Returns bitset of all coupons matching the parts of given filter which do not depend on the current time. """
+        allowedCouponTypes = tuple(couponfilter.allowedCouponTypes) if couponfilter.allowedCouponTypes is not None else None
+        cacheKey = (allowedCouponTypes,) + tuple(getattr(couponfilter, filterField) for filterField in STATIC_FILTER_FLAGS)
+        bits = self.staticFilterBitsCache.get(cacheKey)
+        if bits is not None:
+            return bits
+        bits = self.allBits
+        if allowedCouponTypes is not None:
+            typeBits = 0
+            for couponType in allowedCouponTypes:
+                typeBits |= self.typeBits.get(couponType, 0)
+            bits &= typeBits
+        for filterField in STATIC_FILTER_FLAGS:
+            desiredValue = getattr(couponfilter, filterField)
+            if desiredValue is not None:
+                bits &= self.flagBits[filterField][desiredValue]
+        self.staticFilterBitsCache[cacheKey] = bits
+        return bits
+
+    def getFilterBits(self, couponfilter: CouponFilter, timestamp: Union[float, None] = None) -> int:
+        """ Returns bitset of all coupons matching given filter. """
+        bits = self.getStaticFilterBits(couponfilter)
+        if couponfilter.activeOnly or couponfilter.isNotYetActive is not None or couponfilter.isNew is not None:
+            if timestamp is None:
+                timestamp = getCurrentDate().timestamp()
+            validBits, notYetActiveBits, newBits = self.getTimeDependentBits(timestamp)
+            if couponfilter.activeOnly:
+                bits &= validBits
+            if couponfilter.isNotYetActive is True:
+                bits &= notYetActiveBits
+            elif couponfilter.isNotYetActive is False:
+                bits &= ~notYetActiveBits
+            if couponfilter.isNew is True:
+                bits &= newBits
+            elif couponfilter.isNew is False:
+                bits &= ~newBits
+        return bits
+
+
+def getSortPermutations(coupons: List[Coupon]) -> dict:
+    """ Returns coupon positions in sorted order for each sort mode which does not depend on the current time.
+     Sorting is stable so the result matches sorting any subset of coupons which is given in the same order. """
+    positions = range(len(coupons))
+    prices = [-1 if coupon.getPrice() is None else coupon.getPrice() for coupon in coupons]
+    discounts = [0 if coupon.getReducedPercentage() is None else coupon.getReducedPercentage() for coupon in coupons]
+    containsFriesAndDrink = [coupon.isContainsFriesAndDrink() for coupon in coupons]
+    return {
+        CouponSortModes.PRICE: sorted(positions, key=lambda position: prices[position]),
+        CouponSortModes.PRICE_DESCENDING: sorted(positions, key=lambda position: prices[position], reverse=True),
+        CouponSortModes.DISCOUNT: sorted(positions, key=lambda position: discounts[position]),
+        CouponSortModes.DISCOUNT_DESCENDING: sorted(positions, key=lambda position: discounts[position], reverse=True),
+        # Coupons without menu first, each part sorted by price
+        CouponSortModes.MENU_PRICE: sorted(positions, key=lambda position: (containsFriesAndDrink[position], prices[position])),
+        # Same as above but separated by type: App coupons(source == 0) > Paper coupons
+        CouponSortModes.TYPE_MENU_PRICE: sorted(positions, key=lambda position: (coupons[position].type, containsFriesAndDrink[position], prices[position])),
+    }
+
+
+def getBitIndexes(bits: int) -> List[int]:
+    """ Returns positions of all set bits in ascending order. """
+    return [index for index, char in enumerate(reversed(bin(bits))) if char == '1']
+
+
+class CouponSnapshot:
+    """ Read-only in-memory copy of the coupon DB at one point in time.
+     The bot serves all coupon reads from this so that menu clicks do not cause any DB requests.
+     Coupon objects inside a snapshot must never be modified: Build a new snapshot whenever the DB has changed. """
+
+    def __init__(self, coupons: Union[dict, List[Coupon]], version: int):
+        if isinstance(coupons, list):
+            coupons = {coupon.id: coupon for coupon in coupons}
+        self.version = version
+        self.dateCreated = datetime.now()
+        self.coupons = MappingProxyType(dict(coupons))
+        self.couponIDs = list(self.coupons.keys())
+        self.couponList = list(self.coupons.values())
+        self.filterIndex = CouponFilterIndex(self.couponList)
+        for coupon in self.couponList:
+            coupon.preRenderTexts()
+        self.couponPositions = {couponID: position for position, couponID in enumerate(self.couponIDs)}
+        self.sortPermutations = getSortPermutations(self.couponList)
+        # Permutations for sorting by "new" state depend on the current time -> Cached per bitset of new coupons
+        self.newSortPermutationsBits = None
+        self.newSortPermutations = {}
+        # Groups of coupon positions containing the same products and the position of the coupon to keep for each complete group
+        self.duplicateGroups = []
+        self.duplicateGroupWinners = []
+        for duplicateGroup in getDuplicateCouponGroups([coupon for coupon in self.couponList if coupon.isEligibleForDuplicateRemoval()]):
+            self.duplicateGroups.append([self.couponPositions[coupon.id] for coupon in duplicateGroup])
+            self.duplicateGroupWinners.append(self.couponPositions[getPreferredDuplicateCoupon(duplicateGroup).id])
+
+    def __len__(self) -> int:
+        return len(self.coupons)
+
+    def __contains__(self, couponID: str) -> bool:
+        return couponID in self.coupons
+
+    def __iter__(self):
+        return iter(self.coupons)
+
+    def getCoupon(self, couponID: str) -> Union[Coupon, None]:
+        return self.coupons.get(couponID)
+
+    def getCoupons(self) -> List[Coupon]:
+        return list(self.couponList)
+
+    def getFilteredCoupons(self, couponfilter: CouponFilter, timestamp: Union[float, None] = None) -> dict:
+        """ Returns all coupons matching given filter in snapshot order. Does not remove duplicates and does not sort. """
+        bits = self.filterIndex.getFilterBits(couponfilter, timestamp=timestamp)
+        couponIDs = self.couponIDs
+        couponList = self.couponList
+        return {couponIDs[index]: couponList[index] for index in getBitIndexes(bits)}
+
+    def getNextTimeBoundary(self, timestamp: Union[float, None] = None) -> float:
+        """ Returns the next instant at which the validity/new state of any coupon in this snapshot changes. """
+        if timestamp is None:
+            timestamp = getCurrentDate().timestamp()
+        return self.filterIndex.getNextTimeBoundary(timestamp)
+
+    def getSortPermutation(self, sortMode: CouponSortMode) -> Union[List[int], None]:
+        """ Returns coupon positions in sorted order for given sort mode or None if the sort mode is unknown. """
+        if sortMode == CouponSortModes.NEW or sortMode == CouponSortModes.NEW_DESCENDING:
+            newBits = self.filterIndex.getTimeDependentBits(getCurrentDate().timestamp())[2]
+            if newBits != self.newSortPermutationsBits:
+                newPositions = getBitIndexes(newBits)
+                notNewPositions = getBitIndexes(self.filterIndex.allBits & ~newBits)
+                self.newSortPermutations = {CouponSortModes.NEW: notNewPositions + newPositions, CouponSortModes.NEW_DESCENDING: newPositions + notNewPositions}
+                self.newSortPermutationsBits = newBits
+            return self.newSortPermutations[sortMode]
+        return self.sortPermutations.get(sortMode)
+
+    def sortCouponsAsList(self, coupons: Union[list, dict], sortCode: Union[int, CouponSortMode]) -> List[Coupon]:
+        """ Sorts given coupons of this snapshot by walking through the precomputed order of the sort mode instead of sorting them again.
+         Falls back to regular sorting for coupons which are not part of this snapshot. """
+        if isinstance(coupons, dict):
+            coupons = list(coupons.values())
+        if isinstance(sortCode, CouponSortMode):
+            sortMode = sortCode
+        else:
+            sortMode = getSortModeBySortCode(sortCode)
+        permutation = self.getSortPermutation(sortMode)
+        if permutation is None:
+            return sortCouponsAsList(coupons, sortMode)
+        selected = bytearray(len(self.couponList))
+        for coupon in coupons:
+            position = self.couponPositions.get(coupon.id)
+            if position is None or self.couponList[position] is not coupon or selected[position]:
+                return sortCouponsAsList(coupons, sortMode)
+            selected[position] = 1
+        couponList = self.couponList
+        return [couponList[position] for position in permutation if selected[position]]
+
+    def sortCoupons(self, coupons: Union[list, dict], sortCode: Union[int, CouponSortMode]) -> dict:
+        return {coupon.id: coupon for coupon in self.sortCouponsAsList(coupons, sortCode)}
+
+    def removeDuplicatedCoupons(self, coupons: Union[list, dict]) -> dict:
+        """ Same as removeDuplicatedCoupons but uses the duplicate groups of this snapshot. Returns coupons in snapshot order.
+         Falls back to regular duplicate removal for coupons which are not part of this snapshot. """
+        if isinstance(coupons, dict):
+            coupons = list(coupons.values())
+        selected = bytearray(len(self.couponList))
+        for coupon in coupons:
+            position = self.couponPositions.get(coupon.id)
+            if position is None or self.couponList[position] is not coupon or selected[position]:
+                return removeDuplicatedCoupons(coupons)
+            selected[position] = 1
+        couponList = self.couponList
+        for duplicateGroup, winnerPosition in zip(self.duplicateGroups, self.duplicateGroupWinners):
+            selectedPositions = [position for position in duplicateGroup if selected[position]]
+            if len(selectedPositions) < 2:
+                continue
+            if len(selectedPositions) < len(duplicateGroup):
+                # Only part of this group is selected -> Winner needs to be determined for that part
+                winnerPosition = self.couponPositions[getPreferredDuplicateCoupon([couponList[position] for position in selectedPositions]).id]
+            for position in selectedPositions:
+                if position != winnerPosition:
+                    selected[position] = 0
+        return {self.couponIDs[position]: couponList[position] for position in range(len(couponList)) if selected[position]}
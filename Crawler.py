@@ -1,13 +1,15 @@
 import asyncio
 import csv
+import hashlib
 import logging
 import traceback
-from typing import List
+from collections import OrderedDict
+from typing import List, Tuple, Union, Iterable
 
 import httpx
-import qrcode
 import requests
 from couchdb import Database
+from couchdb.design import ViewDefinition
 
 import couchdb
 
@@ -16,11 +18,18 @@ from BotUtils import getImageBasePath, loadConfig
 from Helper import *
 from Helper import getPathImagesOffers, getPathImagesProducts, \
     isValidImageFile, CouponType, Paths
+from ImageDownloader import ImageDownloader, getHTTPClientLimits
+from JsonArrayStream import JsonArrayStreamParser
+from QRCodeRenderer import QRCodeRenderer
 from UtilsOffers import offerGetImagePath, offerIsValid
-from UtilsCouponsDB import Coupon, getCouponTitleMapping, removeDuplicatedCoupons, sortCoupons, CouponTextRepresentationPLUMode
+from UtilsCouponsDB import Coupon, getDuplicateCouponGroups, CouponTextRepresentationPLUMode, CouponSortMode, MAX_SECONDS_WITHOUT_USAGE_UNTIL_AUTO_ACCOUNT_DELETION, \
+    MAX_HOURS_ACTIVITY_TRACKING
 from filters import CouponFilter
-from models import InfoEntry, User
+from models import InfoEntry, User, USER_DB_VIEWS, OUTBOX_DB_VIEWS, USER_VIEW_STATS, USER_VIEW_LAST_TIME_BOT_USED, USER_VIEW_AUTO_DELETION_CANDIDATES, \
+    getViewName
 from CouponCategory import CouponCategory
+from CouponSnapshot import CouponSnapshot
+from AppCouponParser import getAppCouponObjects, parseAppCoupon
 
 HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
            "Origin": "https://www.burgerking.de",
@@ -35,37 +44,39 @@ HEADERS = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/
            "x-ui-platform": "web",
            "x-ui-region": "DE"}
 
+MAX_CACHED_COUPON_LISTS = 256
+
+
+class AppCouponsNotModifiedException(Exception):
+    """ App API says that coupons haven't changed since our last request (HTTP 304). """
+    pass
+
 
 class UserStats:
-    """ Returns an object containing statistic data about given users Database instance. """
+    """ Returns an object containing statistic data about given users Database instance.
+     All values are read from map/reduce views which CouchDB updates incrementally on every user write so no user document needs to be loaded here. """
 
     def __init__(self, userdb: Database):
-        self.numberofUsersTotal = len(userdb)
-        self.numberofUsersWhoFoundEasterEgg = 0
-        self.numberofFavorites = 0
-        self.numberofUsersWhoProbablyBlockedBot = 0
-        self.numberofUsersWhoAreEligableForAutoDeletion = 0
-        self.numberofUsersWhoRecentlyUsedBot = 0
-        self.numberofUsersWhoAddedPaybackCard = 0
-        self.numberofUsersWhoEnabledBotNewsletter = 0
-        self.numberofUsersWhoDisabledDonateButton = 0
-        for userID in userdb:
-            user: User = User.load(userdb, userID)
-            if user.hasFoundEasterEgg():
-                self.numberofUsersWhoFoundEasterEgg += 1
-            self.numberofFavorites += len(user.favoriteCoupons)
-            if user.hasProbablyBlockedBot():
-                self.numberofUsersWhoProbablyBlockedBot += 1
-            if user.getPaybackCardNumber() is not None:
-                self.numberofUsersWhoAddedPaybackCard += 1
-            if user.isEligableForAutoDeletion():
-                self.numberofUsersWhoAreEligableForAutoDeletion += 1
-            elif user.hasRecentlyUsedBot():
-                self.numberofUsersWhoRecentlyUsedBot += 1
-            if user.settings.notifyOnBotNewsletter:
-                self.numberofUsersWhoEnabledBotNewsletter += 1
-            if user.settings.displayDonateButton is False:
-                self.numberofUsersWhoDisabledDonateButton += 1
+        counters = {row.key: row.value for row in userdb.view(getViewName(USER_VIEW_STATS), group=True)}
+        self.numberofUsersTotal = counters.get('users', 0)
+        self.numberofUsersWhoFoundEasterEgg = counters.get('easterEgg', 0)
+        self.numberofFavorites = counters.get('favorites', 0)
+        self.numberofUsersWhoProbablyBlockedBot = counters.get('blocked', 0)
+        self.numberofUsersWhoAddedPaybackCard = counters.get('paybackCard', 0)
+        self.numberofUsersWhoEnabledBotNewsletter = counters.get('newsletter', 0)
+        self.numberofUsersWhoDisabledDonateButton = counters.get('donateButtonDisabled', 0)
+        timestampNow = getCurrentDate().timestamp()
+        self.numberofUsersWhoAreEligableForAutoDeletion = getViewRowCount(userdb, USER_VIEW_AUTO_DELETION_CANDIDATES, endkey=timestampNow - MAX_SECONDS_WITHOUT_USAGE_UNTIL_AUTO_ACCOUNT_DELETION,
+                                                                          inclusive_end=False)
+        self.numberofUsersWhoRecentlyUsedBot = getViewRowCount(userdb, USER_VIEW_LAST_TIME_BOT_USED, startkey=timestampNow - MAX_HOURS_ACTIVITY_TRACKING * 60 * 60)
+
+
+def getViewRowCount(db: Database, viewDefinition: ViewDefinition, **options) -> int:
+    """ Returns result of a view with '_count' reduce function for given key range. """
+    rows = list(db.view(getViewName(viewDefinition), **options))
+    if len(rows) == 0:
+        return 0
+    return rows[0].value
 
 
 class BKCrawler:
@@ -86,6 +97,21 @@ class BKCrawler:
         self.cachedMissingPaperCouponsText = None
         self.cachedFutureCouponsText = None
         self.cachedFutureCoupons = []
+        # Caches above depend on the current time -> They are valid until this timestamp or until the coupon snapshot changes
+        self.cachesValidUntil = 0
+        self.cachesCouponSnapshotVersion = 0
+        self.couponSnapshot: Union[CouponSnapshot, None] = None
+        self.couponSnapshotVersion = 0
+        self.couponSnapshotIsOutdated = True
+        # Fingerprints of the data of the last successfully processed crawl: If a crawl returns the same data, processing can be skipped. Get loaded from InfoEntry below.
+        self.lastCrawlFingerprint = None
+        self.lastExtraCouponsFingerprint = None
+        # 'If-None-Match'/'If-Modified-Since' headers based on 'ETag'/'Last-Modified' of the last processed app API response
+        self.appCouponsAPIConditionalHeaders = {}
+        # LRU cache of filtered, deduplicated and sorted coupon ID lists e.g. used by the bot for coupon list pagination
+        self.couponListCache = OrderedDict()
+        self.couponListCacheHits = 0
+        self.couponListCacheMisses = 0
         # Create required DBs
         if DATABASES.INFO_DB not in self.couchdb:
             logging.info("Creating missing DB: " + DATABASES.INFO_DB)
@@ -93,12 +119,25 @@ class BKCrawler:
         else:
             infoDB = self.couchdb[DATABASES.INFO_DB]
         # Special case: Not only do we need to make sure that this DB exists but also need to add this special doc
-        if DATABASES.INFO_DB not in infoDB:
+        infoDoc = InfoEntry.load(infoDB, DATABASES.INFO_DB)
+        if infoDoc is None:
             infoDoc = InfoEntry(id=DATABASES.INFO_DB)
-            infoDoc.store(self.couchdb[DATABASES.INFO_DB])
+            infoDoc.store(infoDB)
+        self.lastCrawlFingerprint = infoDoc.crawlFingerprint
+        self.lastExtraCouponsFingerprint = infoDoc.crawlExtraCouponsFingerprint
+        self.appCouponsAPIConditionalHeaders = dict(infoDoc.appCouponsAPIConditionalHeaders)
         if DATABASES.TELEGRAM_USERS not in self.couchdb:
             logging.info("Creating missing DB: " + DATABASES.TELEGRAM_USERS)
             self.couchdb.create(DATABASES.TELEGRAM_USERS)
+        # Make sure that views used by the bot exist and are up-to-date
+        ViewDefinition.sync_many(self.couchdb[DATABASES.TELEGRAM_USERS], USER_DB_VIEWS)
+        if DATABASES.NOTIFICATION_OUTBOX not in self.couchdb:
+            logging.info("Creating missing DB: " + DATABASES.NOTIFICATION_OUTBOX)
+            self.couchdb.create(DATABASES.NOTIFICATION_OUTBOX)
+        ViewDefinition.sync_many(self.couchdb[DATABASES.NOTIFICATION_OUTBOX], OUTBOX_DB_VIEWS)
+        if DATABASES.NOTIFICATION_MESSAGES not in self.couchdb:
+            logging.info("Creating missing DB: " + DATABASES.NOTIFICATION_MESSAGES)
+            self.couchdb.create(DATABASES.NOTIFICATION_MESSAGES)
         if DATABASES.COUPONS not in self.couchdb:
             logging.info("Creating missing DB: " + DATABASES.COUPONS)
             self.couchdb.create(DATABASES.COUPONS)
@@ -123,7 +162,8 @@ class BKCrawler:
         if DATABASES.TELEGRAM_CHANNEL not in self.couchdb:
             logging.info("Creating missing DB: " + DATABASES.TELEGRAM_CHANNEL)
             self.couchdb.create(DATABASES.TELEGRAM_CHANNEL)
-        self.browser = httpx.AsyncClient()
+        self.qrRenderer = QRCodeRenderer()
+        self.browser = httpx.AsyncClient(limits=getHTTPClientLimits(self.cfg.image_download_workers), timeout=httpx.Timeout(30, connect=10))
         # Test 2022-06-05 to find invalid datasets
         # userDB = self.couchdb[DATABASES.TELEGRAM_USERS]
         # if os.path.exists('telegram_users.json'):
@@ -161,6 +201,7 @@ class BKCrawler:
             loop.create_task(self.addExtraCoupons(crawledCouponsDict={}, immediatelyAddToDB=True))
         # Make sure that our cache gets filled on init
         couponDB = self.getCouponDB()
+        self.updateCouponSnapshot(couponDB)
         self.updateCaches(couponDB)
         self.updateCachedMissingPaperCouponsInfo(couponDB)
 
@@ -182,12 +223,24 @@ class BKCrawler:
         """ If enabled, CSV file(s) will be exported into the "crawler" folder on each full crawl run. """
         self.exportCSVs = exportCSVs
 
-    async def crawl(self):
-        """ Updates DB with new coupons & offers. """
+    async def crawl(self) -> bool:
+        """ Updates DB with new coupons & offers. Returns False if nothing has changed since the last crawl so processing has been skipped. """
         crawledCouponsDict = {}
         apiCrawlerException = None
+        if self.lastCrawlFingerprint is not None and len(self.getCouponDB()) == 0:
+            # Coupon DB has been wiped -> Data of the last crawl needs to be processed again
+            self.lastCrawlFingerprint = None
+        extraCouponsFingerprint = getCouponsFingerprint(self.getValidExtraCoupons().values())
+        # Only allow API to tell us that nothing has changed if we don't need the app coupons for processing the extra coupons either
+        allowNotModified = self.lastCrawlFingerprint is not None and extraCouponsFingerprint == self.lastExtraCouponsFingerprint
+        appCouponsAPIConditionalHeaders = {}
         try:
-            await self.crawlCoupons(crawledCouponsDict)
+            appCouponsAPIConditionalHeaders = await self.crawlCoupons(crawledCouponsDict, self.appCouponsAPIConditionalHeaders if allowNotModified else {})
+        except AppCouponsNotModifiedException:
+            logging.info("App coupons have not changed since last crawl -> Skipping processing")
+            self.updateDateLastSuccessfulCrawlRun()
+            self.deleteExpiredCoupons()
+            return False
         except Exception as e:
             """ Catch exception so that we can continue to add/process paper coupons. """
             logging.warning("API crawler failed")
@@ -197,27 +250,46 @@ class BKCrawler:
             """ Small workaround so that even if the crawler fails, we will still download the coupon images and generate the QR codes. """
             immediatelyAddToDB = True
         await self.addExtraCoupons(crawledCouponsDict=crawledCouponsDict, immediatelyAddToDB=immediatelyAddToDB)
+        # Needs to be done before processing as processing modifies the coupons
+        crawlFingerprint = getCouponsFingerprint(crawledCouponsDict.values())
+        if apiCrawlerException is None and crawlFingerprint == self.lastCrawlFingerprint:
+            logging.info("Crawled coupons have not changed since last crawl -> Skipping processing")
+            if appCouponsAPIConditionalHeaders != self.appCouponsAPIConditionalHeaders:
+                self.appCouponsAPIConditionalHeaders = appCouponsAPIConditionalHeaders
+                self.storeCrawlState()
+            self.deleteExpiredCoupons()
+            return False
+        # Forget old state in case processing fails
+        self.lastCrawlFingerprint = None
+        self.storeCrawlState()
         self.processCrawledCoupons(crawledCouponsDict)
         if apiCrawlerException is not None:
             # Raise exception to signal upper handling that API crawler has failed.
             raise apiCrawlerException
+        self.lastCrawlFingerprint = crawlFingerprint
+        self.lastExtraCouponsFingerprint = extraCouponsFingerprint
+        self.appCouponsAPIConditionalHeaders = appCouponsAPIConditionalHeaders
+        self.storeCrawlState()
         # self.crawlProducts()
+        return True
 
     async def downloadProductiveCouponDBImagesAndCreateQRCodes(self):
         """ Downloads coupons images and generates QR codes for current productive coupon DB. """
         dateStart = datetime.now()
         couponDB = self.getCouponDB()
         # Step 1: Create QR images
-        coupons = []
-        for uniqueCouponID in couponDB:
-            coupon = Coupon.load(couponDB, uniqueCouponID)
-            coupons.append(coupon)
-            generateQRImageIfNonExistant(uniqueCouponID, coupon.getImagePathQR())
-        # Step 2: Download coupon images
-        numberofDownloadedImages = 0
+        coupons = self.getCouponSnapshot(couponDB).getCoupons()
+        await self.qrRenderer.renderManyAsync([(coupon.id, coupon.getImagePathQR()) for coupon in coupons])
+        # Step 2: Download missing coupon images in parallel
+        downloads = []
         for coupon in coupons:
-            if await self.downloadImageIfNonExistant(coupon):
-                numberofDownloadedImages += 1
+            url = coupon.imageURL
+            path = coupon.getImagePath()
+            if url is None or path is None or os.path.exists(path):
+                continue
+            downloads.append((url, path))
+        imageDownloader = ImageDownloader(self.browser, maxConcurrentDownloads=self.cfg.image_download_workers)
+        numberofDownloadedImages = await imageDownloader.downloadAll(downloads)
         logging.info(f"Number of coupon images downloaded: {numberofDownloadedImages} | Duration: {datetime.now() - dateStart}")
 
     def migrateDBs(self):
@@ -247,180 +319,46 @@ class BKCrawler:
 
     async def crawlAndProcessData(self):
         """ One function that does it all! Execute this every time you run the crawler. """
+        dataHasChanged = True
         try:
             timestampStart = datetime.now().timestamp()
-            await self.crawl()
-            if self.exportCSVs:
+            dataHasChanged = await self.crawl()
+            if self.exportCSVs and dataHasChanged:
                 self.couponCsvExport()
                 self.couponCsvExport2()
+            # Also done if nothing has changed so images which failed to download last time get downloaded now
             await self.downloadProductiveCouponDBImagesAndCreateQRCodes()
             # self.checkProductiveCouponsDBImagesIntegrity()
             # self.checkProductiveOffersDBImagesIntegrity()
             logging.info("Total crawl duration: " + getFormattedPassedTime(timestampStart))
         finally:
-            self.updateCaches(couponDB=self.getCouponDB(), offerDB=self.getOfferDB())
+            if dataHasChanged:
+                self.updateCaches(couponDB=self.getCouponDB(), offerDB=self.getOfferDB())
+            else:
+                self.updateCachesIfOutdated()
 
-    async def crawlCoupons(self, crawledCouponsDict: dict):
+    async def crawlCoupons(self, crawledCouponsDict: dict, conditionalHeaders: dict) -> dict:
         """ Crawls coupons from App API.
+         Raises AppCouponsNotModifiedException if <conditionalHeaders> are given and the API says that nothing has changed.
+         Returns conditional headers to be used for the next crawl.
          """
         timestampCrawlStart = datetime.now().timestamp()
-        # Docs: https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default
-        # Official live instance: https://www.burgerking.de/rewards/offers
-        # Old one: https://euc1-prod-bk.rbictg.com/graphql
-        req = await self.browser.get(
-            url='https://czqk28jt.apicdn.sanity.io/v2023-08-01/graphql/prod_bk_de/gen3?operationName=featureSortedLoyaltyOffers&variables=%7B%22id%22%3A%22feature-loyalty-offers-ui-singleton%22%7D&query=query+featureSortedLoyaltyOffers%28%24id%3AID%21%29%7BLoyaltyOffersUI%28id%3A%24id%29%7B_id+sortedSystemwideOffers%7B...SystemwideOffersFragment+__typename%7D__typename%7D%7Dfragment+SystemwideOffersFragment+on+SystemwideOffer%7B_id+_type+testOnly+loyaltyEngineId+name%7BlocaleRaw%3AdeRaw+__typename%7Ddescription%7BlocaleRaw%3AdeRaw+__typename%7DmoreInfo%7BlocaleRaw%3AdeRaw+__typename%7DhowToRedeem%7BenRaw+__typename%7DbackgroundImage%7B...MenuImageFragment+__typename%7DshortCode+mobileOrderOnly+redemptionMethod+daypart+redemptionType+upsellOptions%7B_id+loyaltyEngineId+description%7BlocaleRaw%3AdeRaw+__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7Dname%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DofferPrice+marketPrice%7B...on+Item%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7DuiPattern+isUpcomingOffer+lockedOffersPanel%7BcompletedChallengeHeader%7BlocaleRaw%3AdeRaw+__typename%7DcompletedChallengeDescription%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DpromoCodePanel%7BpromoCodeDescription%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLabel%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLink+__typename%7Dincentives%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7DisOfferBenefit+__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Picker%7B_id+_type+options%7Boption%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D%7D__typename%7DisOfferBenefit+__typename%7D...on+OfferDiscount%7B_id+_type+discountValue+discountType+discountProduct%7B...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D__typename%7D__typename%7D%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7Drules%7B...on+RequiresAuthentication%7BrequiresAuthentication+__typename%7D...on+LoyaltyBetweenDates%7BstartDate+endDate+__typename%7D...on+UserAttributes%7BuserAttributesItem%7BattributeItem+useAttributeBatteryLevelFilter+useAttributeBatteryLevelValue+userAttributeBooleanValue+userAttributeStringFilter+userAttributeStringValue+__typename%7D__typename%7D__typename%7D__typename%7Dfragment+MenuImageFragment+on+Image%7Bhotspot%7Bx+y+height+width+__typename%7Dcrop%7Btop+bottom+left+right+__typename%7Dasset%7Bmetadata%7Blqip+__typename%7D_id+__typename%7D__typename%7Dfragment+MenuImagesFragment+on+Images%7Bapp%7B...MenuImageFragment+__typename%7DimageDescription+__typename%7Dfragment+VendorConfigsFragment+on+VendorConfigs%7Bncr%7B...VendorConfigFragment+__typename%7DncrDelivery%7B...VendorConfigFragment+__typename%7Dpartner%7B...VendorConfigFragment+__typename%7DpartnerDelivery%7B...VendorConfigFragment+__typename%7DproductNumber%7B...VendorConfigFragment+__typename%7DproductNumberDelivery%7B...VendorConfigFragment+__typename%7Dsicom%7B...VendorConfigFragment+__typename%7DsicomDelivery%7B...VendorConfigFragment+__typename%7Dqdi%7B...VendorConfigFragment+__typename%7DqdiDelivery%7B...VendorConfigFragment+__typename%7Drpos%7B...VendorConfigFragment+__typename%7DrposDelivery%7B...VendorConfigFragment+__typename%7DsimplyDelivery%7B...VendorConfigFragment+__typename%7DsimplyDeliveryDelivery%7B...VendorConfigFragment+__typename%7DtoshibaLoyalty%7B...VendorConfigFragment+__typename%7D__typename%7Dfragment+VendorConfigFragment+on+VendorConfig%7BpluType+parentSanityId+pullUpLevels+constantPlu+discountPlu+quantityBasedPlu%7Bquantity+plu+qualifier+__typename%7DmultiConstantPlus%7Bquantity+plu+qualifier+__typename%7DparentChildPlu%7Bplu+childPlu+__typename%7DsizeBasedPlu%7BcomboPlu+comboSize+__typename%7D__typename%7Dfragment+PluConfigsFragment+on+PluConfigs%7B_key+_type+partner%7B...PluConfigFragment+__typename%7D__typename%7Dfragment+PluConfigFragment+on+PluConfig%7B_key+_type+posIntegration%7B_id+_type+name+__typename%7DserviceMode+vendorConfig%7B...VendorConfigFragment+__typename%7D__typename%7D',
-            headers=HEADERS, timeout=120)
-        logging.debug(req.text)
-        apiResponse = req.json()
-        if self.storeCouponAPIDataAsJson:
-            # Save API response so we can easily use this data for local testing later on.
-            saveJson('crawler/coupons1.json', apiResponse)
-        couponArrayBK = apiResponse['data']['LoyaltyOffersUI']['sortedSystemwideOffers']
+        offersForJsonExport = [] if self.storeCouponAPIDataAsJson else None
         appCoupons = []
         appCouponsNotYetActive = []
         totalindex = 0
         childindex = 0
 
-        for couponBKTmp in couponArrayBK:
+        newConditionalHeaders = {}
+        async for couponBKTmp in self.iterateAppOfferObjects(conditionalHeaders, newConditionalHeaders):
+            if offersForJsonExport is not None:
+                offersForJsonExport.append(couponBKTmp)
             try:
-                if couponBKTmp.get('testOnly') is True:
-                    # 2025-01-25
-                    logging.info("Skipping internal TEST-item")
-                    continue
-                bkCoupons = [couponBKTmp]
-                # Collect hidden coupons
-                upsellOptions = couponBKTmp.get('upsellOptions')
-                if upsellOptions is not None:
-                    for upsellOption in upsellOptions:
-                        upsellID = upsellOption.get('_id')
-                        upsellType = upsellOption.get('_type')
-                        upsellShortCode = upsellOption.get('shortCode')
-                        if upsellType != 'offer' or upsellShortCode is None:
-                            # Skip invalid items: This should never happen
-                            logging.info(f"Found invalid/unsupported upsell object: {upsellID=}")
-                            continue
-                        bkCoupons.append(upsellOption)
                 childindex = 0
-                for couponBK in bkCoupons:
-                    vendorConfigs = couponBK['vendorConfigs']
-                    try:
-                        uniqueCouponID = vendorConfigs['rpos']['constantPlu']
-                    except:
-                        uniqueCouponID = None
-                    if uniqueCouponID is None:
-                        uniqueCouponID = vendorConfigs['partner']['constantPlu']
-                    legacyInternalName = couponBK.get('internalName')
-                    # Find coupon-title. Prefer to get it from 'internalName' as the other title may contain crap we don't want.
-                    # 2022-11-02: Prefer normal titles again because internal ones are sometimes incomplete
-                    useInternalNameAsTitle = False
-                    legacyInternalNameRegex = None
-                    if legacyInternalName is not None:
-                        legacyInternalNameRegex = re.compile(r'[A-Za-z0-9]+_\d+_(?:UPSELL_|CRM_MYBK_|MYBK_|\d{3,}_)?(.+)').search(legacyInternalName)
-                    subtitle = None
-                    try:
-                        subtitle = couponBK['description']['localeRaw'][0]['children'][0]['text']
-                    except:
-                        # Subtitle is not always available
-                        pass
-                    if legacyInternalNameRegex is not None and useInternalNameAsTitle:
-                        titleFull = legacyInternalNameRegex.group(1)
-                        titleFull = titleFull.replace('_', ' ')
-                    else:
-                        """ Decide how to use title and subtitle and if it makes sense to put both into one string. """
-                        title = couponBK['name']['localeRaw'][0]['children'][0]['text']
-                        title = title.strip()
-                        if subtitle is None:
-                            titleFull = title
-                        else:
-                            subtitle = subtitle.strip()
-                            titleShortened = shortenProductNames(title)
-                            subtitleShortened = shortenProductNames(subtitle)
-                            if len(subtitleShortened) == 0 or subtitleShortened.isspace():
-                                # Useless subtitle -> Use title only
-                                titleFull = title
-                            elif len(titleShortened) == 0 or titleShortened.isspace():
-                                # Useless title -> Use subtitle only
-                                titleFull = subtitle
-                            elif titleShortened == subtitleShortened:  # Small hack: Shorten titles before comparing them
-                                # Title and subtitle are the same -> Use title only
-                                titleFull = title
-                            elif not subtitle.startswith('+'):
-                                logging.info(
-                                    f'Coupon {uniqueCouponID}: Possible subtitle which should not be included in coupon title because it doesnt start with a plus sumbol: {subtitle=}')
-                                titleFull = title
-                            else:
-                                # Assume that subtitle is usable and add it to title
-                                titleFull = title + ' ' + subtitle
-
-                    price = couponBK['offerPrice']
-                    plu = couponBK['shortCode']
-                    coupon = Coupon(id=uniqueCouponID, uniqueID=uniqueCouponID, plu=plu, title=titleFull, subtitle=subtitle, type=CouponType.APP)
-                    # ID which can be used to view coupon in browser
-                    coupon.webviewID = couponBK.get('loyaltyEngineId')
-                    if childindex > 0:
-                        # First item = Real coupon, all others = upsell/"hidden" coupon(s)
-                        coupon.isHidden = True
-                    if price == 0:
-                        # Special detection for some 50%/2for1 coupons that are listed with price == 0€
-                        if titleFull.startswith('2'):
-                            # E.g. 2 Crispy Chicken
-                            coupon.staticReducedPercent = 50
-                        else:
-                            # While it is super unlikely let's allow BK to provide coupons for free products :)
-                            coupon.price = 0
-                    else:
-                        coupon.price = price
-                    # Build URL to coupon product image
-                    imageurl = couponBK['localizedImage']['locale']['app']['asset']['_id']
-                    imageurl = "https://cdn.sanity.io/images/czqk28jt/prod_bk_de/" + imageurl.replace('image-', '')
-                    imageurl = imageurl.replace('-png', '.png')
-                    coupon.imageURL = imageurl
-                    """ Find and set start- and expire-date.
-                     """
-                    datetimeExpire1 = None
-                    datetimeExpire2 = None
-                    datetimeStart = None
-                    try:
-                        footnote = couponBK['moreInfo']['localeRaw'][0]['children'][0]['text']
-                        expiredateRegex = re.compile(r'(?i)Abgabe bis (\d{1,2}\.\d{1,2}\.\d{4})').search(footnote)
-                        if expiredateRegex is not None:
-                            expiredateStr = expiredateRegex.group(1) + ' 23:59:59'
-                            datetimeExpire1 = datetime.strptime(expiredateStr, '%d.%m.%Y %H:%M:%S')
-                    except:
-                        # Dontcare
-                        logging.warning('Failed to find BetterExpiredate for coupon: ' + coupon.id)
-                    rulesHere = couponBK.get('rules')
-                    if rulesHere is not None:
-                        rulesAll = []
-                        for ruleSet in rulesHere:
-                            ruleSetsChilds = ruleSet.get('rules')
-                            if ruleSetsChilds is not None:
-                                for ruleSetsChild in ruleSetsChilds:
-                                    rulesAll.append(ruleSetsChild)
-                            else:
-                                rulesAll.append(ruleSet)
-                        dateformatStart = '%Y-%m-%d'
-                        dateformatEnd = '%Y-%m-%d %H:%M:%S'
-                        for rule in rulesAll:
-                            if rule['__typename'] == 'LoyaltyBetweenDates':
-                                datetimeStart = datetime.strptime(rule['startDate'], dateformatStart)
-                                datetimeExpire2 = datetime.strptime(rule['endDate'] + ' 23:59:59', dateformatEnd)
-                                break
-                    else:
-                        logging.info(f'Coupon without rules field: {coupon.id}')
-                    if datetimeExpire1 is None and datetimeExpire2 is None:
-                        # This should never happen
-                        raise Exception(f'WTF failed to find any expiredate for coupon: {uniqueCouponID}')
-                    if datetimeExpire1 is not None:
-                        # Prefer this expiredate
-                        coupon.timestampExpire = datetimeExpire1.timestamp()
-                    else:
-                        coupon.timestampExpire = datetimeExpire2.timestamp()
-                    if datetimeStart is not None:
-                        coupon.timestampStart = datetimeStart.timestamp()
-                    crawledCouponsDict[uniqueCouponID] = coupon
+                for couponBK in getAppCouponObjects(couponBKTmp):
+                    coupon = parseAppCoupon(couponBK, isHidden=childindex > 0)
                     appCoupons.append(coupon)
-                    if datetimeStart is not None and datetimeStart > datetime.now():
+                    if coupon.timestampStart > datetime.now().timestamp():
                         appCouponsNotYetActive.append(coupon)
                     childindex += 1
                     totalindex += 1
@@ -429,6 +367,12 @@ class BKCrawler:
                 logging.warning(f"Failed to process coupon object with index {totalindex=} | {childindex=} -> Maybe new MyBK code??")
                 continue
 
+        # Only hand over coupons once the complete response has been processed so an interrupted download never looks like deleted coupons
+        for coupon in appCoupons:
+            crawledCouponsDict[coupon.id] = coupon
+        if offersForJsonExport is not None:
+            # Save API response so we can easily use this data for local testing later on.
+            saveJson('crawler/coupons1.json', {'data': {'LoyaltyOffersUI': {'sortedSystemwideOffers': offersForJsonExport}}})
         logging.info(f'Coupons in app total: {len(appCoupons)}')
         logging.info(f'Coupons in app not yet active: {len(appCouponsNotYetActive)}')
         if len(appCouponsNotYetActive) > 0:
@@ -439,10 +383,51 @@ class BKCrawler:
         logging.info(f'Total coupons crawl time: {getFormattedPassedTime(timestampCrawlStart)}')
         if len(appCoupons) > 0:
             """ Update timestamp of last complete run in DB. Assume that the app always contains at least one valid- or upcoming coupon. """
-            infoDatabase = self.getInfoDB()
-            infoDBDoc = InfoEntry.load(infoDatabase, DATABASES.INFO_DB)
-            infoDBDoc.dateLastSuccessfulCrawlRun = datetime.now()
-            infoDBDoc.store(infoDatabase)
+            self.updateDateLastSuccessfulCrawlRun()
+        return newConditionalHeaders
+
+    def updateDateLastSuccessfulCrawlRun(self):
+        infoDatabase = self.getInfoDB()
+        infoDBDoc = InfoEntry.load(infoDatabase, DATABASES.INFO_DB)
+        infoDBDoc.dateLastSuccessfulCrawlRun = datetime.now()
+        infoDBDoc.store(infoDatabase)
+
+    def storeCrawlState(self):
+        """ Persists fingerprints and conditional headers of the last processed crawl so they survive restarts. """
+        infoDatabase = self.getInfoDB()
+        infoDBDoc = InfoEntry.load(infoDatabase, DATABASES.INFO_DB)
+        infoDBDoc.crawlFingerprint = self.lastCrawlFingerprint
+        infoDBDoc.crawlExtraCouponsFingerprint = self.lastExtraCouponsFingerprint
+        infoDBDoc.appCouponsAPIConditionalHeaders = self.appCouponsAPIConditionalHeaders
+        infoDBDoc.store(infoDatabase)
+
+    async def iterateAppOfferObjects(self, conditionalHeaders: dict, newConditionalHeaders: dict):
+        """ Streams coupon objects of the app API one by one while the response is still being downloaded so the complete response never needs to be in memory.
+         Puts conditional headers for the next request based on 'ETag'/'Last-Modified' of the response into <newConditionalHeaders>. """
+        # Docs: https://czqk28jt.apicdn.sanity.io/v1/graphql/prod_bk_de/default
+        # Official live instance: https://www.burgerking.de/rewards/offers
+        # Old one: https://euc1-prod-bk.rbictg.com/graphql
+        parser = JsonArrayStreamParser('sortedSystemwideOffers')
+        isDebugLoggingEnabled = logging.getLogger().isEnabledFor(logging.DEBUG)
+        async with self.browser.stream(
+                'GET',
+                url='https://czqk28jt.apicdn.sanity.io/v2023-08-01/graphql/prod_bk_de/gen3?operationName=featureSortedLoyaltyOffers&variables=%7B%22id%22%3A%22feature-loyalty-offers-ui-singleton%22%7D&query=query+featureSortedLoyaltyOffers%28%24id%3AID%21%29%7BLoyaltyOffersUI%28id%3A%24id%29%7B_id+sortedSystemwideOffers%7B...SystemwideOffersFragment+__typename%7D__typename%7D%7Dfragment+SystemwideOffersFragment+on+SystemwideOffer%7B_id+_type+testOnly+loyaltyEngineId+name%7BlocaleRaw%3AdeRaw+__typename%7Ddescription%7BlocaleRaw%3AdeRaw+__typename%7DmoreInfo%7BlocaleRaw%3AdeRaw+__typename%7DhowToRedeem%7BenRaw+__typename%7DbackgroundImage%7B...MenuImageFragment+__typename%7DshortCode+mobileOrderOnly+redemptionMethod+daypart+redemptionType+upsellOptions%7B_id+loyaltyEngineId+description%7BlocaleRaw%3AdeRaw+__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7Dname%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DofferPrice+marketPrice%7B...on+Item%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+vendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D__typename%7DlocalizedImage%7Blocale%3Ade%7B...MenuImagesFragment+__typename%7D__typename%7DuiPattern+isUpcomingOffer+lockedOffersPanel%7BcompletedChallengeHeader%7BlocaleRaw%3AdeRaw+__typename%7DcompletedChallengeDescription%7BlocaleRaw%3AdeRaw+__typename%7D__typename%7DpromoCodePanel%7BpromoCodeDescription%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLabel%7BlocaleRaw%3AdeRaw+__typename%7DpromoCodeLink+__typename%7Dincentives%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7DisOfferBenefit+__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Picker%7B_id+_type+options%7Boption%7B__typename+...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D%7D__typename%7DisOfferBenefit+__typename%7D...on+OfferDiscount%7B_id+_type+discountValue+discountType+discountProduct%7B...on+Item%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D...on+Combo%7B_id+_type+mainItem%7B_id+_type+operationalItem%7Bdaypart+__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7D__typename%7D__typename%7D__typename%7D%7DvendorConfigs%7B...VendorConfigsFragment+__typename%7DpluConfigs%7B...PluConfigsFragment+__typename%7Drules%7B...on+RequiresAuthentication%7BrequiresAuthentication+__typename%7D...on+LoyaltyBetweenDates%7BstartDate+endDate+__typename%7D...on+UserAttributes%7BuserAttributesItem%7BattributeItem+useAttributeBatteryLevelFilter+useAttributeBatteryLevelValue+userAttributeBooleanValue+userAttributeStringFilter+userAttributeStringValue+__typename%7D__typename%7D__typename%7D__typename%7Dfragment+MenuImageFragment+on+Image%7Bhotspot%7Bx+y+height+width+__typename%7Dcrop%7Btop+bottom+left+right+__typename%7Dasset%7Bmetadata%7Blqip+__typename%7D_id+__typename%7D__typename%7Dfragment+MenuImagesFragment+on+Images%7Bapp%7B...MenuImageFragment+__typename%7DimageDescription+__typename%7Dfragment+VendorConfigsFragment+on+VendorConfigs%7Bncr%7B...VendorConfigFragment+__typename%7DncrDelivery%7B...VendorConfigFragment+__typename%7Dpartner%7B...VendorConfigFragment+__typename%7DpartnerDelivery%7B...VendorConfigFragment+__typename%7DproductNumber%7B...VendorConfigFragment+__typename%7DproductNumberDelivery%7B...VendorConfigFragment+__typename%7Dsicom%7B...VendorConfigFragment+__typename%7DsicomDelivery%7B...VendorConfigFragment+__typename%7Dqdi%7B...VendorConfigFragment+__typename%7DqdiDelivery%7B...VendorConfigFragment+__typename%7Drpos%7B...VendorConfigFragment+__typename%7DrposDelivery%7B...VendorConfigFragment+__typename%7DsimplyDelivery%7B...VendorConfigFragment+__typename%7DsimplyDeliveryDelivery%7B...VendorConfigFragment+__typename%7DtoshibaLoyalty%7B...VendorConfigFragment+__typename%7D__typename%7Dfragment+VendorConfigFragment+on+VendorConfig%7BpluType+parentSanityId+pullUpLevels+constantPlu+discountPlu+quantityBasedPlu%7Bquantity+plu+qualifier+__typename%7DmultiConstantPlus%7Bquantity+plu+qualifier+__typename%7DparentChildPlu%7Bplu+childPlu+__typename%7DsizeBasedPlu%7BcomboPlu+comboSize+__typename%7D__typename%7Dfragment+PluConfigsFragment+on+PluConfigs%7B_key+_type+partner%7B...PluConfigFragment+__typename%7D__typename%7Dfragment+PluConfigFragment+on+PluConfig%7B_key+_type+posIntegration%7B_id+_type+name+__typename%7DserviceMode+vendorConfig%7B...VendorConfigFragment+__typename%7D__typename%7D',
+                headers={**HEADERS, **conditionalHeaders}, timeout=120) as response:
+            if response.status_code == 304:
+                raise AppCouponsNotModifiedException()
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            if etag is not None:
+                newConditionalHeaders['If-None-Match'] = etag
+            lastModified = response.headers.get('Last-Modified')
+            if lastModified is not None:
+                newConditionalHeaders['If-Modified-Since'] = lastModified
+            async for text in response.aiter_text():
+                if isDebugLoggingEnabled:
+                    logging.debug(text)
+                for offer in parser.feed(text):
+                    yield offer
+        parser.close()
 
     async def addExtraCoupons(self, crawledCouponsDict: dict, immediatelyAddToDB: bool):
         """ Adds extra coupons which have been manually added to config_extra_coupons.json and paper coupons.
@@ -452,6 +437,7 @@ class BKCrawler:
             # Add items to DB
             couponDB = self.getCouponDB()
             dbWasUpdated = self.addCouponsToDB(couponDB=couponDB, couponsToAddToDB=extraCouponsToAdd)
+            self.updateCouponSnapshotIfOutdated(couponDB)
             if dbWasUpdated:
                 # Important!
                 await self.downloadProductiveCouponDBImagesAndCreateQRCodes()
@@ -500,11 +486,9 @@ class BKCrawler:
             if paperCouponID in appCouponIDs:
                 print(f"Paper coupon id == app coupon ID: {paperCouponID}")
 
-        couponTitleMapping = getCouponTitleMapping(crawledCouponsDict)
         numberofItemsWithoutImage = 0
-        for couponsContainingSameProducts in couponTitleMapping.values():
-            if len(couponsContainingSameProducts) == 1:
-                continue
+        duplicateCouponGroups = getDuplicateCouponGroups(crawledCouponsDict)
+        for couponsContainingSameProducts in duplicateCouponGroups:
             originalPrice = None
             imageURL = None
             staticReducedPercent = None
@@ -552,7 +536,7 @@ class BKCrawler:
                 logging.info(f'{coupon}')
             logging.info(getLogSeparatorString())
         logging.info(f'Crawled coupons: {len(crawledCouponsDict)} | To be added to DB: {len(couponsToAddToDB)}')
-        numberofDuplicatedCoupons = len(crawledCouponsDict) - len(couponTitleMapping)
+        numberofDuplicatedCoupons = sum(len(couponsContainingSameProducts) - 1 for couponsContainingSameProducts in duplicateCouponGroups)
         logging.info(f"Coupons without images: {numberofItemsWithoutImage} | Duplicated coupons: {numberofDuplicatedCoupons}")
         couponDB = self.getCouponDB()
         self.addCouponsToDB(couponDB=couponDB, couponsToAddToDB=couponsToAddToDB)
@@ -561,8 +545,8 @@ class BKCrawler:
         # modifyCouponDocsUnreliableAPIWorkaround = {}
         # 2023-03-17: Unfinished work
         # doAPIWorkaroundHandling = False
-        for uniqueCouponID in couponDB:
-            dbCoupon = Coupon.load(couponDB, uniqueCouponID)
+        for dbCoupon in iterateDocuments(couponDB, Coupon):
+            uniqueCouponID = dbCoupon.id
             crawledCoupon = crawledCouponsDict.get(uniqueCouponID)
             if crawledCoupon is None:
                 # Coupon is in DB but not in crawled coupons anymore -> Remove from DB
@@ -583,12 +567,25 @@ class BKCrawler:
                 deleteCouponDocs[uniqueCouponID] = dbCoupon
         if len(deleteCouponDocs) > 0:
             couponDB.purge(deleteCouponDocs.values())
+            self.couponSnapshotIsOutdated = True
+        self.updateCouponSnapshotIfOutdated(couponDB)
         logging.info(f"Coupons deleted: {len(deleteCouponDocs)}")
         if len(deleteCouponDocs) > 0:
             logging.info(f"Coupons deleted IDs: {list(deleteCouponDocs.keys())}")
         logging.info(f"Coupon processing done | Total number of coupons in DB: {len(couponDB)}")
         logging.info(f"Total coupon processing time: {datetime.now() - dateStart}")
 
+    def deleteExpiredCoupons(self):
+        """ Time based part of processCrawledCoupons for crawls without any changes: Deletes coupons which have expired since the last crawl. """
+        couponDB = self.getCouponDB()
+        expiredCoupons = [coupon for coupon in self.getCouponSnapshot(couponDB).getCoupons() if coupon.isExpired()]
+        if len(expiredCoupons) == 0:
+            return
+        couponDB.purge(expiredCoupons)
+        self.couponSnapshotIsOutdated = True
+        self.updateCouponSnapshotIfOutdated(couponDB)
+        logging.info(f"Expired coupons deleted: {[coupon.id for coupon in expiredCoupons]}")
+
     def updateHistoryEntry(self, historyDB, primaryKey: str, newData):
         """ Adds/Updates entry inside given database. """
         if primaryKey not in historyDB:
@@ -612,8 +609,8 @@ class BKCrawler:
         """ Small helper functions to detect missing images e.g. after manual images folder cleanup. """
         couponDB = self.getCouponDB()
         numberOfMissingImages = 0
-        for couponIDStr in couponDB:
-            coupon = Coupon.load(couponDB, couponIDStr)
+        for coupon in iterateDocuments(couponDB, Coupon):
+            couponIDStr = coupon.id
             # 2021-04-20: Skip invalid/expired coupons as they're not relevant for the user (we don't access them anyways at this moment).
             if not coupon.isValid():
                 continue
@@ -727,8 +724,7 @@ class BKCrawler:
             fieldnames = ['PRODUCT', 'MENU', 'PLU', 'PLU2', 'TYPE', 'PRICE', 'PRICE_COMPARE', 'START', 'EXP', 'EXP2', 'EXP_PRODUCTIVE']
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            for couponID in couponDB:
-                coupon = Coupon.load(couponDB, couponID)
+            for coupon in iterateDocuments(couponDB, Coupon):
                 writer.writerow({'PRODUCT': coupon.getTitle(), 'MENU': coupon.isContainsFriesAndDrink(),
                                  'PLU': (coupon.plu if coupon.plu is not None else "N/A"), 'PLU2': coupon.id,
                                  'TYPE': coupon.type,
@@ -746,8 +742,7 @@ class BKCrawler:
             fieldnames = ['Produkt', 'Menü', 'PLU', 'PLU2', 'Preis', 'OPreis', 'Ablaufdatum']
             writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
             writer.writeheader()
-            for couponID in couponDB:
-                coupon = Coupon.load(couponDB, couponID)
+            for coupon in iterateDocuments(couponDB, Coupon):
                 if coupon.type != CouponType.PAPER:
                     continue
                 writer.writerow({'Produkt': coupon.getTitle(), 'Menü': coupon.isContainsFriesAndDrink(),
@@ -765,8 +760,9 @@ class BKCrawler:
         # End of nullification
         newCachedAvailableCouponCategories = {}
         futureCoupons = []
-        for couponID in couponDB:
-            coupon = Coupon.load(couponDB, couponID)
+        couponSnapshot = self.getCouponSnapshot(couponDB)
+        timestampNow = getCurrentDate().timestamp()
+        for coupon in couponSnapshot.getCoupons():
             if coupon.isValid():
                 category = newCachedAvailableCouponCategories.setdefault(coupon.type, CouponCategory(
                     coupons=coupon.type))
@@ -797,11 +793,18 @@ class BKCrawler:
                 couponDescr = futureCoupon.generateCouponShortText(highlightIfNew=False, plumode=CouponTextRepresentationPLUMode.ALL_PLUS)
                 thisCouponText = f"<b>{startDateFormatted}</b> | " + couponDescr
                 self.cachedFutureCouponsText += "\n" + thisCouponText
+        self.cachesValidUntil = couponSnapshot.getNextTimeBoundary(timestampNow)
+        self.cachesCouponSnapshotVersion = couponSnapshot.version
+
+    def updateCachesIfOutdated(self):
+        """ Refreshes time dependent caches once any coupon has become valid/expired/new/not new since the last update or if the coupon snapshot has changed. """
+        if getCurrentDate().timestamp() >= self.cachesValidUntil or self.getCouponSnapshot().version != self.cachesCouponSnapshotVersion:
+            logging.info("Refreshing outdated coupon caches")
+            self.updateCaches(couponDB=self.getCouponDB())
 
     def updateCachedMissingPaperCouponsInfo(self, couponDB: Database):
         paperCouponMapping = {}
-        for couponID in couponDB:
-            coupon = Coupon.load(id=couponID, db=couponDB)
+        for coupon in self.getCouponSnapshot(couponDB).getCoupons():
             if coupon.type == CouponType.PAPER and coupon.isValid():
                 clist = paperCouponMapping.setdefault(coupon.getExpireDateFormatted(), [])
                 clist.append(coupon)
@@ -818,6 +821,27 @@ class BKCrawler:
         if self.cachedMissingPaperCouponsText is not None:
             logging.info(f"Missing paper coupons text: {self.cachedMissingPaperCouponsText}")
 
+    def updateCouponSnapshot(self, couponDB: Database):
+        """ Loads all coupons with one DB request and replaces the current coupon snapshot. """
+        timestampStart = datetime.now().timestamp()
+        coupons = list(iterateDocuments(couponDB, Coupon))
+        self.couponSnapshotVersion += 1
+        self.couponSnapshot = CouponSnapshot(coupons=coupons, version=self.couponSnapshotVersion)
+        self.couponSnapshotIsOutdated = False
+        logging.info(f"Coupon snapshot updated | Version: {self.couponSnapshotVersion} | Coupons: {len(coupons)} | Duration: {getFormattedPassedTime(timestampStart)}")
+
+    def updateCouponSnapshotIfOutdated(self, couponDB: Database):
+        if self.couponSnapshotIsOutdated:
+            self.updateCouponSnapshot(couponDB)
+
+    def getCouponSnapshot(self, couponDB: Union[Database, None] = None) -> CouponSnapshot:
+        """ Returns current coupon snapshot. Only does a DB request if the coupon DB has changed since the last snapshot was built. """
+        if self.couponSnapshot is None or self.couponSnapshotIsOutdated:
+            if couponDB is None:
+                couponDB = self.getCouponDB()
+            self.updateCouponSnapshot(couponDB)
+        return self.couponSnapshot
+
     def getCachedCouponCategory(self, couponSrc: Union[CouponType, int]):
         return self.cachedAvailableCouponCategories.get(couponSrc)
 
@@ -887,6 +911,8 @@ class BKCrawler:
                 newCouponIDs.append(crawledCoupon.id)
         logging.info(f'Pushing {len(dbUpdates)} coupon DB updates')
         couponDB.update(dbUpdates)
+        if len(dbUpdates) > 0:
+            self.couponSnapshotIsOutdated = True
         logging.info("Coupons new: " + str(numberofCouponsNew))
         if len(newCouponIDs) > 0:
             logging.info("New IDs: " + str(newCouponIDs))
@@ -914,9 +940,11 @@ class BKCrawler:
     def updateSimpleHistoryDB(self, couponDB: Database) -> bool:
         dbUpdates = []
         simpleHistoryDB = self.couchdb[DATABASES.COUPONS_HISTORY_SIMPLE]
-        for couponID in couponDB:
-            coupon = Coupon.load(db=couponDB, id=couponID)
-            existingCoupon = Coupon.load(simpleHistoryDB, coupon.id)
+        existingCoupons = {}
+        for existingCoupon in iterateDocuments(simpleHistoryDB, Coupon):
+            existingCoupons[existingCoupon.id] = existingCoupon
+        for coupon in iterateDocuments(couponDB, Coupon):
+            existingCoupon = existingCoupons.get(coupon.id)
             if existingCoupon is None:
                 dbUpdates.append(coupon)
             elif hasChanged(existingCoupon, coupon, ignoreKeys=['_rev']):
@@ -940,6 +968,12 @@ class BKCrawler:
     def getUserDB(self):
         return self.couchdb[DATABASES.TELEGRAM_USERS]
 
+    def getNotificationOutboxDB(self):
+        return self.couchdb[DATABASES.NOTIFICATION_OUTBOX]
+
+    def getNotificationMessagesDB(self):
+        return self.couchdb[DATABASES.NOTIFICATION_MESSAGES]
+
     def getInfoDB(self):
         return self.couchdb[DATABASES.INFO_DB]
 
@@ -949,51 +983,50 @@ class BKCrawler:
         """ Use this to only get the coupons you want.
          Returns all by default."""
         timestampStart = datetime.now().timestamp()
-        couponDB = self.getCouponDB()
-        desiredCoupons = {}
+        couponSnapshot = self.getCouponSnapshot()
         # Log if developer is trying to use incorrect filters
         if couponfilter.isVeggie is False and couponfilter.isPlantBased is True:
             logging.warning(f'Bad filter params: {couponfilter.isVeggie=} and {couponfilter.isPlantBased=}')
-        for uniqueCouponID in couponDB:
-            coupon = Coupon.load(couponDB, uniqueCouponID)
-            if couponfilter.activeOnly and not coupon.isValid():
-                # Skip expired coupons if needed
-                continue
-            elif couponfilter.isNotYetActive is not None and coupon.isNotYetActive() != couponfilter.isNotYetActive:
-                continue
-            elif couponfilter.allowedCouponTypes is not None and coupon.type not in couponfilter.allowedCouponTypes:
-                # Skip non-allowed coupon-types
-                continue
-            elif couponfilter.containsFriesAndCoke is not None and coupon.isContainsFriesAndDrink() != couponfilter.containsFriesAndCoke:
-                # Skip items if they do not have the expected "containsFriesOrCoke" state
-                continue
-            elif couponfilter.isNew is not None and coupon.isNewCoupon() != couponfilter.isNew:
-                # Skip item if it does not have the expected "is_new" state
-                continue
-            elif couponfilter.isHidden is not None and coupon.isHidden != couponfilter.isHidden:
-                continue
-            elif couponfilter.isVeggie is not None and coupon.isVeggie() != couponfilter.isVeggie:
-                continue
-            elif couponfilter.isPlantBased is not None and coupon.isPlantBased() != couponfilter.isPlantBased:
-                continue
-            elif couponfilter.isEatable is not None and coupon.isEatable() != couponfilter.isEatable:
-                continue
-            else:
-                desiredCoupons[uniqueCouponID] = coupon
+        # Resolve filter via bitset index of current snapshot instead of checking each coupon
+        desiredCoupons = couponSnapshot.getFilteredCoupons(couponfilter)
         # Remove duplicates if needed and if it makes sense to attempt that
         if couponfilter.removeDuplicates is True and (
                 couponfilter.allowedCouponTypes is None or (couponfilter.allowedCouponTypes is not None and len(couponfilter.allowedCouponTypes) > 1)):
-            desiredCoupons = removeDuplicatedCoupons(desiredCoupons)
+            desiredCoupons = couponSnapshot.removeDuplicatedCoupons(desiredCoupons)
         # Now check if the result shall be sorted
         if couponfilter.sortCode is not None and sortIfSortCodeIsGivenInCouponFilter:
             # Sort coupons: Separate by type and sort each by coupons with/without menu and price.
             # Make dict out of list
-            filteredAndSortedCouponsDict = sortCoupons(desiredCoupons, couponfilter.sortCode)
+            filteredAndSortedCouponsDict = couponSnapshot.sortCoupons(desiredCoupons, couponfilter.sortCode)
             logging.debug("Time it took to get- and sort coupons: " + getFormattedPassedTime(timestampStart))
             return filteredAndSortedCouponsDict
         else:
             return desiredCoupons
 
+    def getCachedCouponList(self, couponfilter: CouponFilter, sortMode: CouponSortMode, title: Union[str, None] = None) -> Tuple[List[str], CouponCategory]:
+        """ Returns IDs of all coupons matching given filter in given sort order plus a CouponCategory containing these coupons.
+         Results are cached until the coupon snapshot changes or any coupon becomes valid/expired/new. """
+        couponSnapshot = self.getCouponSnapshot()
+        cacheKey = (couponfilter.getCacheKey(), sortMode.getSortCode(), title, couponSnapshot.version, couponSnapshot.getNextTimeBoundary())
+        cachedCouponList = self.couponListCache.get(cacheKey)
+        if cachedCouponList is not None:
+            self.couponListCacheHits += 1
+            self.couponListCache.move_to_end(cacheKey)
+            return cachedCouponList
+        self.couponListCacheMisses += 1
+        coupons = self.getFilteredCouponsAsDict(couponfilter, sortIfSortCodeIsGivenInCouponFilter=False)
+        couponsSorted = couponSnapshot.sortCouponsAsList(coupons, sortMode)
+        cachedCouponList = ([coupon.id for coupon in couponsSorted], CouponCategory(couponsSorted, title=title))
+        self.couponListCache[cacheKey] = cachedCouponList
+        if len(self.couponListCache) > MAX_CACHED_COUPON_LISTS:
+            self.couponListCache.popitem(last=False)
+        return cachedCouponList
+
+    def getCouponListCacheStatsText(self) -> str:
+        numberofRequests = self.couponListCacheHits + self.couponListCacheMisses
+        hitRate = 0 if numberofRequests == 0 else self.couponListCacheHits / numberofRequests * 100
+        return f'{self.couponListCacheHits} Hits | {self.couponListCacheMisses} Misses | {hitRate:.0f}% | {len(self.couponListCache)}/{MAX_CACHED_COUPON_LISTS} Einträge'
+
     def getFilteredCouponsAsList(
             self, filters: CouponFilter, sortIfSortCodeIsGivenInCouponFilter: bool = True
     ) -> List[Coupon]:
@@ -1014,31 +1047,13 @@ class BKCrawler:
                 offers.append(offer)
         return offers
 
-    async def downloadImageIfNonExistant(self, coupon: Coupon) -> bool:
-        url = coupon.imageURL
-        path = coupon.getImagePath()
-        if url is None or path is None:
-            return False
-        elif os.path.exists(path):
-            # Image already exists
-            return False
-        try:
-            logging.info('Downloading image to: ' + path)
-            response = await self.browser.get(url, follow_redirects=True)
-            with open(path, mode='wb') as file:
-                file.write(response.content)
-
-            # Check for broken image and delete it if broken
-            # TODO: Solve this in a more elegant way so we do not even write/store broken image files in the first place(?!).
-            if isValidImageFile(path):
-                return True
-            else:
-                logging.warning("Image is broken: Deleting broken image: " + path)
-                os.remove(path)
-                return False
-        except Exception as e:
-            logging.warning(f"Image download failed: {url} - {str(e)}")
-            return False
+
+def getCouponsFingerprint(coupons: Iterable[Coupon]) -> str:
+    """ Returns hash of the data of given coupons which does not depend on the order of the coupons or their fields. """
+    hasher = hashlib.sha256()
+    for coupon in sorted(coupons, key=lambda c: c.id):
+        hasher.update(json.dumps(dict(coupon.items()), sort_keys=True, default=str).encode('utf-8'))
+    return hasher.hexdigest()
 
 
 def getCouponByID(coupons: List[Coupon], couponID: str) -> Union[Coupon, None]:
@@ -1064,22 +1079,6 @@ def hasChanged(originalData, newData, ignoreKeys=None) -> bool:
     return False
 
 
-def generateQRImageIfNonExistant(qrCodeData: str, path: str) -> bool:
-    if os.path.exists(path):
-        # Image already exists
-        return False
-    qr = qrcode.QRCode(
-        version=1,
-        # 2021-05-02: This makes the image itself bigger but due to the border and the resize of Telegram, these QR codes might be suited better for usage in Telegram
-        border=10
-    )
-    qr.add_data(qrCodeData)
-    """ 2021-01-25: Use the same color they're using in their app. """
-    img = qr.make_image(fill_color="#4A1E0D", back_color="white")
-    img.save(path)
-    return True
-
-
 def getLogSeparatorString() -> str:
     return '**************************'
 
@@ -1093,5 +1092,8 @@ if __name__ == '__main__':
     # crawler.setExportCSVs(True)
     # crawler.setCrawlOnlyBotCompatibleCoupons(False)
     print("Number of userIDs in DB: " + str(len(crawler.getUserDB())))
-    asyncio.run(crawler.crawlAndProcessData())
+    try:
+        asyncio.run(crawler.crawlAndProcessData())
+    finally:
+        crawler.qrRenderer.shutdown()
     print("Crawler done!")
@@ -0,0 +1,72 @@
+import unittest
+from datetime import datetime, timedelta
+
+from Crawler import BKCrawler
+from Helper import CouponType
+from UtilsCouponsDB import Coupon
+
+""" Checks coupon processing of the crawler without a CouchDB server. Run with 'python -m unittest CrawlerTest'. """
+
+
+class Row:
+
+    def __init__(self, doc: dict):
+        self.id = doc['_id']
+        self.doc = doc
+
+
+class MemoryCouponDB:
+    """ Minimal in-memory replacement for the few couchdb.Database methods used by processCrawledCoupons. """
+
+    def __init__(self, coupons: list):
+        self.docs = {coupon.id: dict(coupon.items()) for coupon in coupons}
+        self.purgedIDs = []
+
+    def iterview(self, name: str, batch: int, **options):
+        return [Row(doc) for doc in list(self.docs.values())]
+
+    def purge(self, docs):
+        for doc in docs:
+            self.purgedIDs.append(doc.id)
+            del self.docs[doc.id]
+
+    def __len__(self):
+        return len(self.docs)
+
+
+def createCoupon(couponID: str, title: str, daysValid: int = 7, price: int = 499, priceCompare: int = None, imageURL: str = None) -> Coupon:
+    return Coupon(id=couponID, uniqueID=couponID, plu=couponID, title=title, type=CouponType.APP, price=price, priceCompare=priceCompare, imageURL=imageURL,
+                  timestampExpire=(datetime.now() + timedelta(days=daysValid)).timestamp())
+
+
+class ProcessCrawledCouponsTest(unittest.TestCase):
+
+    def setUp(self):
+        # Skip __init__ as it connects to the DB
+        self.crawler = BKCrawler.__new__(BKCrawler)
+        self.crawler.couponSnapshotIsOutdated = False
+        self.addedCoupons = {}
+        self.crawler.addCouponsToDB = lambda couponDB, couponsToAddToDB: self.addedCoupons.update(couponsToAddToDB)
+        self.crawler.updateCouponSnapshotIfOutdated = lambda couponDB: None
+
+    def test_duplicates(self):
+        crawledCouponsDict = {}
+        for coupon in [createCoupon('1', 'Long Chicken®', priceCompare=699, imageURL='https://example.com/1.png'),
+                       createCoupon('2', 'Long Chicken', price=399),
+                       createCoupon('3', 'Whopper'),
+                       createCoupon('4', 'Expired Whopper', daysValid=-1)]:
+            crawledCouponsDict[coupon.id] = coupon
+        couponDB = MemoryCouponDB([createCoupon('3', 'Whopper'), createCoupon('4', 'Expired Whopper'), createCoupon('5', 'Gone')])
+        self.crawler.getCouponDB = lambda: couponDB
+        self.crawler.processCrawledCoupons(crawledCouponsDict)
+        self.assertEqual(sorted(self.addedCoupons.keys()), ['1', '2', '3'])
+        # Extra data of duplicates gets shared
+        self.assertEqual(crawledCouponsDict['2'].priceCompare, 699)
+        self.assertEqual(crawledCouponsDict['2'].imageURL, 'https://example.com/1.png')
+        self.assertEqual(crawledCouponsDict['1'].title, 'Long Chicken')
+        self.assertEqual(sorted(couponDB.purgedIDs), ['4', '5'])
+        self.assertTrue(self.crawler.couponSnapshotIsOutdated)
+
+
+if __name__ == '__main__':
+    unittest.main()
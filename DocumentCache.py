@@ -0,0 +1,88 @@
+import logging
+from collections import OrderedDict
+from typing import Union, Callable
+
+from couchdb import Database, ResourceConflict
+from couchdb.mapping import Document
+
+from DocumentWriteBuffer import mergeIntoLatestRevision, MAX_CONFLICT_RETRIES
+
+
+class DocumentCache:
+    """ Bounded LRU cache of recently used documents e.g. users who are currently clicking through the bot menus.
+     Cached documents carry their _rev so writes going through 'store' keep the cached instance up-to-date.
+     If a write fails due to a _rev conflict (document has been changed elsewhere), our changes get merged into the latest revision.
+     If that is not possible, the latest revision gets reloaded.
+     <onDocumentStored> gets called with every document whose DB state is known after 'store' e.g. to keep indexes up-to-date. """
+
+    def __init__(self, db: Database, documentClass, maxSize: int = 1000, onDocumentStored: Callable[[Document], None] = None):
+        self.db = db
+        self.onDocumentStored = onDocumentStored
+        self.documentClass = documentClass
+        self.maxSize = maxSize
+        self.documents = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, docID: str) -> Union[Document, None]:
+        """ Returns cached document without loading it from DB. """
+        doc = self.documents.get(docID)
+        if doc is not None:
+            self.documents.move_to_end(docID)
+        return doc
+
+    def load(self, docID: str) -> Union[Document, None]:
+        """ Returns document from cache or DB. """
+        doc = self.get(docID)
+        if doc is not None:
+            self.hits += 1
+            return doc
+        self.misses += 1
+        doc = self.documentClass.load(self.db, docID)
+        if doc is not None:
+            self.put(doc)
+        return doc
+
+    def put(self, doc: Document):
+        self.documents[doc.id] = doc
+        self.documents.move_to_end(doc.id)
+        while len(self.documents) > self.maxSize:
+            self.documents.popitem(last=False)
+
+    def putIfCached(self, doc: Document):
+        """ Replaces cached instance of given document e.g. after it has been written elsewhere. Does not add new documents so bulk writes don't evict recently used ones. """
+        if doc.id in self.documents:
+            self.documents[doc.id] = doc
+
+    def store(self, doc: Document) -> bool:
+        """ Writes document to DB and keeps it in cache. Returns False if our changes had to be dropped due to a conflict. """
+        for retryNumber in range(MAX_CONFLICT_RETRIES + 1):
+            try:
+                doc.store(self.db)
+            except ResourceConflict:
+                logging.info(f'Conflict while storing document {doc.id} -> Merging changes into latest revision | Try number: {retryNumber + 1}')
+                if not mergeIntoLatestRevision(self.db, doc):
+                    break
+                continue
+            self.put(doc)
+            self.documentStored(doc)
+            return True
+        logging.warning(f'Failed to store document {doc.id} -> Dropping changes and reloading latest revision')
+        self.invalidate(doc.id)
+        latestDoc = self.load(doc.id)
+        if latestDoc is not None:
+            doc._data.clear()
+            doc._data.update(latestDoc._data)
+            self.put(doc)
+            self.documentStored(doc)
+        return False
+
+    def documentStored(self, doc: Document):
+        if self.onDocumentStored is not None:
+            self.onDocumentStored(doc)
+
+    def invalidate(self, docID: str):
+        self.documents.pop(docID, None)
+
+    def getStatsText(self) -> str:
+        return f'{len(self.documents)}/{self.maxSize} | Hits: {self.hits} | Misses: {self.misses}'
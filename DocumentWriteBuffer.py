@@ -0,0 +1,154 @@
+import logging
+import time
+from typing import Union, List, Callable
+
+from couchdb import Database, ResourceConflict
+from couchdb.mapping import Document
+
+from Helper import DB_BULK_PAGE_SIZE
+
+""" How often we try to merge our changes into the latest revision of a document before we give up. """
+MAX_CONFLICT_RETRIES = 3
+""" How many flushes a document which could not be written stays in the buffer before its changes get dropped e.g. because it has been deleted. """
+MAX_FAILED_FLUSHES = 3
+
+
+def mergeIntoLatestRevision(db: Database, doc: Document) -> bool:
+    """ Applies all fields we've changed compared to the revision our document is based on to the latest revision of it.
+     Returns False if that is not possible e.g. because the document has been deleted in the meantime. """
+    latestData = db.get(doc.id)
+    if latestData is None:
+        logging.info(f'Document {doc.id} has been deleted in the meantime -> Dropping changes')
+        return False
+    baseData = db.get(doc.id, rev=doc.rev) if doc.rev is not None else None
+    if baseData is None:
+        # Base revision is gone e.g. due to DB compaction -> We can't tell which fields we've changed
+        logging.warning(f'Base revision {doc.rev} of document {doc.id} is not available anymore -> Dropping changes')
+        return False
+    ourData = dict(doc.items())
+    for key, value in ourData.items():
+        if not key.startswith('_') and baseData.get(key) != value:
+            latestData[key] = value
+    for key in baseData:
+        if not key.startswith('_') and key not in ourData:
+            latestData.pop(key, None)
+    doc._data.clear()
+    doc._data.update(latestData)
+    return True
+
+
+class DocumentWriteBuffer:
+    """ Collects changed documents (e.g. users whose notification timestamp has changed) and writes them via one '_bulk_docs' request per <maxBufferedDocuments>
+     documents instead of one request per document.
+     Gets flushed as soon as it contains <maxBufferedDocuments> documents or the oldest change is older than <maxSecondsBuffered> seconds (see flushIfDue).
+     On _rev conflicts, only the fields we've changed get merged into the latest revision of the document.
+     Documents which could not be written stay in the buffer and will be retried with the next flushes.
+     Use <onDocumentWritten> and <onDocumentDropped> to keep caches of the same documents up-to-date. """
+
+    def __init__(self, db: Database, maxBufferedDocuments: int = DB_BULK_PAGE_SIZE, maxSecondsBuffered: float = 10,
+                 onDocumentWritten: Callable[[Document], None] = None, onDocumentDropped: Callable[[str], None] = None):
+        self.db = db
+        self.onDocumentWritten = onDocumentWritten
+        self.onDocumentDropped = onDocumentDropped
+        self.maxBufferedDocuments = maxBufferedDocuments
+        self.maxSecondsBuffered = maxSecondsBuffered
+        self.documents = {}
+        self.timestampOldestChange = None
+        self.numberofFlushes = 0
+        self.numberofWrittenDocuments = 0
+        self.numberofFailedDocuments = 0
+        # docID -> Number of flushes this document could not be written in a row
+        self.failedFlushCounts = {}
+
+    def add(self, doc: Document):
+        """ Marks document as changed. It will be written with the next flush. """
+        bufferedDoc = self.documents.get(doc.id)
+        if bufferedDoc is not None and bufferedDoc is not doc:
+            # Another instance of the same document: Write the buffered one first so none of the changes get lost
+            del self.documents[doc.id]
+            for failedDoc in self.writeDocuments([bufferedDoc]):
+                # We can't keep both instances -> Changes of the older one are lost
+                self.numberofFailedDocuments += 1
+                logging.warning(f'Failed to write buffered instance of document {failedDoc.id} -> Dropping its changes')
+                self.documentDropped(failedDoc.id)
+        self.documents[doc.id] = doc
+        if self.timestampOldestChange is None:
+            self.timestampOldestChange = time.monotonic()
+        self.flushIfDue()
+
+    def get(self, docID: str) -> Union[Document, None]:
+        """ Returns the buffered instance of a document with pending changes so callers don't work on an outdated version of it. """
+        return self.documents.get(docID)
+
+    def isFlushDue(self) -> bool:
+        if len(self.documents) >= self.maxBufferedDocuments:
+            return True
+        return self.timestampOldestChange is not None and time.monotonic() - self.timestampOldestChange >= self.maxSecondsBuffered
+
+    def flushIfDue(self):
+        if self.isFlushDue():
+            self.flush()
+
+    def flush(self) -> List[Document]:
+        """ Writes all buffered documents. Returns all documents which could not be written. """
+        if len(self.documents) == 0:
+            return []
+        docs = list(self.documents.values())
+        self.documents.clear()
+        self.timestampOldestChange = None
+        failedDocs = self.writeDocuments(docs)
+        self.numberofFlushes += 1
+        self.numberofFailedDocuments += len(failedDocs)
+        for doc in failedDocs:
+            numberofFailedFlushes = self.failedFlushCounts.get(doc.id, 0) + 1
+            if numberofFailedFlushes >= MAX_FAILED_FLUSHES:
+                logging.warning(f'Failed to write document {doc.id} in {numberofFailedFlushes} flushes -> Dropping its changes')
+                del self.failedFlushCounts[doc.id]
+                self.documentDropped(doc.id)
+                continue
+            self.failedFlushCounts[doc.id] = numberofFailedFlushes
+            if doc.id not in self.documents:
+                # Retry with next flush
+                self.documents[doc.id] = doc
+                if self.timestampOldestChange is None:
+                    self.timestampOldestChange = time.monotonic()
+        logging.debug(f'Flushed {len(docs) - len(failedDocs)}/{len(docs)} documents to DB {self.db.name}')
+        return failedDocs
+
+    def documentDropped(self, docID: str):
+        if self.onDocumentDropped is not None:
+            self.onDocumentDropped(docID)
+
+    def writeDocuments(self, docs: List[Document]) -> List[Document]:
+        """ Writes given documents right away. Returns all documents which could not be written. """
+        failedDocs = []
+        for retryNumber in range(MAX_CONFLICT_RETRIES + 1):
+            conflictedDocs = []
+            for index in range(0, len(docs), DB_BULK_PAGE_SIZE):
+                page = docs[index:index + DB_BULK_PAGE_SIZE]
+                for doc, (success, docID, revOrException) in zip(page, self.db.update(page)):
+                    if success:
+                        # db.update only updates the revision of plain dicts
+                        doc._data['_rev'] = revOrException
+                        self.numberofWrittenDocuments += 1
+                        self.failedFlushCounts.pop(doc.id, None)
+                        if self.onDocumentWritten is not None:
+                            self.onDocumentWritten(doc)
+                    elif isinstance(revOrException, ResourceConflict):
+                        conflictedDocs.append(doc)
+                    else:
+                        logging.warning(f'Failed to write document {docID}: {revOrException}')
+                        failedDocs.append(doc)
+            if len(conflictedDocs) == 0:
+                return failedDocs
+            logging.info(f'Merging {len(conflictedDocs)} conflicted documents | Try number: {retryNumber + 1}')
+            docs = []
+            for doc in conflictedDocs:
+                if mergeIntoLatestRevision(self.db, doc):
+                    docs.append(doc)
+                else:
+                    failedDocs.append(doc)
+        if len(docs) > 0:
+            logging.warning(f'Giving up on {len(docs)} documents which still had conflicts after {MAX_CONFLICT_RETRIES} retries: {[doc.id for doc in docs]}')
+            failedDocs += docs
+        return failedDocs
@@ -0,0 +1,84 @@
+import logging
+from typing import Iterable, Set
+
+from UtilsCouponsDB import Coupon
+
+
+class FavoritesIndex:
+    """ Inverted index of users' favorite coupons: Coupon ID -> user IDs and normalized coupon title -> user IDs.
+     Gets updated via 'updateUser' whenever a user document has been written to DB so it always matches the DB and can be rebuilt from scratch from the users DB.
+     As long as it hasn't been built, callers are supposed to fall back to looking at all users. """
+
+    def __init__(self):
+        self.userIDsByCouponID = {}
+        self.userIDsByNormalizedTitle = {}
+        # userID -> {couponID: normalizedTitle} so we know what to remove again
+        self.favoritesByUserID = {}
+        self.isBuilt = False
+
+    def add(self, userID: str, couponID: str, normalizedTitle: str):
+        self.remove(userID, couponID)
+        self.favoritesByUserID.setdefault(userID, {})[couponID] = normalizedTitle
+        self.userIDsByCouponID.setdefault(couponID, set()).add(userID)
+        if normalizedTitle is not None:
+            self.userIDsByNormalizedTitle.setdefault(normalizedTitle, set()).add(userID)
+
+    def remove(self, userID: str, couponID: str):
+        userFavorites = self.favoritesByUserID.get(userID)
+        if userFavorites is None or couponID not in userFavorites:
+            return
+        normalizedTitle = userFavorites.pop(couponID)
+        if len(userFavorites) == 0:
+            del self.favoritesByUserID[userID]
+        self.discardUserID(self.userIDsByCouponID, couponID, userID)
+        if normalizedTitle is not None and normalizedTitle not in userFavorites.values():
+            # Only remove title mapping if user has no other favorite with the same title
+            self.discardUserID(self.userIDsByNormalizedTitle, normalizedTitle, userID)
+
+    def removeUser(self, userID: str):
+        for couponID in list(self.favoritesByUserID.get(userID, {})):
+            self.remove(userID, couponID)
+
+    def updateUser(self, user):
+        """ Applies current favorites of given User object e.g. after it has been written to DB. """
+        indexedCouponIDs = self.favoritesByUserID.get(user.id, {})
+        for couponID in [couponID for couponID in indexedCouponIDs if couponID not in user.favoriteCoupons]:
+            self.remove(user.id, couponID)
+        for couponID, couponData in user.favoriteCoupons.items():
+            if couponID not in indexedCouponIDs:
+                self.add(user.id, couponID, Coupon.wrap(couponData).getNormalizedTitle())
+
+    @staticmethod
+    def discardUserID(mapping: dict, key: str, userID: str):
+        userIDs = mapping.get(key)
+        if userIDs is not None:
+            userIDs.discard(userID)
+            if len(userIDs) == 0:
+                del mapping[key]
+
+    def rebuild(self, users: Iterable):
+        """ Builds index from scratch based on given User objects e.g. all users in DB. """
+        self.userIDsByCouponID = {}
+        self.userIDsByNormalizedTitle = {}
+        self.favoritesByUserID = {}
+        for user in users:
+            for couponID, couponData in user.favoriteCoupons.items():
+                self.add(user.id, couponID, Coupon.wrap(couponData).getNormalizedTitle())
+        self.isBuilt = True
+        logging.info(f'Built favorites index | Users with favorites: {len(self.favoritesByUserID)} | Coupon IDs: {len(self.userIDsByCouponID)} | Titles: {len(self.userIDsByNormalizedTitle)}')
+
+    def getUserIDsByCouponIDs(self, couponIDs: Iterable[str]) -> Set[str]:
+        userIDs = set()
+        for couponID in couponIDs:
+            userIDs.update(self.userIDsByCouponID.get(couponID, ()))
+        return userIDs
+
+    def getUserIDsByNormalizedTitles(self, normalizedTitles: Iterable[str]) -> Set[str]:
+        userIDs = set()
+        for normalizedTitle in normalizedTitles:
+            userIDs.update(self.userIDsByNormalizedTitle.get(normalizedTitle, ()))
+        return userIDs
+
+    def getFavoriteCouponIDs(self) -> Set[str]:
+        """ Returns IDs of all coupons which are favorites of at least one user. """
+        return set(self.userIDsByCouponID.keys())
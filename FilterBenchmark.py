@@ -0,0 +1,85 @@
+import glob
+import json
+import random
+import time
+
+from CouponSnapshot import CouponSnapshot
+from Helper import CouponType, getCurrentDate
+from UtilsCouponsDB import Coupon, getAllCouponViews
+
+""" Script to measure CouponFilter latency of the snapshot bitset index vs. checking each coupon one by one.
+ Uses synthetic coupons based on the titles in paper_coupon_data/*.json. """
+
+COUPON_AMOUNTS = [1000, 10000]
+ROUNDS = 20
+
+
+def filterCouponsLegacy(coupons: dict, couponfilter) -> dict:
+    """ Old per-coupon implementation of getFilteredCouponsAsDict without dedup/sorting. """
+    desiredCoupons = {}
+    for uniqueCouponID, coupon in coupons.items():
+        if couponfilter.activeOnly and not coupon.isValid():
+            continue
+        elif couponfilter.isNotYetActive is not None and coupon.isNotYetActive() != couponfilter.isNotYetActive:
+            continue
+        elif couponfilter.allowedCouponTypes is not None and coupon.type not in couponfilter.allowedCouponTypes:
+            continue
+        elif couponfilter.containsFriesAndCoke is not None and coupon.isContainsFriesAndDrink() != couponfilter.containsFriesAndCoke:
+            continue
+        elif couponfilter.isNew is not None and coupon.isNewCoupon() != couponfilter.isNew:
+            continue
+        elif couponfilter.isHidden is not None and coupon.isHidden != couponfilter.isHidden:
+            continue
+        elif couponfilter.isVeggie is not None and coupon.isVeggie() != couponfilter.isVeggie:
+            continue
+        elif couponfilter.isPlantBased is not None and coupon.isPlantBased() != couponfilter.isPlantBased:
+            continue
+        elif couponfilter.isEatable is not None and coupon.isEatable() != couponfilter.isEatable:
+            continue
+        else:
+            desiredCoupons[uniqueCouponID] = coupon
+    return desiredCoupons
+
+
+def createSyntheticCoupons(amount: int) -> list:
+    titles = []
+    for path in sorted(glob.glob('paper_coupon_data/*.json')):
+        with open(path, encoding='utf-8') as infile:
+            titles += [entry['title'] for entry in json.load(infile)]
+    rand = random.Random(amount)
+    now = getCurrentDate().timestamp()
+    coupons = []
+    for index in range(amount):
+        timestampStart = rand.choice([0, now - 3 * 86400, now - 3600, now + 86400])
+        coupons.append(Coupon(id=str(10000 + index), uniqueID=str(10000 + index), plu=str(index), title=rand.choice(titles), price=rand.randint(99, 1999),
+                              type=rand.choice([CouponType.APP, CouponType.PAPER, CouponType.PAYBACK]), isHidden=rand.random() < 0.1,
+                              timestampStart=timestampStart, timestampExpire=now + rand.choice([-86400, 3600, 7 * 86400]),
+                              timestampAddedToDB=now - rand.choice([3600, 7 * 86400])))
+    return coupons
+
+
+def main():
+    couponfilters = [view.couponfilter for view in getAllCouponViews()]
+    for amount in COUPON_AMOUNTS:
+        coupons = createSyntheticCoupons(amount)
+        timestampStart = time.time()
+        snapshot = CouponSnapshot(coupons, version=1)
+        print(f'{amount} coupons: Building snapshot index took {(time.time() - timestampStart) * 1000:.1f}ms')
+        for couponfilter in couponfilters:
+            # Check that the index returns exactly the same coupons in the same order
+            assert list(snapshot.getFilteredCoupons(couponfilter)) == list(filterCouponsLegacy(snapshot.coupons, couponfilter))
+        timestampStart = time.time()
+        for i in range(ROUNDS):
+            for couponfilter in couponfilters:
+                filterCouponsLegacy(snapshot.coupons, couponfilter)
+        durationLegacy = (time.time() - timestampStart) * 1000 / (ROUNDS * len(couponfilters))
+        timestampStart = time.time()
+        for i in range(ROUNDS):
+            for couponfilter in couponfilters:
+                snapshot.getFilteredCoupons(couponfilter)
+        durationIndex = (time.time() - timestampStart) * 1000 / (ROUNDS * len(couponfilters))
+        print(f'{amount} coupons: Per coupon: {durationLegacy:.2f}ms | Index: {durationIndex:.2f}ms per filter')
+
+
+if __name__ == '__main__':
+    main()
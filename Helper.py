@@ -2,6 +2,8 @@ import os
 import random
 import re
 from datetime import datetime, timedelta
+from functools import lru_cache
+from io import BytesIO
 from typing import Union
 
 import pytz
@@ -21,6 +23,8 @@ class DATABASES:
     PRODUCTS2_HISTORY = 'products2_history'
     TELEGRAM_USERS = 'telegram_users'
     TELEGRAM_CHANNEL = 'telegram_channel'
+    NOTIFICATION_OUTBOX = 'notification_outbox'
+    NOTIFICATION_MESSAGES = 'notification_messages'
 
 
 class HISTORYDB:
@@ -47,6 +51,34 @@ def saveJson(path: str, data: Union[list, dict]):
         json.dump(data, f, indent=4, sort_keys=True)
 
 
+DB_BULK_PAGE_SIZE = 500
+
+
+def iterateDocuments(db, documentClass, pageSize: int = DB_BULK_PAGE_SIZE):
+    """ Yields all documents of given DB as objects of given couchdb Document class e.g. Coupon, User or ChannelCoupon.
+     Uses paged '_all_docs?include_docs=true' requests so a full DB pass costs one request per <pageSize> documents instead of one request per document. """
+    for row in db.iterview('_all_docs', pageSize, include_docs=True):
+        if row.id.startswith('_design/'):
+            # Skip views/indexes
+            continue
+        yield documentClass.wrap(row.doc)
+
+
+def iterateViewDocuments(db, documentClass, viewName: str, pageSize: int = DB_BULK_PAGE_SIZE, **options):
+    """ Yields documents of all rows of given view e.g. for a key range given via startkey/endkey as objects of given couchdb Document class. """
+    for row in db.iterview(viewName, pageSize, include_docs=True, **options):
+        yield documentClass.wrap(row.doc)
+
+
+def iterateDocumentsByIDs(db, documentClass, docIDs, pageSize: int = DB_BULK_PAGE_SIZE):
+    """ Yields documents with given IDs as objects of given couchdb Document class using paged '_all_docs' requests. IDs of non-existent documents are skipped. """
+    docIDs = list(docIDs)
+    for index in range(0, len(docIDs), pageSize):
+        for row in db.view('_all_docs', keys=docIDs[index:index + pageSize], include_docs=True):
+            if row.doc is not None:
+                yield documentClass.wrap(row.doc)
+
+
 def couponOrOfferGetImageURL(data: dict) -> str:
     """ Only for new API objects (coupons and offers)! Chooses lowest resolution to save traffic (Some URLs have a fixed resolution. In this case we cannot change it.) """
     image_url = data['image_url']
@@ -76,78 +108,42 @@ def splitStringInPairs(string: str) -> str:
     return splitString
 
 
+@lru_cache(maxsize=4096)
 def shortenProductNames(couponTitle: str) -> str:
     """ Cleans up coupon titles to make them shorter so they hopefully fit in the length of one button.
      E.g. "Long Chicken + Crispy Chicken + mittlere KING Pommes + 0,4 L Coca-Cola" -> "LngChn+CrispyCkn+M🍟+0,4LCola"
+     Applies all rules of PRODUCT_TITLE_REPLACEMENT_RULES in order. Results are cached as the same titles come in over and over again.
      """
-    """ Let's start with fixing the fries -> Using an emoji as replacement really shortens product titles with fries! """
     couponTitle = sanitizeCouponTitle(couponTitle)
-    pommesReplacement = SYMBOLS.FRIES
-    # Fries replacements
-    couponTitle = re.sub(r"kleine(\s*KING)?\s*Pommes", "S" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"mittlere(\s*KING)?\s*Pommes", "M" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"große(\s*KING)?\s*Pommes", "L" + pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"KING\s*(Pommes)", pommesReplacement, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Fries", pommesReplacement, couponTitle, flags=re.IGNORECASE)  # E.g. 'Curly Fries'
-    couponTitle = re.sub(r"(Coca[\s-]*)?Cola", SYMBOLS.COLA, couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Big KING", r"BigK", couponTitle, flags=re.IGNORECASE)
-    """ Remove "KING" from some product titles """
-    couponTitle = re.sub(r"(Bacon|Fish|Halloumi)\s*KING", r"\1", couponTitle, flags=re.IGNORECASE)
-    """ E.g. "KING Shake" --> "Shake" """
-    couponTitle = re.sub(r"KING\s*(Jr\.?\s*Meal|Jr\.?\s*Menü|Shake|Sundae|Nuggets?|Wings?|Onion[\s-]*Rings?)", r"\1", couponTitle, flags=re.IGNORECASE)
-    """ 'Meta' replaces """
-    # Normalize- and fix drink unit e.g. "0,3 L" or "0.3l" to "0.3" (remove unit character to save even more space)
-    couponTitle = re.sub(r"(0[.,]\d{1,2})\s*L", r"\1", couponTitle, flags=re.IGNORECASE)
-    # Normalize 'nugget unit e.g. "6er KING Nuggets" -> "6 KING Nuggets"
-    couponTitle = re.sub(r"(\d{1,2})er\s*", r"\1", couponTitle, flags=re.IGNORECASE)
-    # E.g. "2x Crispy Chicken" --> 2 Crispy Chicken
-    couponTitle = re.sub(r"((\d+)[Xx] )([A-Za-z]+)", r"\2 \3", couponTitle, flags=re.IGNORECASE)
-    # "Chicken Nuggets" -> "Nuggets"
-    couponTitle = re.sub(r"Chicken\s*(Nuggets)", r"\1", couponTitle, flags=re.IGNORECASE)
-    # 2024-06-15: Fix "fan bundle"
-    couponTitle = re.sub(r"(Kleines?|Großes?)\s*(Plant[\w-]*)?\s*Fan\s*Bundle\s*", "", couponTitle, flags=re.IGNORECASE)
-    # 2024-06-29
-    couponTitle = re.sub(r"Wähle\s* zwischen\s*", "", couponTitle, flags=re.IGNORECASE)
-
-    # Cheeseburger -> Cheesebrgr
-    couponTitle = re.sub(r"(b)urger", r"\1rgr", couponTitle, flags=re.IGNORECASE)
-    # Assume that all users know that "Cheddar" is cheese so let's remove this double entry
-    couponTitle = re.sub(r"Cheddar\s*Cheese", "Cheddar", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Chicken", "Ckn", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Chili[\s-]*Cheese", "CC", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Deluxe", "Dlx", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Dips", "Dip", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Double", "Dbl", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Long", "Lng", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Nuggets?", "Nug", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Plant[\s-]*Based", "Plnt", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Tripp?le", "Trple", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Veggie", "Veg", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Whopper", "Wppr", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Steakhouse", "SteakH", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"X[\s-]*tra", "Xtra", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Onion[\s-]*Rings", "Rings", couponTitle, flags=re.IGNORECASE)
-
-    """ Down below comes other bullshit they sometimes place into the subtitle fields. """
-    couponTitle = re.sub(r"\s*oder\s*", r",", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"\s*zum\s*Preis\s*von\s*(1!?|einem|einer)(\s*Portion)?", "", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"^.{0,3}?Den Code zur Einlösung findest du im QR-Code.*", "", couponTitle, flags=re.IGNORECASE)
-    # Remove e.g. "Im KING Menü (+ 50 Cent)"
-    couponTitle = re.sub(r"Im King Menü \(\+[^)]+\)", "", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r" mit ", "&", couponTitle, flags=re.IGNORECASE)
-    couponTitle = re.sub(r"Jr\s*\.", "Jr", couponTitle, flags=re.IGNORECASE)
-    # e.g. 0,5 l King Shake® Schoko, Erdbeer- oder Vanillegeschmack
-    couponTitle = re.sub(r"\s*Geschmack", "", couponTitle, flags=re.IGNORECASE)
-    # Do some more basic replacements
-    couponTitle = re.sub(r"\s+und\s+", ",", couponTitle, flags=re.IGNORECASE)
-    couponTitle = couponTitle.replace(' ', '')
+    for regex, replacement in COMPILED_PRODUCT_TITLE_REPLACEMENT_RULES:
+        couponTitle = regex.sub(replacement, couponTitle)
     # E.g. "...Chili-Cheese"
-    couponTitle = couponTitle.replace('-', '')
+    couponTitle = couponTitle.replace(' ', '').replace('-', '')
     # Replace point at the end as they sometimes use whole sentences in coupon titles
-    couponTitle = re.sub(r"\.$", "", couponTitle, flags=re.IGNORECASE)
+    couponTitle = PRODUCT_TITLE_TRAILING_POINT_REGEX.sub("", couponTitle)
     return couponTitle
 
 
+def compileProductTitleReplacementRules(rules: list) -> list:
+    """ Compiles rule table entries to (regex, replacement) pairs.
+     Entries can be a single (pattern, replacement) tuple or a list of such tuples with constant replacements which do not interfere with each other.
+     The latter get fused into one alternation so they can be applied in a single pass over the title. """
+    compiledRules = []
+    for rule in rules:
+        if isinstance(rule, tuple):
+            pattern, replacement = rule
+            compiledRules.append((re.compile(pattern, flags=re.IGNORECASE), replacement))
+        else:
+            replacements = {}
+            alternatives = []
+            for index, (pattern, replacement) in enumerate(rule):
+                groupName = f'rule{index}'
+                replacements[groupName] = replacement
+                alternatives.append(f'(?P<{groupName}>{pattern})')
+            compiledRules.append((re.compile('|'.join(alternatives), flags=re.IGNORECASE), lambda match, replacements=replacements: replacements[match.lastgroup]))
+    return compiledRules
+
+
 def sanitizeCouponTitle(couponTitle: str) -> str:
     """ Generic method which sanitizes strings and removes unneeded symbols such as trademark symbols. """
     couponTitle = couponTitle.replace('®', '')
@@ -247,6 +243,75 @@ class SYMBOLS:
     # SOON = '🔜'
 
 
+""" Rules for shortenProductNames in the order in which they get applied. """
+PRODUCT_TITLE_REPLACEMENT_RULES = [
+    # Let's start with fixing the fries -> Using an emoji as replacement really shortens product titles with fries!
+    (r"kleine(\s*KING)?\s*Pommes", "S" + SYMBOLS.FRIES),
+    (r"mittlere(\s*KING)?\s*Pommes", "M" + SYMBOLS.FRIES),
+    (r"große(\s*KING)?\s*Pommes", "L" + SYMBOLS.FRIES),
+    (r"KING\s*(Pommes)", SYMBOLS.FRIES),
+    [
+        (r"Fries", SYMBOLS.FRIES),  # E.g. 'Curly Fries'
+        (r"(Coca[\s-]*)?Cola", SYMBOLS.COLA),
+        (r"Big KING", "BigK"),
+    ],
+    # Remove "KING" from some product titles
+    (r"(Bacon|Fish|Halloumi)\s*KING", r"\1"),
+    # E.g. "KING Shake" --> "Shake"
+    (r"KING\s*(Jr\.?\s*Meal|Jr\.?\s*Menü|Shake|Sundae|Nuggets?|Wings?|Onion[\s-]*Rings?)", r"\1"),
+    # 'Meta' replaces
+    # Normalize- and fix drink unit e.g. "0,3 L" or "0.3l" to "0.3" (remove unit character to save even more space)
+    (r"(0[.,]\d{1,2})\s*L", r"\1"),
+    # Normalize 'nugget unit e.g. "6er KING Nuggets" -> "6 KING Nuggets"
+    (r"(\d{1,2})er\s*", r"\1"),
+    # E.g. "2x Crispy Chicken" --> 2 Crispy Chicken
+    (r"((\d+)[Xx] )([A-Za-z]+)", r"\2 \3"),
+    # "Chicken Nuggets" -> "Nuggets"
+    (r"Chicken\s*(Nuggets)", r"\1"),
+    # 2024-06-15: Fix "fan bundle"
+    (r"(Kleines?|Großes?)\s*(Plant[\w-]*)?\s*Fan\s*Bundle\s*", ""),
+    # 2024-06-29
+    (r"Wähle\s* zwischen\s*", ""),
+    # Cheeseburger -> Cheesebrgr
+    (r"(b)urger", r"\1rgr"),
+    [
+        # Assume that all users know that "Cheddar" is cheese so let's remove this double entry
+        (r"Cheddar\s*Cheese", "Cheddar"),
+        (r"Chicken", "Ckn"),
+        (r"Chili[\s-]*Cheese", "CC"),
+        (r"Deluxe", "Dlx"),
+        (r"Dips", "Dip"),
+        (r"Double", "Dbl"),
+        (r"Long", "Lng"),
+        (r"Nuggets?", "Nug"),
+        (r"Plant[\s-]*Based", "Plnt"),
+        (r"Tripp?le", "Trple"),
+        (r"Veggie", "Veg"),
+        (r"Whopper", "Wppr"),
+        (r"Steakhouse", "SteakH"),
+    ],
+    # Must not be fused with the rules above as e.g. "Deluxe tra" -> "Dlx tra" -> "DlXtra"
+    [
+        (r"X[\s-]*tra", "Xtra"),
+        (r"Onion[\s-]*Rings", "Rings"),
+    ],
+    # Down below comes other bullshit they sometimes place into the subtitle fields.
+    (r"\s*oder\s*", r","),
+    (r"\s*zum\s*Preis\s*von\s*(1!?|einem|einer)(\s*Portion)?", ""),
+    (r"^.{0,3}?Den Code zur Einlösung findest du im QR-Code.*", ""),
+    # Remove e.g. "Im KING Menü (+ 50 Cent)"
+    (r"Im King Menü \(\+[^)]+\)", ""),
+    (r" mit ", "&"),
+    (r"Jr\s*\.", "Jr"),
+    # e.g. 0,5 l King Shake® Schoko, Erdbeer- oder Vanillegeschmack
+    (r"\s*Geschmack", ""),
+    # Do some more basic replacements
+    (r"\s+und\s+", ","),
+]
+COMPILED_PRODUCT_TITLE_REPLACEMENT_RULES = compileProductTitleReplacementRules(PRODUCT_TITLE_REPLACEMENT_RULES)
+PRODUCT_TITLE_TRAILING_POINT_REGEX = re.compile(r"\.$")
+
+
 def getFilenameFromURL(url: str) -> str:
     filenameRegex = re.compile(r'(?i)^http.*[/=]([\w-]+\.(jpe?g|png))').search(url)
     if filenameRegex:
@@ -416,6 +481,16 @@ def isValidImageFile(path: Union[str, None]) -> bool:
         return False
 
 
+def isValidImageData(data: bytes) -> bool:
+    """ Checks if given bytes are a valid image so we don't have to write them to a file first. """
+    try:
+        im = Image.open(BytesIO(data))
+        im.verify()
+        return True
+    except:
+        return False
+
+
 # All CouponTypes which will be used in our bot (will be displayed in bot menu as categories)
 class CouponType:
     UNKNOWN = -1
@@ -437,6 +512,7 @@ BotAllowedCouponTypes = [CouponType.APP, CouponType.PAPER, CouponType.SPECIAL, C
 class Paths:
     configPath = 'config.json'
     extraCouponConfigPath = 'config_extra_coupons.json'
+    activityJournalPath = 'activity_journal.jsonl'
 
 
 def formatPrice(price: float) -> str:
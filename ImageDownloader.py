@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import os
+import statistics
+import time
+from typing import List, Tuple, Union
+
+import httpx
+
+from Helper import isValidImageData
+
+""" Status codes which are worth retrying: Rate limit and temporary server/CDN errors. """
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+def getHTTPClientLimits(maxConcurrentDownloads: int) -> httpx.Limits:
+    """ Connection pool large enough for all parallel downloads. Connections are kept alive between downloads so we don't need a new TLS handshake for every image. """
+    return httpx.Limits(max_connections=maxConcurrentDownloads + 4, max_keepalive_connections=maxConcurrentDownloads, keepalive_expiry=30)
+
+
+class ImageDownloader:
+    """ Downloads images with a limited number of parallel requests on a shared httpx.AsyncClient.
+     Each image is validated in memory and written to a temp file which is then atomically renamed so there will never be a broken or incomplete file under the final path.
+     Failed downloads are retried with exponential backoff. """
+
+    def __init__(self, client: httpx.AsyncClient, maxConcurrentDownloads: int = 8, maxRetries: int = 3, retryBaseDelaySeconds: float = 1):
+        self.client = client
+        self.semaphore = asyncio.Semaphore(maxConcurrentDownloads)
+        self.maxRetries = maxRetries
+        self.retryBaseDelaySeconds = retryBaseDelaySeconds
+        self.latencies = []
+        self.numberofBytes = 0
+        self.numberofFailedDownloads = 0
+
+    async def downloadAll(self, downloads: List[Tuple[str, str]]) -> int:
+        """ Downloads list of (url, path) items in parallel. Returns number of successfully downloaded images. """
+        timestampStart = time.monotonic()
+        results = await asyncio.gather(*[self.download(url, path) for url, path in downloads])
+        numberofDownloadedImages = sum(1 for result in results if result)
+        if len(downloads) > 0:
+            logging.info(self.getStatsText(time.monotonic() - timestampStart))
+        return numberofDownloadedImages
+
+    async def download(self, url: str, path: str) -> bool:
+        for tryNumber in range(self.maxRetries + 1):
+            if tryNumber > 0:
+                await asyncio.sleep(self.retryBaseDelaySeconds * 2 ** (tryNumber - 1))
+            try:
+                # Don't occupy a download slot while waiting for the next try
+                async with self.semaphore:
+                    timestampStart = time.monotonic()
+                    data = await self.fetch(url)
+            except httpx.TransportError as e:
+                logging.info(f'Image download failed: {url} | Try {tryNumber + 1}/{self.maxRetries + 1} | {e!r}')
+                continue
+            except httpx.HTTPStatusError as e:
+                if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                    logging.warning(f'Image download failed: {url} | Status: {e.response.status_code}')
+                    break
+                logging.info(f'Image download failed: {url} | Try {tryNumber + 1}/{self.maxRetries + 1} | Status: {e.response.status_code}')
+                continue
+            if not isValidImageData(data):
+                # Possibly a truncated response -> Retry
+                logging.info(f'Image is broken: {url} | Try {tryNumber + 1}/{self.maxRetries + 1}')
+                continue
+            latency = time.monotonic() - timestampStart
+            self.writeFileAtomic(path, data)
+            self.latencies.append(latency)
+            self.numberofBytes += len(data)
+            logging.info(f'Downloaded image to: {path} | Size: {len(data) / 1024:.0f}KB | Latency: {latency:.2f}s')
+            return True
+        self.numberofFailedDownloads += 1
+        logging.warning(f'Giving up on image download: {url}')
+        return False
+
+    async def fetch(self, url: str) -> bytes:
+        response = await self.client.get(url, follow_redirects=True)
+        response.raise_for_status()
+        return response.content
+
+    @staticmethod
+    def writeFileAtomic(path: str, data: bytes):
+        pathTmp = path + '.tmp'
+        with open(pathTmp, mode='wb') as file:
+            file.write(data)
+        os.replace(pathTmp, path)
+
+    def getStatsText(self, durationSeconds: Union[float, None] = None) -> str:
+        text = f'Image downloads: {len(self.latencies)} successful | {self.numberofFailedDownloads} failed'
+        if len(self.latencies) > 0:
+            text += f' | Latency min/median/max: {min(self.latencies):.2f}s/{statistics.median(self.latencies):.2f}s/{max(self.latencies):.2f}s'
+        if durationSeconds is not None and durationSeconds > 0:
+            text += f' | Duration: {durationSeconds:.1f}s | Throughput: {len(self.latencies) / durationSeconds:.1f} images/s, {self.numberofBytes / 1024 / durationSeconds:.0f}KB/s'
+        return text
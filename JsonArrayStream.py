@@ -0,0 +1,65 @@
+import json
+import re
+from typing import List
+
+""" Max. number of characters of the beginning of a response we keep for error messages. """
+MAX_HEAD_LENGTH = 1000
+
+
+class JsonArrayStreamParser:
+    """ Incrementally parses the items of one array inside a JSON document e.g. "sortedSystemwideOffers" of a GraphQL response.
+     Feed it the response text chunk by chunk: It returns every array item as soon as it is complete so the whole document never needs to be in memory at once.
+     Only works for arrays of objects/arrays and for keys which occur once in the document. """
+
+    def __init__(self, arrayKey: str):
+        self.arrayStartPattern = re.compile(r'"' + re.escape(arrayKey) + r'"\s*:\s*\[')
+        self.decoder = json.JSONDecoder()
+        self.buffer = ''
+        self.head = ''
+        self.isInsideArray = False
+        self.isDone = False
+        self.numberofItems = 0
+
+    def feed(self, text: str) -> List:
+        """ Adds next chunk of text and returns all array items which are complete now. """
+        if self.isDone:
+            return []
+        if len(self.head) < MAX_HEAD_LENGTH:
+            self.head += text[:MAX_HEAD_LENGTH - len(self.head)]
+        self.buffer += text
+        if not self.isInsideArray:
+            match = self.arrayStartPattern.search(self.buffer)
+            if match is None:
+                # Keep end of buffer in case the key has been split between two chunks
+                self.buffer = self.buffer[-200:]
+                return []
+            self.isInsideArray = True
+            self.buffer = self.buffer[match.end():]
+        items = []
+        pos = 0
+        length = len(self.buffer)
+        while pos < length:
+            char = self.buffer[pos]
+            if char.isspace() or char == ',':
+                pos += 1
+            elif char == ']':
+                self.isDone = True
+                pos += 1
+                break
+            else:
+                try:
+                    item, pos = self.decoder.raw_decode(self.buffer, pos)
+                except ValueError:
+                    # Item is not complete yet -> Wait for more data
+                    break
+                items.append(item)
+        self.buffer = self.buffer[pos:]
+        self.numberofItems += len(items)
+        return items
+
+    def close(self):
+        """ Call this once all data has been fed. Raises ValueError if the array was not found or is incomplete. """
+        if not self.isDone:
+            if not self.isInsideArray:
+                raise ValueError(f'Array not found in JSON response: {self.head}')
+            raise ValueError(f'JSON response ended inside array after {self.numberofItems} items')
@@ -0,0 +1,175 @@
+import hashlib
+import logging
+import time
+from typing import List, Iterable, Tuple, Dict
+
+from couchdb import Database
+
+from Helper import getCurrentDate, DB_BULK_PAGE_SIZE
+from models import OutboxEntry, OutboxMessage, OutboxEntryState, OUTBOX_VIEW_PENDING, OUTBOX_VIEW_MESSAGE_REFERENCES, OUTBOX_VIEW_FAILED, getViewName
+
+""" Max number of send attempts per notification before it is marked as failed. """
+MAX_OUTBOX_ENTRY_ATTEMPTS = 3
+""" Failed entries are kept for some time so they can be inspected, then they get deleted. """
+MAX_SECONDS_KEEP_FAILED_OUTBOX_ENTRIES = 7 * 24 * 60 * 60
+""" All texts get checked for references once per this interval (and after every restart) so texts released by a process which has been stopped don't stay forever. """
+SECONDS_BETWEEN_MESSAGE_SWEEPS = 24 * 60 * 60
+""" Texts younger than this are never deleted by the sweep so we don't race with entries which are just being enqueued. """
+MIN_SECONDS_KEEP_OUTBOX_MESSAGES = 60 * 60
+
+
+def getOutboxMessageID(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def getOutboxEntryID(userID: str, messageID: str) -> str:
+    return f'{userID}_{messageID}'
+
+
+class NotificationOutbox:
+    """ Durable store for notifications which are supposed to be sent to users.
+     Entries only contain (user id, message id, state, attempts) so enqueuing and acknowledging them never touches the (large) user documents.
+     Texts are stored separately once per distinct text and referenced by ID. """
+
+    def __init__(self, outboxDB: Database, messagesDB: Database):
+        self.outboxDB = outboxDB
+        self.messagesDB = messagesDB
+        self.lastSequenceNumber = 0
+        # Messages whose entries have been removed since the last cleanup -> They might not be referenced anymore
+        self.releasedMessageIDs = set()
+        self.timestampLastMessageSweep = 0
+
+    def getNextSequenceNumber(self) -> int:
+        """ Strictly increasing within this process and based on the current time in microseconds so it also keeps increasing across restarts. """
+        self.lastSequenceNumber = max(self.lastSequenceNumber + 1, int(time.time() * 1000000))
+        return self.lastSequenceNumber
+
+    def enqueue(self, userIDs: Iterable[str], text: str) -> int:
+        """ Enqueues the same text for all given users e.g. a newsletter. Returns number of newly enqueued entries. """
+        return self.enqueueMany([(userID, text) for userID in userIDs])
+
+    def enqueueMany(self, notifications: List[Tuple[str, str]]) -> int:
+        """ Enqueues list of (userID, text) items using bulk requests. Returns number of newly enqueued entries.
+         Notifications which are already pending for the same user are skipped, failed ones get replaced by a new pending entry. """
+        if len(notifications) == 0:
+            return 0
+        timestampNow = getCurrentDate().timestamp()
+        messages = {}
+        entries = {}
+        for userID, text in notifications:
+            userID = str(userID)
+            messageID = getOutboxMessageID(text)
+            if messageID not in messages:
+                messages[messageID] = OutboxMessage(id=messageID, text=text, timestampCreated=timestampNow)
+            entryID = getOutboxEntryID(userID, messageID)
+            if entryID not in entries:
+                entries[entryID] = OutboxEntry(id=entryID, userID=userID, messageID=messageID, sequenceNumber=self.getNextSequenceNumber(), timestampCreated=timestampNow)
+        # Store texts first so no pending entry ever references a missing text. Conflicts = text already exists which is fine.
+        self.bulkUpdate(self.messagesDB, list(messages.values()))
+        # Conflicts = User already has this notification in the outbox -> Skip it unless sending it has failed before
+        numberofEnqueuedEntries = 0
+        conflictedEntryIDs = []
+        for success, docID, revOrException in self.bulkUpdate(self.outboxDB, list(entries.values())):
+            if success:
+                numberofEnqueuedEntries += 1
+            else:
+                conflictedEntryIDs.append(docID)
+        entriesToReplace = []
+        for index in range(0, len(conflictedEntryIDs), DB_BULK_PAGE_SIZE):
+            for row in self.outboxDB.view('_all_docs', keys=conflictedEntryIDs[index:index + DB_BULK_PAGE_SIZE], include_docs=True):
+                if row.doc is not None and row.doc.get('state') == OutboxEntryState.FAILED:
+                    entry = entries[row.id]
+                    entry['_rev'] = row.doc['_rev']
+                    entriesToReplace.append(entry)
+        for success, docID, revOrException in self.bulkUpdate(self.outboxDB, entriesToReplace):
+            if success:
+                numberofEnqueuedEntries += 1
+        logging.info(f'Outbox: Enqueued {numberofEnqueuedEntries}/{len(entries)} notifications | Distinct texts: {len(messages)}')
+        return numberofEnqueuedEntries
+
+    def getPendingEntriesByUser(self) -> Dict[str, List[OutboxEntry]]:
+        """ Returns all pending entries grouped by userID, entries of each user in the order they were enqueued in. """
+        entriesByUser = {}
+        for row in self.outboxDB.iterview(getViewName(OUTBOX_VIEW_PENDING), DB_BULK_PAGE_SIZE, include_docs=True):
+            entry = OutboxEntry.wrap(row.doc)
+            entriesByUser.setdefault(entry.userID, []).append(entry)
+        return entriesByUser
+
+    def getMessageTexts(self, messageIDs: Iterable[str]) -> Dict[str, str]:
+        """ Returns mapping messageID -> text. Missing texts are not contained in the result. """
+        texts = {}
+        for row in self.messagesDB.view('_all_docs', keys=list(set(messageIDs)), include_docs=True):
+            if row.doc is not None:
+                texts[row.id] = row.doc['text']
+        return texts
+
+    def ack(self, entries: List[OutboxEntry]):
+        """ Removes successfully processed entries from the outbox. """
+        self.releasedMessageIDs.update(entry.messageID for entry in entries)
+        self.bulkUpdate(self.outboxDB, [{'_id': entry.id, '_rev': entry.rev, '_deleted': True} for entry in entries])
+
+    def nack(self, entries: List[OutboxEntry]):
+        """ Counts failed send attempt. Entries stay pending until they've reached the max. number of attempts. """
+        timestampNow = getCurrentDate().timestamp()
+        for entry in entries:
+            entry.attempts += 1
+            entry.timestampLastAttempt = timestampNow
+            if entry.attempts >= MAX_OUTBOX_ENTRY_ATTEMPTS:
+                logging.info(f'Outbox: Giving up on notification {entry.id} after {entry.attempts} attempts')
+                entry.state = OutboxEntryState.FAILED
+        self.bulkUpdate(self.outboxDB, entries)
+
+    def cleanup(self):
+        """ Deletes old failed entries and texts which aren't referenced by any entry anymore.
+         Usually only looks at texts of entries which have been removed since the last cleanup instead of scanning the whole outbox. """
+        timestampNow = getCurrentDate().timestamp()
+        entriesToDelete = []
+        for row in self.outboxDB.iterview(getViewName(OUTBOX_VIEW_FAILED), DB_BULK_PAGE_SIZE, endkey=timestampNow - MAX_SECONDS_KEEP_FAILED_OUTBOX_ENTRIES, include_docs=True):
+            entriesToDelete.append({'_id': row.id, '_rev': row.doc['_rev'], '_deleted': True})
+            self.releasedMessageIDs.add(row.value)
+        self.bulkUpdate(self.outboxDB, entriesToDelete)
+        messageIDs = list(self.releasedMessageIDs)
+        self.releasedMessageIDs.clear()
+        numberofDeletedMessages = self.deleteUnreferencedMessages(messageIDs)
+        if timestampNow - self.timestampLastMessageSweep >= SECONDS_BETWEEN_MESSAGE_SWEEPS:
+            numberofDeletedMessages += self.sweepUnreferencedMessages()
+            self.timestampLastMessageSweep = timestampNow
+        if len(entriesToDelete) > 0 or numberofDeletedMessages > 0:
+            logging.info(f'Outbox: Deleted {len(entriesToDelete)} old failed entries and {numberofDeletedMessages} unreferenced texts')
+
+    def sweepUnreferencedMessages(self) -> int:
+        """ Checks all texts for references e.g. texts released before a restart. Returns number of deleted texts. """
+        timestampMaxCreated = getCurrentDate().timestamp() - MIN_SECONDS_KEEP_OUTBOX_MESSAGES
+        numberofDeletedMessages = 0
+        messageIDs = []
+        for row in self.messagesDB.iterview('_all_docs', DB_BULK_PAGE_SIZE, include_docs=True):
+            if not row.id.startswith('_design/') and row.doc.get('timestampCreated', 0) < timestampMaxCreated:
+                messageIDs.append(row.id)
+            if len(messageIDs) >= DB_BULK_PAGE_SIZE:
+                numberofDeletedMessages += self.deleteUnreferencedMessages(messageIDs)
+                messageIDs = []
+        numberofDeletedMessages += self.deleteUnreferencedMessages(messageIDs)
+        return numberofDeletedMessages
+
+    def deleteUnreferencedMessages(self, messageIDs: List[str]) -> int:
+        """ Deletes all of the given texts which are not referenced by any entry. Returns number of deleted texts. """
+        if len(messageIDs) == 0:
+            return 0
+        referencedMessageIDs = {row.key for row in self.outboxDB.view(getViewName(OUTBOX_VIEW_MESSAGE_REFERENCES), keys=messageIDs, group=True)}
+        unreferencedMessageIDs = [messageID for messageID in messageIDs if messageID not in referencedMessageIDs]
+        if len(unreferencedMessageIDs) == 0:
+            return 0
+        messagesToDelete = []
+        for row in self.messagesDB.view('_all_docs', keys=unreferencedMessageIDs):
+            if row.value is not None and not row.value.get('deleted'):
+                messagesToDelete.append({'_id': row.id, '_rev': row.value['rev'], '_deleted': True})
+        self.bulkUpdate(self.messagesDB, messagesToDelete)
+        return len(messagesToDelete)
+
+    @staticmethod
+    def bulkUpdate(db: Database, docs: list) -> list:
+        """ Wrapper for db.update which splits big updates into multiple requests. """
+        results = []
+        for index in range(0, len(docs), DB_BULK_PAGE_SIZE):
+            results += db.update(docs[index:index + DB_BULK_PAGE_SIZE])
+        return results
@@ -0,0 +1,132 @@
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Tuple
+
+import qrcode
+
+
+class QRStyle:
+    """ Look of rendered QR codes. Default: Same color as in the BK app. """
+
+    def __init__(self, fillColor: str = "#4A1E0D", backColor: str = "white", border: int = 10, version: int = 1):
+        self.fillColor = fillColor
+        self.backColor = backColor
+        # 2021-05-02: This makes the image itself bigger but due to the border and the resize of Telegram, these QR codes might be suited better for usage in Telegram
+        self.border = border
+        self.version = version
+
+    def getKey(self) -> tuple:
+        return self.fillColor, self.backColor, self.border, self.version
+
+
+def getQRRenderHash(qrCodeData: str, style: QRStyle) -> str:
+    """ Identical payload + style = identical image. """
+    return hashlib.sha1(repr((qrCodeData, style.getKey())).encode('utf-8')).hexdigest()
+
+
+def renderQRImage(qrCodeData: str, path: str, styleKey: tuple):
+    """ Renders one QR image. Module level function so it can be executed in worker processes. """
+    fillColor, backColor, border, version = styleKey
+    qr = qrcode.QRCode(version=version, border=border)
+    qr.add_data(qrCodeData)
+    img = qr.make_image(fill_color=fillColor, back_color=backColor)
+    # Write to temp file first so an interrupted run never leaves a broken image behind
+    pathTmp = path + '.tmp'
+    img.save(pathTmp, format='PNG')
+    os.replace(pathTmp, path)
+
+
+class QRCodeRenderer:
+    """ Renders QR images in a pool of worker processes which gets started on first use and is kept until 'shutdown' is called.
+     Jobs with the same (payload, style) get rendered only once, all other paths get a copy of that image.
+     Use 'renderManyAsync' from async code so the event loop never gets blocked. """
+
+    def __init__(self, maxWorkers: int = None):
+        self.maxWorkers = maxWorkers
+        self.executor = None
+        # Render hash -> path of an image which has already been rendered
+        self.renderedPaths = {}
+
+    def getExecutor(self) -> ProcessPoolExecutor:
+        if self.executor is None:
+            # 'spawn' because forking the bot process from a non-main thread can deadlock
+            self.executor = ProcessPoolExecutor(max_workers=self.maxWorkers, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor
+
+    def shutdown(self):
+        """ Stops worker processes. They will be started again if something gets rendered afterwards. """
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def getJobsToRender(self, jobs: List[Tuple[str, str]], style: QRStyle, overwrite: bool) -> Tuple[dict, List[Tuple[str, str, str]]]:
+        """ Returns mapping render hash -> (qrCodeData, paths) of all images to create and list of (renderHash, qrCodeData, path) items which actually need to be rendered. """
+        pathsByHash = {}
+        for qrCodeData, path in jobs:
+            if not overwrite and os.path.exists(path):
+                continue
+            pathsByHash.setdefault(getQRRenderHash(qrCodeData, style), (qrCodeData, []))[1].append(path)
+        toRender = []
+        for renderHash, (qrCodeData, paths) in pathsByHash.items():
+            renderedPath = self.renderedPaths.get(renderHash)
+            if renderedPath is None or not os.path.exists(renderedPath):
+                toRender.append((renderHash, qrCodeData, paths[0]))
+        return pathsByHash, toRender
+
+    def copyRenderedImages(self, pathsByHash: dict) -> int:
+        """ Copies rendered images to all other paths with the same payload. Returns number of created images. """
+        numberofCreatedImages = 0
+        for renderHash, (qrCodeData, paths) in pathsByHash.items():
+            renderedPath = self.renderedPaths[renderHash]
+            for path in paths:
+                if path != renderedPath:
+                    shutil.copyfile(renderedPath, path)
+                numberofCreatedImages += 1
+        return numberofCreatedImages
+
+    def renderMany(self, jobs: List[Tuple[str, str]], style: QRStyle = None, overwrite: bool = False) -> int:
+        """ Renders list of (qrCodeData, path) items. Existing files are skipped unless <overwrite> is True. Returns number of created images. """
+        if style is None:
+            style = QRStyle()
+        timestampStart = time.monotonic()
+        pathsByHash, toRender = self.getJobsToRender(jobs, style, overwrite)
+        if len(pathsByHash) == 0:
+            return 0
+        if len(toRender) == 1 and self.executor is None:
+            # Not worth starting worker processes
+            renderHash, qrCodeData, path = toRender[0]
+            renderQRImage(qrCodeData, path, style.getKey())
+            self.renderedPaths[renderHash] = path
+        elif len(toRender) > 0:
+            executor = self.getExecutor()
+            futures = {renderHash: executor.submit(renderQRImage, qrCodeData, path, style.getKey()) for renderHash, qrCodeData, path in toRender}
+            for renderHash, qrCodeData, path in toRender:
+                futures[renderHash].result()
+                self.renderedPaths[renderHash] = path
+        numberofCreatedImages = self.copyRenderedImages(pathsByHash)
+        logging.info(f'Created {numberofCreatedImages} QR images | Rendered: {len(toRender)} | Duration: {time.monotonic() - timestampStart:.2f}s')
+        return numberofCreatedImages
+
+    async def renderManyAsync(self, jobs: List[Tuple[str, str]], style: QRStyle = None, overwrite: bool = False) -> int:
+        """ Same as 'renderMany' but awaits the worker processes directly instead of blocking a thread while they are busy. """
+        if style is None:
+            style = QRStyle()
+        timestampStart = time.monotonic()
+        pathsByHash, toRender = self.getJobsToRender(jobs, style, overwrite)
+        if len(pathsByHash) == 0:
+            return 0
+        if len(toRender) > 0:
+            loop = asyncio.get_running_loop()
+            executor = self.getExecutor()
+            await asyncio.gather(*[loop.run_in_executor(executor, renderQRImage, qrCodeData, path, style.getKey()) for renderHash, qrCodeData, path in toRender])
+            for renderHash, qrCodeData, path in toRender:
+                self.renderedPaths[renderHash] = path
+        numberofCreatedImages = self.copyRenderedImages(pathsByHash)
+        logging.info(f'Created {numberofCreatedImages} QR images | Rendered: {len(toRender)} | Duration: {time.monotonic() - timestampStart:.2f}s')
+        return numberofCreatedImages
@@ -0,0 +1,91 @@
+import argparse
+import glob
+import json
+import os
+import time
+
+from Helper import shortenProductNames
+
+""" Checks shortenProductNames against previously recorded outputs and measures its speed.
+ Titles are taken from paper_coupon_data/*.json and, if available, from a saved API response in crawler/coupons1.json.
+ Run with '-u' before changing PRODUCT_TITLE_REPLACEMENT_RULES to record the current outputs, then run without it to check that nothing has changed. """
+
+PATH_GOLDEN_OUTPUTS = 'TitleShortenerGolden.json'
+PATH_APP_COUPONS_JSON = 'crawler/coupons1.json'
+BENCHMARK_ROUNDS = 100
+
+
+def getLocaleRawText(data: dict, key: str):
+    try:
+        return data[key]['localeRaw'][0]['children'][0]['text']
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def loadTitles() -> list:
+    titles = []
+    for path in sorted(glob.glob('paper_coupon_data/*.json')):
+        with open(path, encoding='utf-8') as infile:
+            titles += [entry['title'] for entry in json.load(infile)]
+    if os.path.exists(PATH_APP_COUPONS_JSON):
+        with open(PATH_APP_COUPONS_JSON, encoding='utf-8') as infile:
+            apiResponse = json.load(infile)
+        for couponBK in apiResponse['data']['LoyaltyOffersUI']['sortedSystemwideOffers']:
+            for couponOrUpsell in [couponBK] + (couponBK.get('upsellOptions') or []):
+                for text in [getLocaleRawText(couponOrUpsell, 'name'), getLocaleRawText(couponOrUpsell, 'description')]:
+                    if text is not None:
+                        titles.append(text.strip())
+    else:
+        print(f'{PATH_APP_COUPONS_JSON} not found -> Only using paper coupon titles')
+    # Remove duplicates but keep order
+    return list(dict.fromkeys(titles))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-u', '--update', help='Record current outputs as golden outputs.', action='store_true')
+    args = parser.parse_args()
+    titles = loadTitles()
+    if args.update:
+        goldenOutputs = {}
+        if os.path.exists(PATH_GOLDEN_OUTPUTS):
+            with open(PATH_GOLDEN_OUTPUTS, encoding='utf-8') as infile:
+                goldenOutputs = json.load(infile)
+        for title in titles:
+            goldenOutputs[title] = shortenProductNames(title)
+        with open(PATH_GOLDEN_OUTPUTS, 'w', encoding='utf-8') as outfile:
+            json.dump(goldenOutputs, outfile, indent=2, ensure_ascii=False, sort_keys=True)
+        print(f'Recorded {len(goldenOutputs)} golden outputs')
+        return
+    with open(PATH_GOLDEN_OUTPUTS, encoding='utf-8') as infile:
+        goldenOutputs = json.load(infile)
+    numberofMismatches = 0
+    numberofUnknownTitles = 0
+    for title in titles:
+        if title not in goldenOutputs:
+            numberofUnknownTitles += 1
+            continue
+        newTitle = shortenProductNames(title)
+        if newTitle != goldenOutputs[title]:
+            numberofMismatches += 1
+            print(f'Mismatch: {title} | Expected: {goldenOutputs[title]} | Got: {newTitle}')
+    print(f'Checked {len(titles) - numberofUnknownTitles} titles | Mismatches: {numberofMismatches} | Titles without golden output: {numberofUnknownTitles}')
+    # Benchmark without and with result cache
+    timestampStart = time.time()
+    for i in range(BENCHMARK_ROUNDS):
+        shortenProductNames.cache_clear()
+        for title in titles:
+            shortenProductNames(title)
+    durationUncached = (time.time() - timestampStart) * 1000000 / (BENCHMARK_ROUNDS * len(titles))
+    timestampStart = time.time()
+    for i in range(BENCHMARK_ROUNDS):
+        for title in titles:
+            shortenProductNames(title)
+    durationCached = (time.time() - timestampStart) * 1000000 / (BENCHMARK_ROUNDS * len(titles))
+    print(f'shortenProductNames: {durationUncached:.1f}µs per title uncached | {durationCached:.2f}µs per title cached')
+    if numberofMismatches > 0:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
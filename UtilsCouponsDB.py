@@ -1,6 +1,7 @@
 import logging
 import os
 import re
+from collections import OrderedDict
 from datetime import datetime
 from enum import Enum
 from typing import Union, List
@@ -139,6 +140,73 @@ def getCouponViewByIndex(index: int) -> Union[CouponView, None]:
 
 
 COUPON_IS_NEW_FOR_SECONDS = 24 * 60 * 60
+MAX_CACHED_COUPON_DERIVED_ATTRIBUTES = 20000
+
+
+class CouponDerivedAttributes:
+    """ Values derived from the title/tags of one coupon revision. Computed once and then re-used by all consumers.
+     Also holds the pre-rendered texts of this coupon revision e.g. button labels. """
+
+    def __init__(self, sourceKey: tuple, title: Union[str, None], rawTitle: Union[str, None], tags: Union[List[str], None], couponType: int):
+        self.sourceKey = sourceKey
+        # Rendered texts by (text type, flags...)
+        self.texts = {}
+        tagsLower = [tag.lower() for tag in tags] if tags is not None else None
+        self.shortenedTitle = shortenProductNames(title)
+        self.normalizedTitle = re.sub(r'[\W_]+', '', self.shortenedTitle).lower()
+        self.isEatable = couponType != CouponType.PAYBACK
+        self.isContainsFriesAndDrink = couponTitleContainsFriesAndDrink(title)
+        self.isContainsChiliCheese = couponTitleContainsChiliCheese(title)
+        # Plant based
+        if tagsLower is not None and any('plant' in tag for tag in tagsLower):
+            self.isPlantBased = True
+        else:
+            self.isPlantBased = couponTitleContainsPlantBasedFood(title)
+        # Meat: First check for plant based stuff in title because BK sometimes has wrong tags (e.g. tag contains "chicken" when article is veggie lol)...
+        titleLower = title.lower()
+        if self.isPlantBased:
+            self.isContainsMeat = False
+        elif tagsLower is not None and any('beef' in tag or 'chicken' in tag for tag in tagsLower):
+            self.isContainsMeat = True
+        else:
+            self.isContainsMeat = 'chicken' in titleLower or 'wings' in titleLower or 'beef' in titleLower
+        # Veggie
+        if self.isContainsMeat:
+            # Some coupons are wrongly tagged so let's fix that by also looking into the product titles.
+            self.isVeggie = False
+        elif self.isPlantBased or couponTitleContainsVeggieFood(title):
+            self.isVeggie = True
+        elif tagsLower is not None and 'sweetkings' in tagsLower:
+            # Last resort: Check if tags contain any useful information.
+            self.isVeggie = True
+        else:
+            # If in doubt, the product is not veggie
+            self.isVeggie = rawTitle is not None and 'sundae' in rawTitle.lower()
+
+    def getNutritionSymbols(self, includeMeatSymbol: bool = False, includeVeggieSymbol: bool = True, includeChiliCheeseSymbol: bool = True) -> Union[str, None]:
+        """ Returns string of [allowed] nutrition symbols. """
+        if not self.isEatable:
+            return None
+        symbols = []
+        if includeMeatSymbol and self.isContainsMeat:
+            symbols.append(SYMBOLS.MEAT)
+        elif includeVeggieSymbol and self.isVeggie:
+            symbols.append(SYMBOLS.BROCCOLI)
+        if includeChiliCheeseSymbol and self.isContainsChiliCheese:
+            symbols.append(SYMBOLS.CHILI)
+        if len(symbols) == 0:
+            return None
+        return "".join(symbols)
+
+
+def getCouponDerivedAttributesSourceKey(coupon) -> tuple:
+    """ Returns all values of given coupon which derived attributes and pre-rendered texts depend on. """
+    return (coupon.getTitle(), tuple(coupon.tags) if coupon.tags is not None else None, coupon.type, coupon.plu, coupon.price, coupon.priceCompare,
+            coupon.staticReducedPercent)
+
+
+""" Maps (coupon ID, _rev) to CouponDerivedAttributes. """
+couponDerivedAttributesCache = OrderedDict()
 
 
 class Coupon(Document):
@@ -184,11 +252,23 @@ class Coupon(Document):
             else:
                 return self.id
 
+    def getDerivedAttributes(self) -> CouponDerivedAttributes:
+        """ Returns values derived from title/tags of this coupon revision. These get computed only once per coupon ID and revision. """
+        sourceKey = getCouponDerivedAttributesSourceKey(self)
+        cacheKey = (self.id, self.rev)
+        derivedAttributes = couponDerivedAttributesCache.get(cacheKey)
+        # Compare source values too as unsaved coupon objects can get modified without getting a new revision
+        if derivedAttributes is not None and derivedAttributes.sourceKey == sourceKey:
+            couponDerivedAttributesCache.move_to_end(cacheKey)
+            return derivedAttributes
+        derivedAttributes = CouponDerivedAttributes(sourceKey=sourceKey, title=self.getTitle(), rawTitle=self.title, tags=self.tags, couponType=self.type)
+        couponDerivedAttributesCache[cacheKey] = derivedAttributes
+        if len(couponDerivedAttributesCache) > MAX_CACHED_COUPON_DERIVED_ATTRIBUTES:
+            couponDerivedAttributesCache.popitem(last=False)
+        return derivedAttributes
+
     def getNormalizedTitle(self) -> Union[str, None]:
-        title = self.getTitle()
-        title = shortenProductNames(title)
-        title = re.sub(r'[\W_]+', '', title).lower()
-        return title
+        return self.getDerivedAttributes().normalizedTitle
 
     def getTitle(self) -> Union[str, None]:
         if self.paybackMultiplicator is not None:
@@ -200,7 +280,7 @@ class Coupon(Document):
         return self.subtitle
 
     def getTitleShortened(self, includeVeggieSymbol: bool = True, includeChiliCheeseSymbol: bool = True) -> Union[str, None]:
-        shortenedTitle = shortenProductNames(self.getTitle())
+        shortenedTitle = self.getDerivedAttributes().shortenedTitle
         nutritionSymbolsString = self.getNutritionSymbols(includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol)
         if nutritionSymbolsString is not None:
             shortenedTitle = nutritionSymbolsString + shortenedTitle
@@ -208,19 +288,8 @@ class Coupon(Document):
 
     def getNutritionSymbols(self, includeMeatSymbol: bool = False, includeVeggieSymbol: bool = True, includeChiliCheeseSymbol: bool = True) -> Union[str, None]:
         """ Returns string of [allowed] nutrition symbols. """
-        if not self.isEatable():
-            return None
-        symbols = []
-        if includeMeatSymbol and self.isContainsMeat():
-            symbols.append(SYMBOLS.MEAT)
-        elif includeVeggieSymbol and self.isVeggie():
-            symbols.append(SYMBOLS.BROCCOLI)
-        if includeChiliCheeseSymbol and self.isContainsChiliCheese():
-            symbols.append(SYMBOLS.CHILI)
-        if len(symbols) == 0:
-            return None
-        symbolsString = "".join(symbols)
-        return symbolsString
+        return self.getDerivedAttributes().getNutritionSymbols(includeMeatSymbol=includeMeatSymbol, includeVeggieSymbol=includeVeggieSymbol,
+                                                               includeChiliCheeseSymbol=includeChiliCheeseSymbol)
 
     def isExpiredForLongerTime(self) -> bool:
         """ Using this check, coupons that e.g. expire on midnight and get elongated will not be marked as new because really they aren't. """
@@ -264,66 +333,20 @@ class Coupon(Document):
             return True
 
     def isContainsFriesAndDrink(self) -> bool:
-        return couponTitleContainsFriesAndDrink(self.getTitle())
+        return self.getDerivedAttributes().isContainsFriesAndDrink
 
     def isContainsChiliCheese(self) -> bool:
-        return couponTitleContainsChiliCheese(self.getTitle())
+        return self.getDerivedAttributes().isContainsChiliCheese
 
     def isPlantBased(self) -> bool:
-        if self.tags is not None:
-            # First check tags
-            for tag in self.tags:
-                tag = tag.lower()
-                if 'plant' in tag:
-                    return True
-        if couponTitleContainsPlantBasedFood(self.getTitle()):
-            return True
-        else:
-            return False
+        return self.getDerivedAttributes().isPlantBased
 
     def isVeggie(self) -> bool:
-        if self.isContainsMeat():
-            """ 
-            Check if coupon contains meat. Some of them are wrongly tagged so ket's fix that by also looking into the product titles.
-             """
-            return False
-        elif self.isPlantBased():
-            return True
-        elif couponTitleContainsVeggieFood(self.getTitle()):
-            # No result? Fallback to other, more unsafe methods.
-            return True
-        # Last resort: Check if tags contain any useful information.
-        if self.tags is not None:
-            for tag in self.tags:
-                tag = tag.lower()
-                if tag == 'sweetkings':
-                    return True
-        titlelower = self.title.lower()
-        if 'sundae' in titlelower:
-            return True
-        # If in doubt, the product is not veggie
-        return False
+        return self.getDerivedAttributes().isVeggie
 
     def isContainsMeat(self) -> bool:
         """ Returns true if this coupon contains at least one article with meat. """
-        """ First check for plant based stuff in title because BK sometimes has wrong tags (e.g. tag contains "chicken" when article is veggie lol)... """
-        if self.isPlantBased():
-            return False
-        elif self.tags is not None:
-            for tag in self.tags:
-                tag = tag.lower()
-                if 'beef' in tag or 'chicken' in tag:
-                    return True
-
-        titleLower = self.getTitle().lower()
-        if 'chicken' in titleLower:
-            return True
-        elif 'wings' in titleLower:
-            return True
-        elif 'beef' in titleLower:
-            return True
-        else:
-            return False
+        return self.getDerivedAttributes().isContainsMeat
 
     def getPrice(self) -> Union[float, None]:
         return self.price
@@ -364,21 +387,23 @@ class Coupon(Document):
             timePassedSinceCouponValidityStarted = currentTimestamp - self.timestampStart
         if 0 < timePassedSinceCouponValidityStarted < COUPON_IS_NEW_FOR_SECONDS:
             return True
-        if self.isNewUntilDate is not None:
-            # Check if maybe coupon should be considered as new for X
-            try:
-                enforceIsNewOverrideUntilDate = datetime.strptime(self.isNewUntilDate + ' 23:59:59',
-                                                                  '%Y-%m-%d %H:%M:%S').astimezone(getTimezone())
-                if enforceIsNewOverrideUntilDate.timestamp() > getCurrentDate().timestamp():
-                    return True
-                else:
-                    return False
-            except:
-                # This should never happen
-                logging.warning("Coupon.isNewCoupon: WTF invalid date format??")
-                return False
+        # Check if maybe coupon should be considered as new for X
+        enforceIsNewOverrideUntilDate = self.getIsNewUntilDatetime()
+        if enforceIsNewOverrideUntilDate is not None and enforceIsNewOverrideUntilDate.timestamp() > getCurrentDate().timestamp():
+            return True
         return False
 
+    def getIsNewUntilDatetime(self) -> Union[datetime, None]:
+        """ Returns datetime until which this coupon shall be treated as new according to the 'isNewUntilDate' override. """
+        if self.isNewUntilDate is None:
+            return None
+        try:
+            return datetime.strptime(self.isNewUntilDate + ' 23:59:59', '%Y-%m-%d %H:%M:%S').astimezone(getTimezone())
+        except:
+            # This should never happen
+            logging.warning("Coupon.isNewCoupon: WTF invalid date format??")
+            return None
+
     def getStartDatetime(self) -> Union[datetime, None]:
         """ Returns datetime from which coupon is valid. Not all coupons got a startDatetime. """
         if self.timestampStart is not None and self.timestampStart > 0:
@@ -492,8 +517,34 @@ class Coupon(Document):
             description += f"{SYMBOLS.WARNING}Achtung!\nDerzeit fehlen die original Produktbilder von Papiercoupons!\nDas Bild dieses Coupons stammt vom gleichnamigen App Coupon! Es gelten die Textangaben in den Buttons und hier im Post-Text, nicht die aus den Bildern!!"
         return description
 
+    def getRenderedText(self, textKey: tuple, renderText) -> str:
+        """ Returns text from the pre-rendered texts of this coupon revision. Renders and stores it via given function if it hasn't been rendered yet. """
+        texts = self.getDerivedAttributes().texts
+        text = texts.get(textKey)
+        if text is None:
+            text = renderText()
+            texts[textKey] = text
+        return text
+
+    def preRenderTexts(self):
+        """ Renders all button label variants in advance so that the bot only needs to look them up. """
+        for includeVeggieSymbol in [True, False]:
+            for includeChiliCheeseSymbol in [True, False]:
+                for plumode in CouponTextRepresentationPLUMode:
+                    self.generateCouponShortText(highlightIfNew=False, includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol,
+                                                 plumode=plumode)
+        self.generateCouponShortTextFormatted(highlightIfNew=False)
+
     def generateCouponShortText(self, highlightIfNew: bool = True, includeVeggieSymbol: bool = True, includeChiliCheeseSymbol: bool = True, plumode: CouponTextRepresentationPLUMode = CouponTextRepresentationPLUMode.ALL_PLUS) -> str:
         """ Returns e.g. "Y15 | 2Whopper+M🍟+0,4Cola | 8,99€" """
+        couponText = self.getRenderedText(('short', includeVeggieSymbol, includeChiliCheeseSymbol, plumode),
+                                          lambda: self.renderCouponShortText(includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol,
+                                                                             plumode=plumode))
+        if highlightIfNew and self.isNewCoupon():
+            couponText = SYMBOLS.NEW + couponText
+        return couponText
+
+    def renderCouponShortText(self, includeVeggieSymbol: bool, includeChiliCheeseSymbol: bool, plumode: CouponTextRepresentationPLUMode) -> str:
         if plumode == CouponTextRepresentationPLUMode.ALL_PLUS and self.plu is not None:
             # All PLUs
             vouchercode = f"{self.plu} | {self.id}"
@@ -503,20 +554,15 @@ class Coupon(Document):
         else:
             # Long-PLU
             vouchercode = self.id
-        couponText = ''
-        if highlightIfNew and self.isNewCoupon():
-            couponText += SYMBOLS.NEW
-        couponText += vouchercode + " | " + self.getTitleShortened(includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol)
-        couponText = self.appendPriceInfoText(couponText)
-        return couponText
+        couponText = vouchercode + " | " + self.getTitleShortened(includeVeggieSymbol=includeVeggieSymbol, includeChiliCheeseSymbol=includeChiliCheeseSymbol)
+        return self.appendPriceInfoText(couponText)
 
     def generateCouponShortTextFormatted(self, highlightIfNew: bool) -> str:
         """ Returns e.g. "<b>Y15</b> | 2Whopper+M🍟+0,4Cola | 8,99€" """
-        couponText = ''
+        couponText = self.getRenderedText(('shortFormatted',),
+                                          lambda: self.appendPriceInfoText("<b>" + self.getPLUOrUniqueIDOrRedemptionHint() + "</b> | " + self.getTitleShortened()))
         if highlightIfNew and self.isNewCoupon():
-            couponText += SYMBOLS.NEW
-        couponText += "<b>" + self.getPLUOrUniqueIDOrRedemptionHint() + "</b> | " + self.getTitleShortened()
-        couponText = self.appendPriceInfoText(couponText)
+            couponText = SYMBOLS.NEW + couponText
         return couponText
 
     def generateCouponShortTextFormattedWithHyperlinkToChannelPost(self, highlightIfNew: bool, publicChannelName: str,
@@ -526,8 +572,7 @@ class Coupon(Document):
             messageID) + "\">"
         if highlightIfNew and self.isNewCoupon():
             couponText += SYMBOLS.NEW
-        couponText += self.getTitleShortened() + "</a>"
-        couponText = self.appendPriceInfoText(couponText)
+        couponText += self.getRenderedText(('shortFormattedHyperlinkEnd',), lambda: self.appendPriceInfoText(self.getTitleShortened() + "</a>"))
         return couponText
 
     def generateCouponLongTextFormatted(self) -> str:
@@ -869,6 +914,38 @@ if DISPLAY_BETA_SETTING:
     }
 
 
+def getDuplicateCouponGroups(coupons: Union[List[Coupon], dict]) -> List[List[Coupon]]:
+    """ Returns all groups of at least two coupons containing the same products according to their normalized titles. """
+    return [dupeslist for dupeslist in getCouponTitleMapping(coupons).values() if len(dupeslist) > 1]
+
+
+def getPreferredDuplicateCoupon(couponsForDuplicateRemoval: List[Coupon]) -> Coupon:
+    """ Returns the coupon which shall be kept out of a group of coupons containing the same products. """
+    # Sort these ones by price and pick the first (= cheapest) one for our mapping.
+    isDifferentPrices = False
+    firstPrice = None
+    appCoupon = None
+    if len(couponsForDuplicateRemoval) == 1:
+        return couponsForDuplicateRemoval[0]
+    for coupon in couponsForDuplicateRemoval:
+        if firstPrice is None:
+            firstPrice = coupon.getPrice()
+        elif coupon.getPrice() != firstPrice:
+            isDifferentPrices = True
+        if coupon.type == CouponType.APP:
+            appCoupon = coupon
+    if isDifferentPrices:
+        # Prefer cheapest coupon
+        couponsSorted = sortCouponsByPrice(couponsForDuplicateRemoval)
+        return couponsSorted[0]
+    elif appCoupon is not None:
+        # Same prices but different sources -> Prefer App coupon
+        return appCoupon
+    else:
+        # Same prices but all coupons are from the same source -> Should never happen but we'll cover it anyways -> Select first item.
+        return couponsForDuplicateRemoval[0]
+
+
 def removeDuplicatedCoupons(coupons: Union[List[Coupon], dict]) -> dict:
     couponTitleMapping = getCouponTitleMapping(coupons)
     # Now clean our mapping: Sometimes one product may be available twice with multiple prices -> We want exactly one mapping per title
@@ -884,31 +961,7 @@ def removeDuplicatedCoupons(coupons: Union[List[Coupon], dict]) -> dict:
         # Check if anything is left to do
         if len(couponsForDuplicateRemoval) == 0:
             continue
-        # Sort these ones by price and pick the first (= cheapest) one for our mapping.
-        isDifferentPrices = False
-        firstPrice = None
-        appCoupon = None
-        if len(couponsForDuplicateRemoval) == 1:
-            coupon = couponsForDuplicateRemoval[0]
-            couponsWithoutDuplicates[coupon.id] = coupon
-            continue
-        for coupon in couponsForDuplicateRemoval:
-            if firstPrice is None:
-                firstPrice = coupon.getPrice()
-            elif coupon.getPrice() != firstPrice:
-                isDifferentPrices = True
-            if coupon.type == CouponType.APP:
-                appCoupon = coupon
-        if isDifferentPrices:
-            # Prefer cheapest coupon
-            couponsSorted = sortCouponsByPrice(couponsForDuplicateRemoval)
-            coupon = couponsSorted[0]
-        elif appCoupon is not None:
-            # Same prices but different sources -> Prefer App coupon
-            coupon = appCoupon
-        else:
-            # Same prices but all coupons are from the same source -> Should never happen but we'll cover it anyways -> Select first item.
-            coupon = couponsForDuplicateRemoval[0]
+        coupon = getPreferredDuplicateCoupon(couponsForDuplicateRemoval)
         couponsWithoutDuplicates[coupon.id] = coupon
     numberofRemovedDuplicates = len(coupons) - len(couponsWithoutDuplicates)
     logging.debug("Number of removed duplicates: " + str(numberofRemovedDuplicates))
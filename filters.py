@@ -18,3 +18,7 @@ class CouponFilter(BaseModel):
     isPlantBased: Optional[Union[bool, None]] = None
     isEatable: Optional[Union[bool, None]] = None
     sortCode: Optional[Union[None, int]]
+
+    def getCacheKey(self) -> tuple:
+        """ Returns hashable representation of all filter values. """
+        return tuple((key, tuple(value) if isinstance(value, list) else value) for key, value in self.dict().items())
@@ -5,6 +5,7 @@ from typing import List, Union
 from barcode.ean import EuropeanArticleNumber13
 from barcode.writer import ImageWriter
 
+from couchdb.design import ViewDefinition
 from couchdb.mapping import Document, DateTimeField, TextField, DictField, ListField, IntegerField, BooleanField, Mapping, FloatField
 
 from Helper import getCurrentDate
@@ -13,6 +14,90 @@ from UtilsCouponsDB import MAX_TIMES_INFORM_ABOUT_UPCOMING_AUTO_ACCOUNT_DELETION
     MAX_SECONDS_WITHOUT_USAGE_UNTIL_SEND_WARNING_TO_USER, MIN_SECONDS_BETWEEN_UPCOMING_AUTO_DELETION_WARNING
 
 
+""" CouchDB views of the users DB. These get created/updated on startup. """
+USER_VIEW_PENDING_NOTIFICATIONS = ViewDefinition('users', 'pendingNotifications', '''function(doc) {
+    if (doc.pendingNotifications && doc.pendingNotifications.length > 0) {
+        emit(doc._id, doc.pendingNotifications.length);
+    }
+}''')
+""" Counters for the bot statistics. Use with group=True to get one row per counter. """
+USER_VIEW_STATS = ViewDefinition('users', 'stats', '''function(doc) {
+    emit('users', 1);
+    if (doc.easterEggCounter > 0) {
+        emit('easterEgg', 1);
+    }
+    var numberofFavorites = doc.favoriteCoupons ? Object.keys(doc.favoriteCoupons).length : 0;
+    if (numberofFavorites > 0) {
+        emit('favorites', numberofFavorites);
+    }
+    if (doc.botBlockedCounter > 0) {
+        emit('blocked', 1);
+    }
+    if (doc.paybackCard && doc.paybackCard.paybackCardNumber != null) {
+        emit('paybackCard', 1);
+    }
+    var settings = doc.settings || {};
+    if (settings.notifyOnBotNewsletter === undefined || settings.notifyOnBotNewsletter === true) {
+        emit('newsletter', 1);
+    }
+    if (settings.displayDonateButton === false) {
+        emit('donateButtonDisabled', 1);
+    }
+}''', '_sum')
+""" Users who haven't blocked the bot for a longer time by timestamp of last bot usage -> Range query = number of users who recently used the bot. """
+USER_VIEW_LAST_TIME_BOT_USED = ViewDefinition('users', 'lastTimeBotUsed', '''function(doc) {
+    if (doc.timestampLastTimeBotUsed > 0 && !(doc.botBlockedCounter >= 30)) {
+        emit(doc.timestampLastTimeBotUsed, null);
+    }
+}''', '_count')
+""" Users who could be auto deleted once their last account activity is old enough, by timestamp of last account activity (see User.isEligableForAutoDeletion).
+ Users who have blocked the bot for a longer time are emitted with timestamp 0 as they can be deleted any time. """
+USER_VIEW_AUTO_DELETION_CANDIDATES = ViewDefinition('users', 'autoDeletionCandidates', '''function(doc) {
+    if (doc.botBlockedCounter >= 30) {
+        emit(0, null);
+    } else if (doc.timesInformedAboutUpcomingAutoAccountDeletion >= %d) {
+        emit(Math.max(doc.timestampLastTimeBotUsed || 0, doc.timestampLastTimeNotificationSentSuccessfully || 0), null);
+    }
+}''' % MAX_TIMES_INFORM_ABOUT_UPCOMING_AUTO_ACCOUNT_DELETION, '_count')
+""" Users who want to be notified about all new coupons. """
+USER_VIEW_NEW_COUPONS_SUBSCRIBERS = ViewDefinition('users', 'newCouponsSubscribers', '''function(doc) {
+    if (doc.settings && doc.settings.notifyWhenNewCouponsAreAvailable === true) {
+        emit(doc._id, null);
+    }
+}''')
+""" All users sorted by timestamp of last account activity (see User.getSecondsPassedSinceLastAccountActivity). """
+USER_VIEW_LAST_ACCOUNT_ACTIVITY = ViewDefinition('users', 'lastAccountActivity', '''function(doc) {
+    emit(Math.max(doc.timestampLastTimeBotUsed || 0, doc.timestampLastTimeNotificationSentSuccessfully || 0), null);
+}''')
+USER_DB_VIEWS = [USER_VIEW_PENDING_NOTIFICATIONS, USER_VIEW_STATS, USER_VIEW_NEW_COUPONS_SUBSCRIBERS, USER_VIEW_LAST_ACCOUNT_ACTIVITY, USER_VIEW_LAST_TIME_BOT_USED, USER_VIEW_AUTO_DELETION_CANDIDATES]
+
+""" CouchDB views of the notification outbox DB. """
+OUTBOX_VIEW_PENDING = ViewDefinition('outbox', 'pending', '''function(doc) {
+    if (doc.state === 'pending') {
+        // Entries created before sequence numbers existed: Fall back to their creation timestamp in microseconds
+        emit([doc.userID, doc.sequenceNumber || Math.floor(doc.timestampCreated * 1000000)], doc.messageID);
+    }
+}''')
+""" Number of entries referencing each message. Use with group=True. """
+OUTBOX_VIEW_MESSAGE_REFERENCES = ViewDefinition('outbox', 'messageReferences', '''function(doc) {
+    if (doc.messageID) {
+        emit(doc.messageID, null);
+    }
+}''', '_count')
+""" Failed entries sorted by timestamp of their last send attempt. """
+OUTBOX_VIEW_FAILED = ViewDefinition('outbox', 'failed', '''function(doc) {
+    if (doc.state === 'failed') {
+        emit(doc.timestampLastAttempt, doc.messageID);
+    }
+}''')
+OUTBOX_DB_VIEWS = [OUTBOX_VIEW_PENDING, OUTBOX_VIEW_MESSAGE_REFERENCES, OUTBOX_VIEW_FAILED]
+
+
+def getViewName(viewDefinition: ViewDefinition) -> str:
+    """ Returns name which can be used to query given view e.g. "users/pendingNotifications". """
+    return viewDefinition.design + '/' + viewDefinition.name
+
+
 class InfoEntry(Document):
     dateLastSuccessfulChannelUpdate = DateTimeField()
     dateLastSuccessfulCrawlRun = DateTimeField()
@@ -20,6 +105,10 @@ class InfoEntry(Document):
     couponTypeOverviewMessageIDs = DictField(default={})
     messageIDsToDelete = ListField(IntegerField(), default=[])
     lastMaintenanceModeState = BooleanField()
+    # State of the last successfully processed crawl so unchanged crawls can be skipped after a restart too (see BKCrawler.crawl)
+    crawlFingerprint = TextField()
+    crawlExtraCouponsFingerprint = TextField()
+    appCouponsAPIConditionalHeaders = DictField(default={})
 
     def addMessageIDToDelete(self, messageID: int) -> bool:
         # Avoid duplicates
@@ -56,6 +145,29 @@ class InfoEntry(Document):
         self.couponTypeOverviewMessageIDs = {}
 
 
+class OutboxEntryState:
+    PENDING = 'pending'
+    FAILED = 'failed'
+
+
+class OutboxMessage(Document):
+    """ Text of a notification. ID is the hash of the text so identical texts e.g. a newsletter are only stored once. """
+    text = TextField()
+    timestampCreated = FloatField(default=0)
+
+
+class OutboxEntry(Document):
+    """ A notification which is supposed to be sent to one user. ID is '<userID>_<messageID>'. """
+    userID = TextField()
+    messageID = TextField()
+    state = TextField(default=OutboxEntryState.PENDING)
+    attempts = IntegerField(default=0)
+    # Strictly increasing: Defines the order in which the notifications of one user get sent
+    sequenceNumber = IntegerField(default=0)
+    timestampCreated = FloatField(default=0)
+    timestampLastAttempt = FloatField(default=0)
+
+
 class ChannelCoupon(Document):
     """ Represents a coupon posted in a Telegram channel.
      Only contains minimum of required information as information about coupons itself is stored in another DB. """
@@ -126,6 +238,7 @@ class User(Document):
             addedDate=DateTimeField()
         ))
     couponViewSortModes = DictField(default={})
+    # Legacy: Notifications are now stored in the notification outbox. Leftovers get moved there by the bot.
     pendingNotifications = ListField(TextField())
     # Rough timestamp when user user start commenad of bot last time -> Can be used to delete inactive users after X time
     timestampLastTimeBotUsed = FloatField(default=0)
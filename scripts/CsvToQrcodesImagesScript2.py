@@ -1,8 +1,11 @@
 import os.path
 import csv
 import re
+import sys
 
-import qrcode
+# Allow importing modules from the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from QRCodeRenderer import QRCodeRenderer
 
 """ Quick and dirty script to create QR Codes for all items of CSV exported data from crawler for old BK API.
 Usage:
@@ -27,6 +30,7 @@ class CsvToQrcodesImagesScript2:
             csvreader = csv.DictReader(csvfile, dialect='excel',
                                       fieldnames=["PRODUCT", "MENU", "PLU", "PLU2", "TYPE", "PRICE", "PRICE_COMPARE", "START", "EXP"], delimiter=',')
 
+            qrJobs = []
             position = 0
             for row in csvreader:
                 position += 1
@@ -60,14 +64,13 @@ class CsvToQrcodesImagesScript2:
                 filename = re.sub('[^\\w_.)( -]', '', filename)
                 # print(str(row))
                 print('Writing file' + filename)
-                qr = qrcode.QRCode(
-                    version=1,
-                    border=10
-                )
-                qr.add_data(plu)
-                """ 2021-01-25: Use the same color they're using in their app. """
-                img = qr.make_image(fill_color="#4A1E0D", back_color="white")
-                img.save(os.path.join(imagefolder, filename))
+                qrJobs.append((plu, os.path.join(imagefolder, filename)))
+            # Same PLU may appear in multiple rows -> Rendered only once
+            qrRenderer = QRCodeRenderer()
+            try:
+                qrRenderer.renderMany(qrJobs, overwrite=True)
+            finally:
+                qrRenderer.shutdown()
         print('SUCCESS | Done')
         return None
 
@@ -1,9 +1,12 @@
 import os.path
 import re
+import sys
 from os import listdir
 from os.path import isfile, join
 
-import qrcode
+# Allow importing modules from the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from QRCodeRenderer import QRCodeRenderer
 
 
 """ Creates QR codes for all files in folder "images" in the following format: plu_blabla.ext. Example: 1234_Productname.png
@@ -21,7 +24,7 @@ class QrImageFromImagesCreator:
         for f in listdir(imagefolder):
             if isfile(join(imagefolder, f)):
                 filenames.append(f)
-        numberofCreatedQRCodeImages = 0
+        qrJobs = []
         numberofSkippedFiles = 0
         numberofSkippedQRCodeFiles = 0
         for filename in filenames:
@@ -43,16 +46,12 @@ class QrImageFromImagesCreator:
                 print("Skipping already existing QR image: " + qrFilepath)
                 numberofSkippedQRCodeFiles += 1
                 continue
-            # print('Writing file' + qrFilepath)
-            qr = qrcode.QRCode(
-                version=1,
-                border=10
-            )
-            qr.add_data(plu)
-            """ 2021-01-25: Use the same color they're using in their app. """
-            img = qr.make_image(fill_color="#4A1E0D", back_color="white")
-            img.save(qrFilepath)
-            numberofCreatedQRCodeImages += 1
+            qrJobs.append((plu, qrFilepath))
+        qrRenderer = QRCodeRenderer()
+        try:
+            numberofCreatedQRCodeImages = qrRenderer.renderMany(qrJobs)
+        finally:
+            qrRenderer.shutdown()
         print(f'Number of created QR code images: {numberofCreatedQRCodeImages}')
         if numberofSkippedFiles > 0:
             print(f'Number of skipped files: {numberofSkippedFiles}')